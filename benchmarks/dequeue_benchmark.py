@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+"""Measures the dequeue latency of every dequeue strategy as the
+number of ready queues in a queue type grows. The latency should
+stay flat, since a dequeue only reads a bounded number of entries
+from the ready sorted set.
+
+The benchmark flushes the Redis database in the config before every
+run, so always point it to a scratch database.
+
+    python benchmarks/dequeue_benchmark.py /path/to/sharq.conf \\
+        --queues 1000,10000,100000,200000 --dequeues 2000
+"""
+import argparse
+import time
+from sharq import SharQ
+from sharq.queue import DEQUEUE_STRATEGIES
+from sharq.utils import generate_epoch
+
+QUEUE_TYPE = 'benchmark'
+
+# the ready queue selection of older SharQ versions, which read every
+# ready queue of the queue type. used as the baseline.
+UNBOUNDED_SELECTION_SCRIPT = """
+return #redis.call('ZRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+"""
+
+
+def populate(sq, queue_count, jobs_per_queue):
+    """Flushes the database and enqueues `jobs_per_queue` jobs
+    into each of `queue_count` queues.
+    """
+    sq.redis_client().flushdb()
+    jobs = []
+    for i in range(queue_count):
+        for j in range(jobs_per_queue):
+            jobs.append({
+                'payload': {'message': 'hello, world'},
+                'interval': 0,
+                'job_id': 'job-%d-%d' % (i, j),
+                'queue_id': 'queue-%d' % i,
+                'queue_type': QUEUE_TYPE
+            })
+    sq.enqueue_many(jobs)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def measure(func, iterations):
+    """Calls `func` `iterations` times and returns the latencies
+    in microseconds.
+    """
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('config', help='path to the SharQ config file.')
+    parser.add_argument('--queues', default='1000,10000,100000,200000',
+                        help='comma separated numbers of ready queues.')
+    parser.add_argument('--dequeues', type=int, default=2000,
+                        help='number of dequeues measured per run.')
+    args = parser.parse_args()
+
+    sq = SharQ(args.config)
+    unbounded_selection = sq.redis_client().register_script(
+        UNBOUNDED_SELECTION_SCRIPT)
+    ready_set = '%s:%s' % (sq._key_prefix, QUEUE_TYPE)
+
+    print('%-10s %-10s %12s %12s %12s' % (
+        'queues', 'strategy', 'mean (us)', 'p50 (us)', 'p99 (us)'))
+    for queue_count in [int(i) for i in args.queues.split(',')]:
+        # enough jobs per queue so that no queue runs dry while measuring.
+        jobs_per_queue = args.dequeues // queue_count + 1
+        populate(sq, queue_count, jobs_per_queue)
+        rows = [('unbounded', measure(
+            lambda: unbounded_selection(
+                keys=[ready_set], args=[generate_epoch()]),
+            args.dequeues))]
+        for strategy in DEQUEUE_STRATEGIES:
+            populate(sq, queue_count, jobs_per_queue)
+            rows.append((strategy, measure(
+                lambda: sq.dequeue(queue_type=QUEUE_TYPE, strategy=strategy),
+                args.dequeues)))
+
+        for name, samples in rows:
+            print('%-10d %-10s %12.1f %12.1f %12.1f' % (
+                queue_count, name, sum(samples) / len(samples),
+                percentile(samples, 0.5), percentile(samples, 0.99)))
+
+    sq.redis_client().flushdb()
+
+
+if __name__ == '__main__':
+    main()
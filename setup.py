@@ -12,6 +12,12 @@ setup(
     package_data={
         'sharq': ['scripts/lua/*.lua']
     },
+    entry_points={
+        'console_scripts': [
+            'sharq-requeuer = sharq.requeuer:main',
+            'sharq-exporter = sharq.exporter:main'
+        ]
+    },
     license="The MIT License (MIT)",
     description='An API queueing system built at Plivo.',
     long_description=open('README.md').read(),
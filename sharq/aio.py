@@ -0,0 +1,636 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+import array
+import asyncio
+try:
+    import redis.asyncio as aioredis
+    from redis.asyncio.cluster import RedisCluster as AsyncRedisCluster
+except ImportError:
+    # the asyncio client is available from redis-py 4.3 onwards.
+    aioredis = None
+    AsyncRedisCluster = None
+from sharq.queue import (SharQ, MAX_BLOCKING_TIMEOUT,
+                         CLUSTER_SOCKET_TIMEOUT)
+from sharq.utils import (is_valid_identifier, is_valid_interval,
+                         is_valid_requeue_limit, generate_epoch,
+                         convert_to_str)
+from sharq.exceptions import SharqException, BadArgumentException
+
+
+class AsyncSharQ(SharQ):
+    """The asyncio version of SharQ. It reads the same configuration
+    file and runs the same Lua scripts as SharQ, so both of them can
+    work on the same queues. Every function of SharQ which talks to
+    redis is a coroutine here.
+
+        sq = AsyncSharQ('/path/to/sharq.conf')
+        job = await sq.dequeue(queue_type='sms')
+    """
+
+    def _create_redis_client(self):
+        """Opens an asyncio redis connection pool as per the
+        redis section of the config.
+        """
+        if aioredis is None:
+            raise SharqException(
+                'redis-py 4.3 or above is required by AsyncSharQ.')
+
+        redis_connection_type = self._config.get('redis', 'conn_type')
+        db = self._config.get('redis', 'db')
+        if redis_connection_type == 'unix_sock':
+            return aioredis.StrictRedis(
+                db=db,
+                unix_socket_path=self._config.get('redis', 'unix_socket_path')
+            )
+        elif redis_connection_type == 'tcp_sock':
+            isclustered = False
+            if self._config.has_option('redis', 'clustered'):
+                isclustered = self._config.getboolean('redis', 'clustered')
+
+            if isclustered:
+                return AsyncRedisCluster(
+                    host=self._config.get('redis', 'host'),
+                    port=self._config.get('redis', 'port'),
+                    decode_responses=False,
+                    socket_timeout=CLUSTER_SOCKET_TIMEOUT)
+            else:
+                return aioredis.StrictRedis(
+                    db=db,
+                    host=self._config.get('redis', 'host'),
+                    port=self._config.get('redis', 'port'),
+                    password=self._config.get('redis', 'password')
+                )
+
+    async def close(self):
+        """Closes the redis connection pool."""
+        # redis-py 5 renamed `close` to `aclose`.
+        close = getattr(self._r, 'aclose', None) or self._r.close
+        await close()
+
+    async def enqueue(self, payload, interval, job_id,
+                      queue_id, queue_type='default', requeue_limit=None):
+        """Enqueues the job into the specified queue_id
+        of a particular queue_type
+        """
+        job_args = self._build_enqueue_args(
+            payload, interval, job_id, queue_id, queue_type, requeue_limit)
+
+        timestamp = str(generate_epoch())
+
+        keys = [
+            self._key_prefix,
+            queue_type
+        ]
+
+        args = self._build_metrics_args(timestamp, queue_type) + job_args
+
+        await self._lua_enqueue(keys=keys, args=args)
+
+        response = {
+            'status': 'queued'
+        }
+        return response
+
+    async def enqueue_many(self, jobs, batch_size=500):
+        """Enqueues a batch of jobs. See `SharQ.enqueue_many`."""
+        script_calls, responses = self._build_enqueue_many_args(
+            jobs, batch_size)
+        for keys, args in script_calls:
+            await self._lua_enqueue(keys=keys, args=args)
+
+        return responses
+
+    async def dequeue(self, queue_type='default', timeout=None,
+                      strategy=None):
+        """Dequeues a job from any of the ready queues
+        based on the queue_type. See `SharQ.dequeue`.
+        """
+        jobs = await self.dequeue_many(
+            queue_type=queue_type, count=1, timeout=timeout,
+            strategy=strategy)
+        if not jobs:
+            response = {
+                'status': 'failure'
+            }
+            return response
+
+        return jobs[0]
+
+    async def dequeue_many(self, queue_type='default', count=1, timeout=None,
+                           strategy=None):
+        """Dequeues up to `count` jobs of the queue_type in a
+        single call. See `SharQ.dequeue_many`.
+        """
+        strategy = self._validate_dequeue_args(
+            queue_type, count, timeout, strategy)
+
+        deadline = generate_epoch() + (timeout or 0)
+        notify = False
+        while True:
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+            args = self._build_dequeue_args(
+                queue_type, count, strategy, notify)
+            jobs = self._parse_dequeue_response(
+                await self._lua_dequeue(keys=keys, args=args))
+            if jobs:
+                return jobs
+
+            wait_time = deadline - generate_epoch()
+            if wait_time <= 0:
+                return jobs
+
+            await self._wait_for_ready_queue(queue_type, wait_time)
+            notify = True
+
+    async def _wait_for_ready_queue(self, queue_type, wait_time):
+        """Waits until the earliest queue of the queue_type gets
+        ready, or until an enqueue / requeue adds a new ready queue
+        to this queue_type. See `SharQ._wait_for_ready_queue`.
+        """
+        next_ready_queue = await self._r.zrange(
+            '%s:%s' % (self._key_prefix, queue_type), 0, 0, withscores=True)
+        wait_time = self._get_ready_wait_time(next_ready_queue, wait_time)
+
+        if wait_time >= 1000:
+            await self._r.blpop(
+                '%s:%s:notify' % (self._key_prefix, queue_type),
+                timeout=min(wait_time // 1000, MAX_BLOCKING_TIMEOUT))
+        else:
+            await asyncio.sleep(max(wait_time, 1) / 1000.0)
+
+    async def finish(self, job_id, queue_id, queue_type='default'):
+        """Marks any dequeued job as *completed successfully*."""
+        responses = await self.finish_many([(queue_type, queue_id, job_id)])
+        return responses[0]
+
+    async def finish_many(self, jobs, batch_size=500):
+        """Marks a batch of dequeued jobs as *completed successfully*.
+        See `SharQ.finish_many`.
+        """
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        jobs = list(jobs)
+        queue_type_jobs = self._group_jobs_by_queue_type(jobs)
+
+        responses = [None] * len(jobs)
+        timestamp = str(generate_epoch())
+        for queue_type, job_list in queue_type_jobs.items():
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+            for i in range(0, len(job_list), batch_size):
+                chunk = job_list[i:i + batch_size]
+                args = self._build_finish_args(queue_type, timestamp)
+                for _, queue_id, job_id in chunk:
+                    args.extend([queue_id, job_id])
+
+                finish_response = await self._lua_finish(keys=keys, args=args)
+                self._update_job_responses(responses, chunk, finish_response)
+
+        return responses
+
+    async def finish_and_dequeue(self, job_id, queue_id, queue_type='default',
+                                 strategy=None):
+        """Marks a dequeued job as *completed successfully* and
+        dequeues the next ready job of the same queue_type.
+        See `SharQ.finish_and_dequeue`.
+        """
+        keys, args = self._build_finish_and_dequeue_args(
+            job_id, queue_id, queue_type, strategy)
+
+        finish_response, dequeue_response = await self._lua_finish_dequeue(
+            keys=keys, args=args)
+        return self._parse_finish_and_dequeue_response(
+            finish_response, dequeue_response)
+
+    async def touch(self, job_id, queue_id, queue_type='default',
+                    extend_ms=None):
+        """Extends the lease of a dequeued job. See `SharQ.touch`."""
+        responses = await self.touch_many(
+            [(queue_type, queue_id, job_id)], extend_ms=extend_ms)
+        return responses[0]
+
+    async def touch_many(self, jobs, extend_ms=None):
+        """Extends the lease of a batch of dequeued jobs.
+        See `SharQ.touch_many`.
+        """
+        if extend_ms is None:
+            extend_ms = self._job_expire_interval
+
+        if not is_valid_interval(extend_ms):
+            raise BadArgumentException('`extend_ms` has an invalid value.')
+
+        jobs = list(jobs)
+        queue_type_jobs = self._group_jobs_by_queue_type(jobs)
+
+        timestamp = str(generate_epoch())
+        responses = [None] * len(jobs)
+        for queue_type, job_list in queue_type_jobs.items():
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+            args = [
+                timestamp,
+                extend_ms
+            ]
+            for _, queue_id, job_id in job_list:
+                args.extend([queue_id, job_id])
+
+            touch_response = await self._lua_touch(keys=keys, args=args)
+            self._update_job_responses(responses, job_list, touch_response)
+
+        return responses
+
+    async def release(self, job_id, queue_id, queue_type='default',
+                      delay_ms=0):
+        """Releases a dequeued job without waiting for it to expire.
+        See `SharQ.release`.
+        """
+        keys, args = self._build_release_args(
+            job_id, queue_id, queue_type, delay_ms)
+
+        requeued_job_count, discarded_job_count, _ = await self._lua_requeue(
+            keys=keys, args=args)
+
+        return self._parse_release_response(
+            requeued_job_count, discarded_job_count)
+
+    async def interval(self, interval, queue_id, queue_type='default'):
+        """Updates the interval for a specific queue_id
+        of a particular queue type.
+        """
+        keys, args = self._build_interval_args(interval, queue_id, queue_type)
+        interval_response = await self._lua_interval(keys=keys, args=args)
+        return self._parse_interval_response(interval_response)
+
+    def _is_clustered(self):
+        """Returns True when the redis client talks to a cluster."""
+        return (AsyncRedisCluster is not None and
+                isinstance(self._r, AsyncRedisCluster))
+
+    async def _requeue_lane(self, queue_types, timestamp, batch_size):
+        """Requeues the expired jobs of the queue_types, one after
+        the other. See `SharQ._requeue_lane`.
+        """
+        requeued_count = discarded_count = 0
+        for queue_type in queue_types:
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+
+            args = self._build_requeue_args(
+                queue_type, timestamp, 0, batch_size)
+            remaining_job_count = 1
+            while remaining_job_count > 0:
+                requeued_job_count, discarded_job_count, remaining_job_count = \
+                    await self._lua_requeue(keys=keys, args=args)
+                requeued_count += requeued_job_count
+                discarded_count += discarded_job_count
+
+        return requeued_count, discarded_count
+
+    async def requeue(self, batch_size=None, concurrency=None):
+        """Re-queues any expired job back into their respective
+        queue, in chunks of `batch_size` jobs, and discards the ones
+        which have no requeues remaining. Up to `concurrency` queue
+        types are requeued concurrently. See
+        `SharQ.requeue`.
+        """
+        batch_size, concurrency = self._validate_requeue_args(
+            batch_size, concurrency)
+
+        timestamp = str(generate_epoch())
+        active_queue_type_list = [
+            queue_type.decode('utf-8')
+            for queue_type in await self._r.smembers(
+                '%s:active:queue_type' % self._key_prefix)]
+        lanes = self._get_requeue_lanes(active_queue_type_list, concurrency)
+        lane_responses = await asyncio.gather(*[
+            self._requeue_lane(lane, timestamp, batch_size)
+            for lane in lanes])
+
+        return {
+            'status': 'success',
+            'requeued': sum(requeued for requeued, _ in lane_responses),
+            'discarded': sum(discarded for _, discarded in lane_responses)
+        }
+
+    async def get_dead_letters(self, queue_type='default', offset=0,
+                               limit=100):
+        """Returns a page of the jobs in the dead letter store of
+        the queue_type. See `SharQ.get_dead_letters`.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if not isinstance(offset, int) or offset < 0:
+            raise BadArgumentException('`offset` has an invalid value.')
+
+        if not isinstance(limit, int) or limit < 1:
+            raise BadArgumentException('`limit` has an invalid value.')
+
+        dead_letter_key = '%s:%s:dead' % (self._key_prefix, queue_type)
+        total = await self._r.zcard(dead_letter_key)
+        dead_jobs = await self._r.zrange(
+            dead_letter_key, offset, offset + limit - 1, withscores=True)
+
+        job_details = []
+        if dead_jobs:
+            job_details = await self._r.hmget(
+                '%s:job' % dead_letter_key, [job for job, _ in dead_jobs])
+
+        response = {
+            'status': 'success',
+            'total': int(total),
+            'dead_letters': self._parse_dead_letters(
+                queue_type, dead_jobs, job_details)
+        }
+        return response
+
+    def replay_dead_letters(self, queue_type='default', limit=None,
+                            batch_size=500, requeue_limit=None):
+        """Re-enqueues jobs from the dead letter store of the queue_type
+        in batches. Returns an asynchronous generator, which yields the
+        enqueue response of every job. See `SharQ.replay_dead_letters`.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise BadArgumentException('`limit` has an invalid value.')
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        if requeue_limit is not None and not is_valid_requeue_limit(
+                requeue_limit):
+            raise BadArgumentException(
+                '`requeue_limit` has an invalid value.')
+
+        return self._replay_dead_letters(
+            queue_type, limit, batch_size, requeue_limit)
+
+    async def _replay_dead_letters(self, queue_type, limit, batch_size,
+                                   requeue_limit):
+        dead_letter_key = '%s:%s:dead' % (self._key_prefix, queue_type)
+        replayed_job_count = 0
+        while limit is None or replayed_job_count < limit:
+            count = batch_size
+            if limit is not None:
+                count = min(batch_size, limit - replayed_job_count)
+
+            dead_jobs = await self._r.zrange(
+                dead_letter_key, 0, count - 1, withscores=True)
+            if not dead_jobs:
+                return
+
+            job_list = [job for job, _ in dead_jobs]
+            job_details = await self._r.hmget(
+                '%s:job' % dead_letter_key, job_list)
+            jobs = self._build_replay_jobs(
+                self._parse_dead_letters(queue_type, dead_jobs, job_details),
+                requeue_limit)
+            responses = await self.enqueue_many(jobs, batch_size=batch_size)
+
+            await self._r.zrem(dead_letter_key, *job_list)
+            await self._r.hdel('%s:job' % dead_letter_key, *job_list)
+
+            replayed_job_count += len(dead_jobs)
+            for response in responses:
+                yield response
+
+    def iter_queue_ids(self, queue_type, page_size=1000, count_only=False):
+        """Iterates over the queue_ids of the queue_type a page at a
+        time. Returns an asynchronous generator, which yields the list
+        of the queue_ids new in every page, or only their number with
+        `count_only`. See `SharQ.iter_queue_ids`.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if not isinstance(page_size, int) or page_size < 1:
+            raise BadArgumentException('`page_size` has an invalid value.')
+
+        return self._iter_queue_ids(queue_type, page_size, count_only)
+
+    async def _iter_queue_ids(self, queue_type, page_size, count_only):
+        seen_queue_ids = set()
+        for key, is_active in self._build_queue_id_keys(queue_type):
+            cursor = 0
+            while True:
+                cursor, members = await self._r.zscan(
+                    key, cursor, count=page_size)
+                queue_ids = self._parse_queue_id_page(
+                    members, is_active, seen_queue_ids)
+                if queue_ids:
+                    yield len(queue_ids) if count_only else [
+                        queue_id.decode('utf-8') for queue_id in queue_ids]
+                if cursor == 0:
+                    break
+
+    async def get_queue_type_stats(self, queue_type):
+        """Returns the counters of the jobs of the queue_type.
+        See `SharQ.get_queue_type_stats`.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        return self._parse_queue_type_stats(await self._r.hgetall(
+            '%s:%s:stats' % (self._key_prefix, queue_type)))
+
+    async def _get_latency_metrics(self, key):
+        """Returns the summaries of the wait time and the service time
+        histograms of `key`. See `SharQ._get_latency_metrics`.
+        """
+        pipe = self._r.pipeline()
+        for histogram_key in self._build_latency_keys(key, generate_epoch()):
+            pipe.hgetall(histogram_key)
+        return self._parse_latency_response(await pipe.execute())
+
+    async def metrics(self, queue_type=None, queue_id=None):
+        """Provides a way to get statistics about various
+        parameters. See `SharQ.metrics`.
+        """
+        if queue_id is not None and not is_valid_identifier(queue_id):
+            raise BadArgumentException('`queue_id` has an invalid value.')
+
+        if queue_type is not None and not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        response = {
+            'status': 'failure'
+        }
+        if not queue_type and not queue_id:
+            # return global stats.
+            # list of active queue types (ready + active)
+            active_queue_types = await self._r.smembers(
+                '%s:active:queue_type' % self._key_prefix)
+            ready_queue_types = await self._r.smembers(
+                '%s:ready:queue_type' % self._key_prefix)
+            all_queue_types = active_queue_types | ready_queue_types
+            queue_types = convert_to_str(all_queue_types)
+            # global rates for past 10 minutes
+            timestamp = str(generate_epoch())
+            keys = [
+                self._key_prefix
+            ]
+            args = self._build_metrics_args(timestamp)
+            enqueue_counts, dequeue_counts = self._parse_metrics_response(
+                await self._lua_metrics(keys=keys, args=args))
+
+            response.update({
+                'status': 'success',
+                'queue_types': queue_types,
+                'enqueue_counts': enqueue_counts,
+                'dequeue_counts': dequeue_counts
+            })
+            return response
+        elif queue_type and not queue_id:
+            # return list of queue_ids, read a page at a time.
+            queue_list = [
+                queue_id async for queue_ids in self.iter_queue_ids(queue_type)
+                for queue_id in queue_ids]
+            response.update({
+                'status': 'success',
+                'queue_ids': queue_list
+            })
+            response.update(await self.get_queue_type_stats(queue_type))
+            if self._get_queue_type_boolean(queue_type, 'queue_type_metrics'):
+                # queue_type rates over the metrics retention
+                keys = [
+                    '%s:%s' % (self._key_prefix, queue_type)
+                ]
+                args = self._build_metrics_args(str(generate_epoch()))
+                enqueue_counts, dequeue_counts = self._parse_metrics_response(
+                    await self._lua_metrics(keys=keys, args=args))
+                response.update({
+                    'enqueue_counts': enqueue_counts,
+                    'dequeue_counts': dequeue_counts
+                })
+            if self._get_latency_metrics_mode(queue_type) > 0:
+                wait_time, service_time = await self._get_latency_metrics(
+                    '%s:%s' % (self._key_prefix, queue_type))
+                response.update({
+                    'wait_time': wait_time,
+                    'service_time': service_time
+                })
+            return response
+        elif queue_type and queue_id:
+            # return specific details.
+            # queue specific rates for past 10 minutes
+            timestamp = str(generate_epoch())
+            keys = [
+                '%s:%s:%s' % (self._key_prefix, queue_type, queue_id)
+            ]
+            args = self._build_metrics_args(timestamp)
+            enqueue_counts, dequeue_counts = self._parse_metrics_response(
+                await self._lua_metrics(keys=keys, args=args))
+
+            # get the queue length for the job queue
+            queue_length = await self._r.llen('%s:%s:%s' % (
+                self._key_prefix, queue_type, queue_id))
+
+            response.update({
+                'status': 'success',
+                'queue_length': int(queue_length),
+                'enqueue_counts': enqueue_counts,
+                'dequeue_counts': dequeue_counts
+            })
+            if self._get_latency_metrics_mode(queue_type) == 2:
+                wait_time, service_time = await self._get_latency_metrics(
+                    '%s:%s:%s' % (self._key_prefix, queue_type, queue_id))
+                response.update({
+                    'wait_time': wait_time,
+                    'service_time': service_time
+                })
+            return response
+        elif not queue_type and queue_id:
+            raise BadArgumentException(
+                '`queue_id` should be accompanied by `queue_type`.')
+
+        return response
+
+    async def deep_status(self):
+        """To check the availability of redis. See `SharQ.deep_status`."""
+        return await self._r.set(
+            'sharq:deep_status:{}'.format(self._key_prefix),
+            'sharq_deep_status')
+
+    async def clear_queue(self, queue_type=None, queue_id=None,
+                          purge_all=False):
+        """clear the all entries in queue with particular queue_id
+        and queue_type. See `SharQ.clear_queue`.
+        """
+        if queue_id is None or not is_valid_identifier(queue_id):
+            raise BadArgumentException('`queue_id` has an invalid value.')
+
+        if queue_type is None or not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        response = {
+            'status': 'Failure',
+            'message': 'No queued calls found'
+        }
+        keys, args = self._build_clear_queue_args(
+            queue_type, queue_id, purge_all)
+        queued_status = await self._lua_clear_queue(keys=keys, args=args)
+        if queued_status and purge_all:
+            response.update({'status': 'Success',
+                             'message': 'Successfully removed all queued calls and purged related resources'})
+        elif queued_status:
+            response.update({'status': 'Success',
+                             'message': 'Successfully removed all queued calls'})
+        return response
+
+    async def get_queue_length(self, queue_type, queue_id):
+        """Return the current length of the job queue.
+        See `SharQ.get_queue_length`.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if not is_valid_identifier(queue_id):
+            raise BadArgumentException('`queue_id` has an invalid value.')
+
+        redis_key = self._key_prefix + ':' + queue_type + ':' + queue_id
+        return await self._r.llen(redis_key)
+
+    async def get_queue_lengths(self, queue_type, queue_ids, batch_size=1000):
+        """Returns the lengths of many queues of the queue_type.
+        See `SharQ.get_queue_lengths`.
+        """
+        queue_ids = self._validate_bulk_args(queue_type, queue_ids, batch_size)
+
+        queue_lengths = array.array('q')
+        for i in range(0, len(queue_ids), batch_size):
+            pipe = self._r.pipeline(transaction=False)
+            self._queue_metrics_many_commands(
+                pipe, queue_type, queue_ids[i:i + batch_size], [])
+            queue_lengths.extend(await pipe.execute())
+
+        return queue_lengths
+
+    async def metrics_many(self, queue_type, queue_ids, batch_size=1000):
+        """Returns the lengths and the enqueue / dequeue counts of many
+        queues of the queue_type. See `SharQ.metrics_many`.
+        """
+        queue_ids = self._validate_bulk_args(queue_type, queue_ids, batch_size)
+        buckets = self._get_metrics_buckets(queue_type)
+        batch_size = self._get_metrics_many_batch_size(buckets, batch_size)
+
+        response = self._build_metrics_many_response(queue_ids, buckets)
+        for i in range(0, len(queue_ids), batch_size):
+            pipe = self._r.pipeline(transaction=False)
+            self._queue_metrics_many_commands(
+                pipe, queue_type, queue_ids[i:i + batch_size], buckets)
+            self._update_metrics_many_response(
+                response, buckets, await pipe.execute())
+
+        return response
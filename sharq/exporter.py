@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+"""Serves the state and the rates of a SharQ in the OpenMetrics text
+format, for Prometheus to scrape.
+
+    sharq-exporter /path/to/sharq.conf --port 9515
+"""
+import logging
+import argparse
+from wsgiref.simple_server import make_server
+from sharq.queue import SharQ
+from sharq.utils import convert_to_str, generate_epoch
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# the name, type and help of every metric family, in the order they are
+# rendered. the samples of a counter get the _total suffix.
+METRIC_FAMILIES = (
+    ('sharq_enqueue_rate', 'gauge',
+     'Jobs enqueued per second in the last complete metrics bucket.'),
+    ('sharq_dequeue_rate', 'gauge',
+     'Jobs dequeued per second in the last complete metrics bucket.'),
+    ('sharq_ready_queues', 'gauge',
+     'Queues which have jobs waiting to be dequeued.'),
+    ('sharq_due_queues', 'gauge',
+     'Queues whose next job can be dequeued right now.'),
+    ('sharq_queued_jobs', 'gauge',
+     'Jobs waiting to be dequeued.'),
+    ('sharq_in_flight_jobs', 'gauge',
+     'Dequeued jobs which are not finished yet.'),
+    ('sharq_expired_jobs', 'gauge',
+     'Dequeued jobs whose lease expired, waiting to be requeued.'),
+    ('sharq_dead_letter_jobs', 'gauge',
+     'Discarded jobs kept in the dead letter store.'),
+    ('sharq_queue_type_enqueue_rate', 'gauge',
+     'Jobs of the queue type enqueued per second in the last complete '
+     'metrics bucket, when its queue_type_metrics are enabled.'),
+    ('sharq_queue_type_dequeue_rate', 'gauge',
+     'Jobs of the queue type dequeued per second in the last complete '
+     'metrics bucket, when its queue_type_metrics are enabled.'),
+    ('sharq_requeued_jobs', 'counter',
+     'Jobs requeued after their lease expired or they were released.'),
+    ('sharq_discarded_jobs', 'counter',
+     'Jobs discarded after running out of requeues.'),
+)
+
+
+class Exporter(object):
+    """An Exporter renders the metrics of a SharQ in the OpenMetrics
+    text format. Every scrape reads Redis in two pipelined round trips,
+    the first for the queue types and the global rates, and the second
+    for a fixed number of commands per queue type. So the cost of a
+    scrape does not depend on the number of queues, and nothing is
+    read per queue_id.
+    """
+
+    def __init__(self, sharq):
+        """Construct an Exporter.
+            * sharq - the SharQ object to export the metrics of.
+        """
+        self._sharq = sharq
+
+    def collect(self):
+        """Reads the metrics from Redis. Returns a dict of the name of
+        every metric family to its samples, as a list of (labels, value)
+        tuples.
+        """
+        r = self._sharq._r
+        prefix = self._sharq._key_prefix
+        timestamp = generate_epoch()
+        bucket_size = self._sharq._metrics_bucket_size
+        # the current bucket is still being counted.
+        last_bucket = timestamp // bucket_size * bucket_size - bucket_size
+
+        pipe = r.pipeline()
+        pipe.smembers('%s:active:queue_type' % prefix)
+        pipe.smembers('%s:ready:queue_type' % prefix)
+        pipe.get('%s:enqueue_counter:%d' % (prefix, last_bucket))
+        pipe.get('%s:dequeue_counter:%d' % (prefix, last_bucket))
+        active_queue_types, ready_queue_types, enqueue_count, dequeue_count = \
+            pipe.execute()
+        queue_types = sorted(convert_to_str(
+            active_queue_types | ready_queue_types))
+
+        pipe = r.pipeline()
+        for queue_type in queue_types:
+            ready_key = '%s:%s' % (prefix, queue_type)
+            active_key = '%s:%s:active' % (prefix, queue_type)
+            pipe.zcard(ready_key)
+            pipe.zcount(ready_key, 0, timestamp)
+            pipe.zcard(active_key)
+            pipe.zcount(active_key, 0, timestamp)
+            pipe.zcard('%s:%s:dead' % (prefix, queue_type))
+            pipe.get('%s:%s:enqueue_counter:%d' % (
+                prefix, queue_type, last_bucket))
+            pipe.get('%s:%s:dequeue_counter:%d' % (
+                prefix, queue_type, last_bucket))
+            pipe.hgetall('%s:%s:stats' % (prefix, queue_type))
+        responses = pipe.execute()
+
+        bucket_seconds = bucket_size / 1000.0
+        samples = dict((name, []) for name, _, _ in METRIC_FAMILIES)
+        samples['sharq_enqueue_rate'].append(
+            ({}, int(enqueue_count or 0) / bucket_seconds))
+        samples['sharq_dequeue_rate'].append(
+            ({}, int(dequeue_count or 0) / bucket_seconds))
+        for i, queue_type in enumerate(queue_types):
+            (ready_queue_count, due_queue_count, in_flight_job_count,
+             expired_job_count, dead_letter_count, queue_type_enqueue_count,
+             queue_type_dequeue_count, stats) = responses[i * 8:(i + 1) * 8]
+            stats = self._sharq._parse_queue_type_stats(stats)
+            labels = {'queue_type': queue_type}
+            samples['sharq_ready_queues'].append((labels, ready_queue_count))
+            samples['sharq_due_queues'].append((labels, due_queue_count))
+            samples['sharq_queued_jobs'].append((labels, stats['queued']))
+            samples['sharq_in_flight_jobs'].append(
+                (labels, in_flight_job_count))
+            samples['sharq_expired_jobs'].append((labels, expired_job_count))
+            samples['sharq_dead_letter_jobs'].append(
+                (labels, dead_letter_count))
+            if self._sharq._get_queue_type_boolean(
+                    queue_type, 'queue_type_metrics'):
+                samples['sharq_queue_type_enqueue_rate'].append(
+                    (labels, int(queue_type_enqueue_count or 0) /
+                     bucket_seconds))
+                samples['sharq_queue_type_dequeue_rate'].append(
+                    (labels, int(queue_type_dequeue_count or 0) /
+                     bucket_seconds))
+            samples['sharq_requeued_jobs'].append(
+                (labels, stats['requeued']))
+            samples['sharq_discarded_jobs'].append(
+                (labels, stats['discarded']))
+
+        return samples
+
+    def render(self):
+        """Returns the metrics in the OpenMetrics text format."""
+        samples = self.collect()
+        lines = []
+        for name, metric_type, description in METRIC_FAMILIES:
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.append('# HELP %s %s' % (name, description))
+            sample_name = name + '_total' if metric_type == 'counter' else name
+            for labels, value in samples[name]:
+                lines.append('%s%s %s' % (
+                    sample_name, _format_labels(labels), value))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def wsgi_app(self, environ, start_response):
+        """A WSGI application which serves the metrics on /metrics."""
+        if environ.get('PATH_INFO', '/') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found\n']
+
+        try:
+            body = self.render().encode('utf-8')
+        except Exception:
+            logger.exception('could not collect the metrics')
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'text/plain')])
+            return [b'could not collect the metrics\n']
+
+        start_response('200 OK', [
+            ('Content-Type', CONTENT_TYPE),
+            ('Content-Length', str(len(body)))
+        ])
+        return [body]
+
+
+def _format_labels(labels):
+    """Renders the labels of a sample, escaping their values."""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, value.replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('config', help='path to the SharQ config file.')
+    parser.add_argument('--host', default='0.0.0.0',
+                        help='address to listen on. defaults to 0.0.0.0.')
+    parser.add_argument('--port', type=int, default=9515,
+                        help='port to listen on. defaults to 9515.')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    exporter = Exporter(SharQ(args.config))
+    server = make_server(args.host, args.port, exporter.wsgi_app)
+    logger.info('serving the metrics on %s:%d/metrics', args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+"""Times the operations of a SharQ, and the phases every operation
+goes through, for a recorder. The timing is installed on a SharQ object
+by `SharQ.set_recorder`, and costs nothing until then.
+
+    recorder = HistogramRecorder()
+    sq.set_recorder(recorder)
+    sq.enqueue(...)
+    recorder.snapshot()['enqueue']['lua_enqueue']['p99']
+"""
+import time
+import bisect
+import inspect
+import threading
+import contextvars
+
+# the public functions of SharQ which are timed as operations. the
+# duration of a whole operation is recorded as its `total` phase. the
+# operations which return a generator go on while it is iterated, see
+# `_time_generator`.
+OPERATIONS = (
+    'enqueue', 'enqueue_many', 'dequeue', 'dequeue_many', 'finish',
+    'finish_many', 'finish_and_dequeue', 'touch', 'touch_many', 'release',
+    'interval', 'requeue', 'get_dead_letters', 'replay_dead_letters',
+    'metrics', 'clear_queue', 'get_queue_length', 'get_queue_lengths',
+    'metrics_many', 'iter_queue_ids', 'get_queue_type_stats', 'deep_status'
+)
+
+# the public functions of SharQ which are not timed, as they do not
+# talk to redis.
+UNTIMED_FUNCTIONS = (
+    'redis_client', 'reload_config', 'reload_lua_scripts', 'set_recorder'
+)
+
+# the internal functions of SharQ which are timed as phases of the
+# operation calling them. every Lua script call is a phase of its own,
+# named after the script (lua_enqueue, lua_dequeue, ...), which covers
+# the round trip to redis along with the run of the script.
+PHASES = {
+    '_build_enqueue_args': 'validate',
+    '_build_enqueue_many_args': 'validate',
+    '_validate_dequeue_args': 'validate',
+    '_build_dequeue_args': 'validate',
+    '_group_jobs_by_queue_type': 'validate',
+    '_build_finish_args': 'validate',
+    '_build_finish_and_dequeue_args': 'validate',
+    '_build_release_args': 'validate',
+    '_build_interval_args': 'validate',
+    '_validate_requeue_args': 'validate',
+    '_build_requeue_args': 'validate',
+    '_build_metrics_args': 'validate',
+    '_validate_bulk_args': 'validate',
+    '_build_clear_queue_args': 'validate',
+    '_serialize_payload': 'serialize',
+    '_parse_dequeue_response': 'deserialize',
+    '_parse_finish_and_dequeue_response': 'deserialize',
+    '_parse_dead_letters': 'deserialize',
+    '_wait_for_ready_queue': 'wait'
+}
+
+# the operation recorded for the phases which run outside of any
+# operation, like the lease script calls of the requeuer.
+NO_OPERATION = 'other'
+
+# upper bounds of the buckets of the HistogramRecorder, in milliseconds.
+DURATION_BUCKETS = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+    2500, 5000, 10000
+)
+
+DURATION_PERCENTILES = (50, 95, 99)
+
+# the (operation, phase) being timed. a context variable, so that it is
+# kept apart for every thread and for every asyncio task.
+_timing = contextvars.ContextVar('sharq_timing', default=(None, None))
+
+
+class Recorder(object):
+    """The interface of the recorders given to `SharQ.set_recorder`.
+    `record` is called from the thread (or the asyncio task) which
+    called the operation, and should not block.
+    """
+
+    def record(self, operation, phase, duration):
+        """Records the duration, in milliseconds, of a phase of an
+        operation. The phase is `total` for the whole operation.
+        """
+        raise NotImplementedError
+
+
+class HistogramRecorder(Recorder):
+    """Keeps a histogram of the durations of every phase of every
+    operation in memory, with the DURATION_BUCKETS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (operation, phase) -> [bucket counts, duration sum]
+        self._histograms = {}
+
+    def record(self, operation, phase, duration):
+        bucket = bisect.bisect_left(DURATION_BUCKETS, duration)
+        with self._lock:
+            histogram = self._histograms.get((operation, phase))
+            if histogram is None:
+                histogram = self._histograms[(operation, phase)] = [
+                    [0] * (len(DURATION_BUCKETS) + 1), 0.0]
+            histogram[0][bucket] += 1
+            histogram[1] += duration
+
+    def reset(self):
+        """Drops all the recorded durations."""
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot(self):
+        """Returns a dict of every operation to a dict of its phases
+        to the summary of their durations: the count, the sum, the
+        counts of every bucket (keyed by its upper bound) and the
+        DURATION_PERCENTILES. A percentile is interpolated linearly
+        within its bucket, and is the largest finite upper bound when
+        it falls into the +Inf bucket. The durations are in milliseconds.
+        """
+        with self._lock:
+            histograms = [
+                (operation, phase, list(bucket_counts), duration_sum)
+                for (operation, phase), (bucket_counts, duration_sum)
+                in self._histograms.items()]
+
+        snapshot = {}
+        for operation, phase, bucket_counts, duration_sum in histograms:
+            snapshot.setdefault(operation, {})[phase] = _summarize_durations(
+                bucket_counts, duration_sum)
+        return snapshot
+
+
+def _summarize_durations(bucket_counts, duration_sum):
+    """Summarizes the bucket counts of a HistogramRecorder histogram."""
+    bounds = DURATION_BUCKETS + (None,)
+    duration_count = sum(bucket_counts)
+    summary = {
+        'count': duration_count,
+        'sum': round(duration_sum, 3),
+        'buckets': dict(
+            ('+Inf' if bound is None else '%g' % bound, count)
+            for bound, count in zip(bounds, bucket_counts) if count)
+    }
+    for percentile in DURATION_PERCENTILES:
+        rank = duration_count * percentile / 100.0
+        value = None
+        lower_bound = cumulative_count = 0
+        for bound, count in zip(bounds, bucket_counts):
+            if count and cumulative_count + count >= rank:
+                if bound is None:
+                    value = lower_bound
+                else:
+                    value = lower_bound + (bound - lower_bound) * (
+                        rank - cumulative_count) / count
+                break
+            cumulative_count += count
+            if bound is not None:
+                lower_bound = bound
+        summary['p%d' % percentile] = (
+            None if value is None else round(value, 3))
+
+    return summary
+
+
+def instrument(sharq, recorder):
+    """Times the OPERATIONS, the PHASES and the Lua script calls of
+    the SharQ object with the recorder, by shadowing them with timed
+    functions on the object. A recorder of None removes the timing.
+    """
+    for name, (original, timed) in sharq._instrumented.items():
+        if sharq.__dict__.get(name) is not timed:
+            # replaced since, e.g. by a reload of the Lua scripts.
+            continue
+        if original is None:
+            delattr(sharq, name)
+        else:
+            setattr(sharq, name, original)
+    sharq._instrumented = {}
+    sharq._recorder = recorder
+    if recorder is None:
+        return
+
+    names = [(name, name, None) for name in OPERATIONS]
+    names.extend((name, None, phase) for name, phase in PHASES.items())
+    names.extend(
+        (name, None, name[1:]) for name in list(sharq.__dict__)
+        if name.startswith('_lua_') and not name.endswith('_script'))
+    for name, operation, phase in names:
+        original = sharq.__dict__.get(name)
+        timed = _time(getattr(sharq, name), operation, phase, recorder)
+        setattr(sharq, name, timed)
+        sharq._instrumented[name] = (original, timed)
+
+
+def _time(function, operation, phase, recorder):
+    """Returns a function which calls `function` and records its
+    duration as the operation, or as the phase of the operation being
+    timed. An operation called by another operation is a part of that
+    one, and so is a phase called within the same phase; neither is
+    recorded on its own.
+    """
+    def start():
+        current_operation, current_phase = _timing.get()
+        if phase is None:
+            if current_operation is not None:
+                return None
+            return _timing.set((operation, None)), operation, 'total'
+        if current_phase == phase:
+            return None
+        current_operation = current_operation or NO_OPERATION
+        return (_timing.set((current_operation, phase)),
+                current_operation, phase)
+
+    def stop(timing, start_time, result=None):
+        duration = (time.perf_counter() - start_time) * 1000
+        token, timed_operation, timed_phase = timing
+        _timing.reset(token)
+        if inspect.isgenerator(result) or inspect.isasyncgen(result):
+            return _time_generator(
+                result, timed_operation, timed_phase, recorder, duration)
+        recorder.record(timed_operation, timed_phase, duration)
+        return result
+
+    if _is_coroutine_function(function):
+        async def timed(*args, **kwargs):
+            timing = start()
+            if timing is None:
+                return await function(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                result = await function(*args, **kwargs)
+            except BaseException:
+                stop(timing, start_time)
+                raise
+            return stop(timing, start_time, result)
+    else:
+        def timed(*args, **kwargs):
+            timing = start()
+            if timing is None:
+                return function(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                stop(timing, start_time)
+                raise
+            return stop(timing, start_time, result)
+
+    return timed
+
+
+def _time_generator(generator, operation, phase, recorder, duration):
+    """Returns a generator (or an asynchronous generator) which
+    yields the items of the generator returned by an operation. The
+    time spent in the generator is added to the `duration` of the call,
+    and the phases it goes through are timed as parts of the operation.
+    The duration is recorded once the generator is exhausted or closed,
+    and not at all if it is never iterated.
+    """
+    if inspect.isasyncgen(generator):
+        async def timed_generator():
+            total_duration = duration
+            try:
+                while True:
+                    token = _timing.set((operation, None))
+                    start_time = time.perf_counter()
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        total_duration += (
+                            time.perf_counter() - start_time) * 1000
+                        _timing.reset(token)
+                    yield item
+            finally:
+                await generator.aclose()
+                recorder.record(operation, phase, total_duration)
+    else:
+        def timed_generator():
+            total_duration = duration
+            try:
+                while True:
+                    token = _timing.set((operation, None))
+                    start_time = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        total_duration += (
+                            time.perf_counter() - start_time) * 1000
+                        _timing.reset(token)
+                    yield item
+            finally:
+                generator.close()
+                recorder.record(operation, phase, total_duration)
+
+    return timed_generator()
+
+
+def _is_coroutine_function(function):
+    """Returns True for a coroutine function, and for an object whose
+    __call__ is one, like the Lua scripts of the asyncio client.
+    """
+    return (inspect.iscoroutinefunction(function) or
+            inspect.iscoroutinefunction(getattr(function, '__call__', None)))
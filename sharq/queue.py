@@ -2,15 +2,75 @@
 # Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
 import os
 import sys
+import array
+import time
+import random
+import itertools
 import signal
 import configparser
+import contextvars
+import msgpack
 import redis
-from rediscluster import RedisCluster as StrictRedisCluster
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from rediscluster import RedisCluster as StrictRedisCluster
+except ImportError:
+    # redis-py-cluster is only needed in the cluster mode. it does not
+    # support redis-py 4+, which is needed by the asyncio client.
+    StrictRedisCluster = None
 from sharq.utils import (is_valid_identifier, is_valid_interval,
                          is_valid_requeue_limit, generate_epoch,
                          serialize_payload, deserialize_payload,
                          convert_to_str)
 from sharq.exceptions import SharqException, BadArgumentException
+from sharq.instrumentation import instrument
+
+# socket timeout, in seconds, of the clients of a redis cluster. the
+# clients of a single redis have no socket timeout.
+CLUSTER_SOCKET_TIMEOUT = 5
+
+# maximum number of seconds a blocking dequeue waits in a single
+# redis call. this is kept below the socket timeout of the cluster
+# clients, and bounds the time a consumer misses a queue which gets
+# ready without a notify token, like one added with a later ready time.
+MAX_BLOCKING_TIMEOUT = CLUSTER_SOCKET_TIMEOUT - 1
+
+# the metrics Lua script reads every bucket in a single MGET, which
+# is bounded by the stack size of the Lua interpreter in redis.
+MAX_METRICS_BUCKET_COUNT = 3600
+
+# the most queues a bulk read (metrics_many, get_queue_lengths) takes
+# in a single call, and the most counter keys metrics_many reads in a
+# single round trip. a chunk is made smaller than its batch_size to
+# stay below the latter when there are many metrics buckets.
+MAX_BULK_QUEUE_COUNT = 100000
+MAX_METRICS_MANY_KEY_COUNT = 100000
+
+# strategies to pick the ready queues to dequeue from.
+#   earliest - the queues which have been ready the longest.
+#   random   - random queues among the sampled ready queues.
+#   backlog  - the queues with the most jobs among the sampled ready queues.
+DEQUEUE_STRATEGIES = ('earliest', 'random', 'backlog')
+
+# the modes of the per queue enqueue / dequeue counters.
+#   on      - every queue is counted.
+#   off     - no queue is counted.
+#   sampled - a queue is counted with the probability of the
+#             queue_metrics_sample_rate, scaled up by its inverse.
+QUEUE_METRICS_MODES = ('on', 'off', 'sampled')
+
+# the modes of the wait time and service time histograms.
+#   off        - no latency is measured.
+#   queue_type - a histogram is kept for every queue_type.
+#   queue      - a histogram is kept for every queue as well.
+LATENCY_METRICS_MODES = ('off', 'queue_type', 'queue')
+
+# the percentiles of the latencies returned by metrics.
+LATENCY_PERCENTILES = (50, 95, 99)
+
+# the counters of the jobs of a queue_type, kept in the
+# <key_prefix>:<queue_type>:stats hash by the Lua scripts.
+QUEUE_TYPE_STATS = ('queued', 'in_flight', 'requeued', 'discarded')
 
 
 class SharQ(object):
@@ -29,6 +89,9 @@ class SharQ(object):
             3. Initialized SharQ.
         """
         self.config_path = config_path
+        # the recorder of the instrumentation, see `set_recorder`.
+        self._recorder = None
+        self._instrumented = {}
         self._load_config()
         self._initialize()
 
@@ -41,15 +104,68 @@ class SharQ(object):
         self._job_expire_interval = int(
             self._config.get('sharq', 'job_expire_interval')
         )
+        self._job_requeue_interval = 1000
+        if self._config.has_option('sharq', 'job_requeue_interval'):
+            self._job_requeue_interval = self._config.getint(
+                'sharq', 'job_requeue_interval')
         self._default_job_requeue_limit = int(
             self._config.get('sharq', 'default_job_requeue_limit')
         )
+        self._dequeue_strategy = 'earliest'
+        if self._config.has_option('sharq', 'dequeue_strategy'):
+            self._dequeue_strategy = self._config.get(
+                'sharq', 'dequeue_strategy')
+        if self._dequeue_strategy not in DEQUEUE_STRATEGIES:
+            raise SharqException(
+                '`dequeue_strategy` should be one of %s.' % ', '.join(
+                    DEQUEUE_STRATEGIES))
+        self._dequeue_sample_size = 16
+        if self._config.has_option('sharq', 'dequeue_sample_size'):
+            self._dequeue_sample_size = self._config.getint(
+                'sharq', 'dequeue_sample_size')
+        self._requeue_batch_size = 1000
+        if self._config.has_option('sharq', 'requeue_batch_size'):
+            self._requeue_batch_size = self._config.getint(
+                'sharq', 'requeue_batch_size')
+        if self._requeue_batch_size < 1:
+            raise SharqException(
+                '`requeue_batch_size` should be greater than 0.')
+        self._requeue_concurrency = 4
+        if self._config.has_option('sharq', 'requeue_concurrency'):
+            self._requeue_concurrency = self._config.getint(
+                'sharq', 'requeue_concurrency')
+        if self._requeue_concurrency < 1:
+            raise SharqException(
+                '`requeue_concurrency` should be greater than 0.')
+        self._metrics_bucket_size = 60000
+        if self._config.has_option('sharq', 'metrics_bucket_size'):
+            self._metrics_bucket_size = self._config.getint(
+                'sharq', 'metrics_bucket_size')
+        if self._metrics_bucket_size < 1:
+            raise SharqException(
+                '`metrics_bucket_size` should be greater than 0.')
+        self._metrics_retention = 600000
+        if self._config.has_option('sharq', 'metrics_retention'):
+            self._metrics_retention = self._config.getint(
+                'sharq', 'metrics_retention')
+        if not (1 <= self._metrics_retention // self._metrics_bucket_size
+                <= MAX_METRICS_BUCKET_COUNT):
+            raise SharqException(
+                '`metrics_retention` should hold between 1 and %d buckets.'
+                % MAX_METRICS_BUCKET_COUNT)
 
         # initalize redis
+        self._r = self._create_redis_client()
+        self._load_lua_scripts()
+
+    def _create_redis_client(self):
+        """Opens a redis connection pool as per the
+        redis section of the config.
+        """
         redis_connection_type = self._config.get('redis', 'conn_type')
         db = self._config.get('redis', 'db')
         if redis_connection_type == 'unix_sock':
-            self._r = redis.StrictRedis(
+            return redis.StrictRedis(
                 db=db,
                 unix_socket_path=self._config.get('redis', 'unix_socket_path')
             )
@@ -59,17 +175,20 @@ class SharQ(object):
                 isclustered = self._config.getboolean('redis', 'clustered')
 
             if isclustered:
+                if StrictRedisCluster is None:
+                    raise SharqException(
+                        'redis-py-cluster is required in the cluster mode.')
                 startup_nodes = [{"host": self._config.get('redis', 'host'), "port": self._config.get('redis', 'port')}]
-                self._r = StrictRedisCluster(startup_nodes=startup_nodes, decode_responses=False,
-                                             skip_full_coverage_check=True, socket_timeout=5)
+                return StrictRedisCluster(startup_nodes=startup_nodes, decode_responses=False,
+                                          skip_full_coverage_check=True,
+                                          socket_timeout=CLUSTER_SOCKET_TIMEOUT)
             else:
-                self._r = redis.StrictRedis(
+                return redis.StrictRedis(
                     db=db,
                     host=self._config.get('redis', 'host'),
                     port=self._config.get('redis', 'port'),
                     password=self._config.get('redis', 'password')
                 )
-        self._load_lua_scripts()
 
     def _load_config(self):
         """Read the configuration file and load it into memory."""
@@ -114,6 +233,25 @@ class SharQ(object):
             self._lua_finish_script = finish_file.read()
             self._lua_finish = self._r.register_script(self._lua_finish_script)
 
+        with open(os.path.join(
+                lua_script_path,
+                'finish_dequeue.lua'), 'r') as finish_dequeue_file:
+            # the finish and dequeue scripts are wrapped into functions
+            # which are called from the finish_dequeue script.
+            self._lua_finish_dequeue_script = (
+                'local finish = function(KEYS, ARGV)\n%s\nend\n'
+                'local dequeue = function(KEYS, ARGV)\n%s\nend\n'
+                '%s' % (self._lua_finish_script, self._lua_dequeue_script,
+                        finish_dequeue_file.read()))
+            self._lua_finish_dequeue = self._r.register_script(
+                self._lua_finish_dequeue_script)
+
+        with open(os.path.join(
+                lua_script_path,
+                'touch.lua'), 'r') as touch_file:
+            self._lua_touch_script = touch_file.read()
+            self._lua_touch = self._r.register_script(self._lua_touch_script)
+
         with open(os.path.join(
                 lua_script_path,
                 'interval.lua'), 'r') as interval_file:
@@ -135,14 +273,194 @@ class SharQ(object):
             self._lua_metrics = self._r.register_script(
                 self._lua_metrics_script)
 
+        with open(os.path.join(
+                lua_script_path,
+                'lease.lua'), 'r') as lease_file:
+            self._lua_lease_script = lease_file.read()
+            self._lua_lease = self._r.register_script(self._lua_lease_script)
+
+        with open(os.path.join(
+                lua_script_path,
+                'clear_queue.lua'), 'r') as clear_queue_file:
+            self._lua_clear_queue_script = clear_queue_file.read()
+            self._lua_clear_queue = self._r.register_script(
+                self._lua_clear_queue_script)
+
+        if self._recorder is not None:
+            # time the new scripts too.
+            instrument(self, self._recorder)
+
     def reload_lua_scripts(self):
         """Lets user reload the lua scripts in run time."""
         self._load_lua_scripts()
 
-    def enqueue(self, payload, interval, job_id,
-                queue_id, queue_type='default', requeue_limit=None):
-        """Enqueues the job into the specified queue_id
-        of a particular queue_type
+    def set_recorder(self, recorder):
+        """Times every public function and the phases it goes through
+        (validation, serialization, every Lua script call, ...) with the
+        recorder, a `sharq.instrumentation.Recorder`. None stops the
+        timing, which adds no overhead to any call when it is off.
+        """
+        instrument(self, recorder)
+
+    def _get_queue_type_option(self, queue_type, option):
+        """Returns the value of a config option for the queue_type.
+        The options in the `sharq:<queue_type>` section override the
+        ones in the `sharq` section. Returns None if the option is
+        not set in either of them.
+        """
+        for section in ('sharq:%s' % queue_type, 'sharq'):
+            if self._config.has_option(section, option):
+                return self._config.get(section, option)
+        return None
+
+    def _get_queue_type_boolean(self, queue_type, option):
+        """Returns the boolean value of a config option for the
+        queue_type, which defaults to False.
+        """
+        value = self._get_queue_type_option(queue_type, option)
+        if value is None:
+            return False
+
+        if value.lower() not in self._config.BOOLEAN_STATES:
+            raise SharqException('`%s` should be a boolean.' % option)
+        return self._config.BOOLEAN_STATES[value.lower()]
+
+    def _is_dead_letter_enabled(self, queue_type):
+        """Checks if the discarded jobs of the queue_type are kept
+        in its dead letter store.
+        """
+        return self._get_queue_type_boolean(queue_type, 'dead_letter')
+
+    def _get_latency_metrics_mode(self, queue_type):
+        """Returns the index of the latency_metrics mode of the
+        queue_type in LATENCY_METRICS_MODES, 0 being off.
+        """
+        latency_metrics = (self._get_queue_type_option(
+            queue_type, 'latency_metrics') or 'off').lower()
+        if latency_metrics not in LATENCY_METRICS_MODES:
+            raise SharqException(
+                '`latency_metrics` should be one of %s.' %
+                ', '.join(LATENCY_METRICS_MODES))
+        return LATENCY_METRICS_MODES.index(latency_metrics)
+
+    def _build_counter_args(self, queue_type):
+        """Returns the arguments which select the metrics updated by
+        the enqueue and dequeue Lua scripts for the queue_type, as
+        [queue_metrics_rate, queue_type_metrics, latency_metrics]. The
+        rate is the probability of a queue being counted, 1 when the
+        queue_metrics are on and 0 when they are off.
+        """
+        queue_metrics = (self._get_queue_type_option(
+            queue_type, 'queue_metrics') or 'on').lower()
+        if queue_metrics not in QUEUE_METRICS_MODES:
+            raise SharqException(
+                '`queue_metrics` should be one of %s.' %
+                ', '.join(QUEUE_METRICS_MODES))
+
+        if queue_metrics == 'on':
+            queue_metrics_rate = 1
+        elif queue_metrics == 'off':
+            queue_metrics_rate = 0
+        else:
+            try:
+                queue_metrics_rate = float(self._get_queue_type_option(
+                    queue_type, 'queue_metrics_sample_rate') or 0.01)
+            except ValueError:
+                queue_metrics_rate = 0
+            if not 0 < queue_metrics_rate <= 1:
+                raise SharqException(
+                    '`queue_metrics_sample_rate` should be between 0 and 1.')
+
+        return [
+            queue_metrics_rate,
+            int(self._get_queue_type_boolean(queue_type, 'queue_type_metrics')),
+            self._get_latency_metrics_mode(queue_type)
+        ]
+
+    def _build_finish_args(self, queue_type, timestamp):
+        """Returns the arguments of the finish Lua script which
+        precede the jobs to finish.
+        """
+        return self._build_metrics_args(timestamp) + [
+            self._get_latency_metrics_mode(queue_type)
+        ]
+
+    def _get_retry_policy(self, queue_type):
+        """Returns the retry backoff of the queue_type as a list of
+        [retry_base_delay, retry_multiplier, retry_max_delay,
+        retry_jitter]. A retry_base_delay of 0 (the default) disables
+        the backoff. The backoff delays the whole queue of the job while
+        no other job waits in it, so retry_max_delay defaults to a minute.
+        """
+        try:
+            retry_base_delay = int(self._get_queue_type_option(
+                queue_type, 'retry_base_delay') or 0)
+            retry_multiplier = float(self._get_queue_type_option(
+                queue_type, 'retry_multiplier') or 2)
+            retry_max_delay = int(self._get_queue_type_option(
+                queue_type, 'retry_max_delay') or 60000)
+            retry_jitter = float(self._get_queue_type_option(
+                queue_type, 'retry_jitter') or 0)
+        except ValueError:
+            raise SharqException(
+                'the retry options of `%s` should be numbers.' % queue_type)
+
+        if retry_base_delay < 0:
+            raise SharqException('`retry_base_delay` should not be negative.')
+
+        if retry_multiplier < 1:
+            raise SharqException('`retry_multiplier` should be at least 1.')
+
+        if retry_max_delay < retry_base_delay:
+            raise SharqException(
+                '`retry_max_delay` should be at least `retry_base_delay`.')
+
+        if not 0 <= retry_jitter <= 1:
+            raise SharqException('`retry_jitter` should be between 0 and 1.')
+
+        return [
+            retry_base_delay,
+            retry_multiplier,
+            retry_max_delay,
+            retry_jitter
+        ]
+
+    def _build_requeue_args(self, queue_type, timestamp, delay, batch_size,
+                            jobs=()):
+        """Returns the arguments of the requeue Lua script. `jobs`
+        is a list of queue_id:job_id strings to requeue, all the
+        expired jobs are requeued when it is empty.
+        """
+        return [
+            timestamp,
+            delay,
+            batch_size,
+            int(self._is_dead_letter_enabled(queue_type))
+        ] + self._get_retry_policy(queue_type) + [
+            random.randint(0, 2 ** 31)
+        ] + list(jobs)
+
+    def _build_metrics_args(self, timestamp, queue_type=None):
+        """Returns the timestamp along with the size and the retention
+        of the metrics buckets, which lead the arguments of the enqueue
+        and metrics Lua scripts. For the enqueue of a queue_type, the
+        counters to update and a seed to sample the queues with follow.
+        """
+        args = [
+            timestamp,
+            self._metrics_bucket_size,
+            self._metrics_retention
+        ]
+        if queue_type is not None:
+            args += self._build_counter_args(queue_type) + [
+                random.randint(0, 2 ** 31)
+            ]
+        return args
+
+    def _build_enqueue_args(self, payload, interval, job_id, queue_id,
+                            queue_type, requeue_limit):
+        """Validates the input of a job and returns the arguments
+        which describe this job to the enqueue Lua script.
         """
         # validate all the input
         if not is_valid_interval(interval):
@@ -163,10 +481,30 @@ class SharQ(object):
         if not is_valid_requeue_limit(requeue_limit):
             raise BadArgumentException('`requeue_limit` has an invalid value.')
 
+        serialized_payload = self._serialize_payload(payload)
+
+        return [
+            queue_id,
+            job_id,
+            serialized_payload,
+            interval,
+            requeue_limit
+        ]
+
+    def _serialize_payload(self, payload):
+        """Serializes the payload of a job."""
         try:
-            serialized_payload = serialize_payload(payload)
+            return serialize_payload(payload)
         except TypeError as e:
-            raise BadArgumentException(e.message)
+            raise BadArgumentException(str(e))
+
+    def enqueue(self, payload, interval, job_id,
+                queue_id, queue_type='default', requeue_limit=None):
+        """Enqueues the job into the specified queue_id
+        of a particular queue_type
+        """
+        job_args = self._build_enqueue_args(
+            payload, interval, job_id, queue_id, queue_type, requeue_limit)
 
         timestamp = str(generate_epoch())
 
@@ -175,14 +513,7 @@ class SharQ(object):
             queue_type
         ]
 
-        args = [
-            timestamp,
-            queue_id,
-            job_id,
-            serialized_payload,
-            interval,
-            requeue_limit
-        ]
+        args = self._build_metrics_args(timestamp, queue_type) + job_args
         self._lua_enqueue(keys=keys, args=args)
 
         response = {
@@ -190,58 +521,324 @@ class SharQ(object):
         }
         return response
 
-    def dequeue(self, queue_type='default'):
+    def enqueue_many(self, jobs, batch_size=500):
+        """Enqueues a batch of jobs. Each job is a dict which takes
+        the same arguments as `enqueue`. All the jobs are validated
+        before any of them is enqueued, and the jobs of a queue_type
+        are sent to Redis in chunks of `batch_size` jobs, one Lua
+        script call per chunk. Returns the status of every job in
+        the order they were given.
+        """
+        script_calls, responses = self._build_enqueue_many_args(
+            jobs, batch_size)
+        for keys, args in script_calls:
+            self._lua_enqueue(keys=keys, args=args)
+
+        return responses
+
+    def _build_enqueue_many_args(self, jobs, batch_size):
+        """Validates and serializes a batch of jobs. Returns the
+        (keys, args) of every enqueue Lua script call needed for
+        the batch, along with the responses of the jobs.
+        """
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        # validate and serialize every job before touching redis.
+        queue_type_args = {}
+        responses = []
+        for job in jobs:
+            try:
+                payload = job['payload']
+                interval = job['interval']
+                job_id = job['job_id']
+                queue_id = job['queue_id']
+            except KeyError as e:
+                raise BadArgumentException(
+                    '`%s` is missing in a job.' % e.args[0])
+            queue_type = job.get('queue_type', 'default')
+            job_args = self._build_enqueue_args(
+                payload, interval, job_id, queue_id, queue_type,
+                job.get('requeue_limit'))
+            queue_type_args.setdefault(queue_type, []).append(job_args)
+            responses.append({
+                'status': 'queued',
+                'job_id': job_id
+            })
+
+        timestamp = str(generate_epoch())
+        script_calls = []
+        for queue_type, job_args_list in queue_type_args.items():
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+            for i in range(0, len(job_args_list), batch_size):
+                args = self._build_metrics_args(timestamp, queue_type)
+                for job_args in job_args_list[i:i + batch_size]:
+                    args.extend(job_args)
+                script_calls.append((keys, args))
+
+        return script_calls, responses
+
+    def dequeue(self, queue_type='default', timeout=None, strategy=None):
         """Dequeues a job from any of the ready queues
-        based on the queue_type. If no job is ready,
-        returns a failure status.
+        based on the queue_type. If no job is ready, waits
+        for up to `timeout` milliseconds for one to become
+        ready and returns a failure status after that.
+        """
+        jobs = self.dequeue_many(
+            queue_type=queue_type, count=1, timeout=timeout,
+            strategy=strategy)
+        if not jobs:
+            response = {
+                'status': 'failure'
+            }
+            return response
+
+        return jobs[0]
+
+    def dequeue_many(self, queue_type='default', count=1, timeout=None,
+                     strategy=None):
+        """Dequeues up to `count` jobs of the queue_type in a
+        single call. At most one job is dequeued from each ready
+        queue, so the interval of every queue is honoured. Returns
+        a list of jobs, which is empty when no job gets ready within
+        `timeout` milliseconds (by default, the call does not wait).
+
+        The ready queues are picked by the `strategy`, which is one
+        of `DEQUEUE_STRATEGIES` and defaults to the `dequeue_strategy`
+        in the config.
+        """
+        strategy = self._validate_dequeue_args(
+            queue_type, count, timeout, strategy)
+
+        deadline = generate_epoch() + (timeout or 0)
+        # a dequeue after a wait passes the wake up on to the
+        # other waiting consumers, while ready queues remain.
+        notify = False
+        while True:
+            jobs = self._dequeue_many(queue_type, count, strategy, notify)
+            if jobs:
+                return jobs
+
+            wait_time = deadline - generate_epoch()
+            if wait_time <= 0:
+                return jobs
+
+            self._wait_for_ready_queue(queue_type, wait_time)
+            notify = True
+
+    def _validate_dequeue_args(self, queue_type, count, timeout, strategy):
+        """Validates the arguments of a dequeue and returns
+        the strategy to be used.
         """
         if not is_valid_identifier(queue_type):
             raise BadArgumentException('`queue_type` has an invalid value.')
 
+        if not isinstance(count, int) or count < 1:
+            raise BadArgumentException('`count` has an invalid value.')
+
+        if timeout is not None and not is_valid_interval(timeout):
+            raise BadArgumentException('`timeout` has an invalid value.')
+
+        if strategy is None:
+            strategy = self._dequeue_strategy
+
+        if strategy not in DEQUEUE_STRATEGIES:
+            raise BadArgumentException('`strategy` has an invalid value.')
+
+        return strategy
+
+    def _wait_for_ready_queue(self, queue_type, wait_time):
+        """Sleeps until the earliest queue of the queue_type gets
+        ready, or until an enqueue / requeue adds a new ready queue
+        to this queue_type, whichever happens first. Never sleeps
+        longer than `wait_time` milliseconds.
+        """
+        next_ready_queue = self._r.zrange(
+            '%s:%s' % (self._key_prefix, queue_type), 0, 0, withscores=True)
+        wait_time = self._get_ready_wait_time(next_ready_queue, wait_time)
+
+        if wait_time >= 1000:
+            # block on the notify list. blocking timeouts are in whole
+            # seconds and are capped so that the socket does not time out.
+            self._r.blpop(
+                '%s:%s:notify' % (self._key_prefix, queue_type),
+                timeout=min(wait_time // 1000, MAX_BLOCKING_TIMEOUT))
+        else:
+            time.sleep(max(wait_time, 1) / 1000.0)
+
+    def _get_ready_wait_time(self, next_ready_queue, wait_time):
+        """Returns the milliseconds to wait, given the earliest ready
+        queue (a ZRANGE WITHSCORES response) and the wait deadline.
+        """
+        if next_ready_queue:
+            _, next_ready_time = next_ready_queue[0]
+            wait_time = min(wait_time, int(next_ready_time) - generate_epoch())
+
+        return wait_time
+
+    def _build_dequeue_args(self, queue_type, count, strategy,
+                            notify=False):
+        """Returns the arguments of the dequeue Lua script. With
+        `notify`, the script wakes up another blocked consumer when
+        ready queues are left.
+        """
         timestamp = str(generate_epoch())
 
+        return [
+            timestamp,
+            self._job_expire_interval,
+            count,
+            strategy,
+            self._dequeue_sample_size,
+            random.randint(0, 2 ** 31),
+            self._metrics_bucket_size,
+            self._metrics_retention
+        ] + self._build_counter_args(queue_type) + [
+            # a seed of its own for the sampling of the queue counters.
+            random.randint(0, 2 ** 31),
+            1 if notify else 0
+        ]
+
+    def _parse_dequeue_response(self, dequeue_response):
+        """Converts the response of the dequeue Lua script
+        into a list of jobs.
+        """
+        jobs = []
+        for job in dequeue_response:
+            if len(job) < 4:
+                continue
+
+            queue_id, job_id, payload, requeues_remaining = job
+
+            if payload is None:
+                continue
+
+            payload = deserialize_payload(payload)
+
+            jobs.append({
+                'status': 'success',
+                'queue_id': queue_id.decode('utf-8'),
+                'job_id': job_id.decode('utf-8'),
+                'payload': payload,
+                'requeues_remaining': int(requeues_remaining)
+            })
+
+        return jobs
+
+    def _dequeue_many(self, queue_type, count, strategy, notify=False):
+        """Runs the dequeue Lua script once and returns the
+        dequeued jobs.
+        """
         keys = [
             self._key_prefix,
             queue_type
         ]
-        args = [
-            timestamp,
-            self._job_expire_interval
-        ]
+        args = self._build_dequeue_args(
+            queue_type, count, strategy, notify)
 
         dequeue_response = self._lua_dequeue(keys=keys, args=args)
+        return self._parse_dequeue_response(dequeue_response)
 
-        if len(dequeue_response) < 4:
-            response = {
-                'status': 'failure'
-            }
-            return response
+    def _group_jobs_by_queue_type(self, jobs):
+        """Validates a list of (queue_type, queue_id, job_id) tuples
+        and groups them by queue_type. Every job in a group is an
+        (index, queue_id, job_id) tuple, where index is the position
+        of the job in the list.
+        """
+        queue_type_jobs = {}
+        for index, (queue_type, queue_id, job_id) in enumerate(jobs):
+            if not is_valid_identifier(job_id):
+                raise BadArgumentException('`job_id` has an invalid value.')
 
-        queue_id, job_id, payload, requeues_remaining = dequeue_response
+            if not is_valid_identifier(queue_id):
+                raise BadArgumentException('`queue_id` has an invalid value.')
 
-        if payload is None:
-            response = {
-                'status': 'failure'
-            }
-            return response
+            if not is_valid_identifier(queue_type):
+                raise BadArgumentException(
+                    '`queue_type` has an invalid value.')
 
-        payload = deserialize_payload(payload)
+            queue_type_jobs.setdefault(queue_type, []).append(
+                (index, queue_id, job_id))
 
-        response = {
-            'status': 'success',
-            'queue_id': queue_id.decode('utf-8'),
-            'job_id': job_id.decode('utf-8'),
-            'payload': payload,
-            'requeues_remaining': int(requeues_remaining)
-        }
-
-        return response
+        return queue_type_jobs
 
     def finish(self, job_id, queue_id, queue_type='default'):
         """Marks any dequeued job as *completed successfully*.
         Any job which gets a finish will be treated as complete
         and will be removed from the SharQ.
         """
+        return self.finish_many([(queue_type, queue_id, job_id)])[0]
+
+    def finish_many(self, jobs, batch_size=500):
+        """Marks a batch of dequeued jobs as *completed successfully*.
+        Each job is a (queue_type, queue_id, job_id) tuple. The jobs
+        of a queue_type are finished in chunks of `batch_size` jobs,
+        one Lua script call per chunk. Returns the status of every
+        job in the order they were given.
+        """
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        jobs = list(jobs)
+        queue_type_jobs = self._group_jobs_by_queue_type(jobs)
+
+        responses = [None] * len(jobs)
+        timestamp = str(generate_epoch())
+        for queue_type, job_list in queue_type_jobs.items():
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+            for i in range(0, len(job_list), batch_size):
+                chunk = job_list[i:i + batch_size]
+                args = self._build_finish_args(queue_type, timestamp)
+                for _, queue_id, job_id in chunk:
+                    args.extend([queue_id, job_id])
+
+                finish_response = self._lua_finish(keys=keys, args=args)
+                self._update_job_responses(responses, chunk, finish_response)
+
+        return responses
+
+    def _update_job_responses(self, responses, job_list, script_response):
+        """Sets the response of every (index, queue_id, job_id) job in
+        `job_list` from the 1 / 0 status returned by a Lua script.
+        """
+        for (index, _, _), status in zip(job_list, script_response):
+            response = {
+                'status': 'success'
+            }
+            if status == 0:
+                # the job is not active anymore.
+                response.update({
+                    'status': 'failure'
+                })
+            responses[index] = response
+
+    def finish_and_dequeue(self, job_id, queue_id, queue_type='default',
+                           strategy=None):
+        """Marks a dequeued job as *completed successfully* and
+        dequeues the next ready job of the same queue_type, both
+        in a single Lua script call. The `status` of the response
+        is the status of the finish, and `next_job` is the response
+        of the dequeue.
+        """
+        keys, args = self._build_finish_and_dequeue_args(
+            job_id, queue_id, queue_type, strategy)
+
+        finish_response, dequeue_response = self._lua_finish_dequeue(
+            keys=keys, args=args)
+        return self._parse_finish_and_dequeue_response(
+            finish_response, dequeue_response)
+
+    def _build_finish_and_dequeue_args(self, job_id, queue_id, queue_type,
+                                       strategy):
+        """Validates the arguments of a finish and dequeue and returns
+        the keys and args of the Lua script.
+        """
         if not is_valid_identifier(job_id):
             raise BadArgumentException('`job_id` has an invalid value.')
 
@@ -251,32 +848,171 @@ class SharQ(object):
         if not is_valid_identifier(queue_type):
             raise BadArgumentException('`queue_type` has an invalid value.')
 
+        if strategy is None:
+            strategy = self._dequeue_strategy
+
+        if strategy not in DEQUEUE_STRATEGIES:
+            raise BadArgumentException('`strategy` has an invalid value.')
+
         keys = [
             self._key_prefix,
             queue_type
         ]
 
-        args = [
+        args = self._build_finish_args(
+            queue_type, str(generate_epoch())) + [
             queue_id,
             job_id
-        ]
+        ] + self._build_dequeue_args(queue_type, 1, strategy)
+
+        return keys, args
 
+    def _parse_finish_and_dequeue_response(self, finish_response,
+                                           dequeue_response):
+        """Converts the response of the finish and dequeue Lua script
+        into the response of a finish and dequeue.
+        """
         response = {
             'status': 'success'
         }
-
-        finish_response = self._lua_finish(keys=keys, args=args)
-        if finish_response == 0:
+        if finish_response[0] == 0:
             # the finish failed.
             response.update({
                 'status': 'failure'
             })
+
+        jobs = self._parse_dequeue_response(dequeue_response)
+        if jobs:
+            response['next_job'] = jobs[0]
+        else:
+            response['next_job'] = {
+                'status': 'failure'
+            }
+        return response
+
+    def touch(self, job_id, queue_id, queue_type='default', extend_ms=None):
+        """Extends the lease of a dequeued job, so that it does not
+        get requeued for another `extend_ms` milliseconds (defaults
+        to the job_expire_interval). Long running jobs are expected
+        to call this periodically as a heartbeat.
+        """
+        return self.touch_many(
+            [(queue_type, queue_id, job_id)], extend_ms=extend_ms)[0]
+
+    def touch_many(self, jobs, extend_ms=None):
+        """Extends the lease of a batch of dequeued jobs. Each job is
+        a (queue_type, queue_id, job_id) tuple. The jobs of a
+        queue_type are touched in one Lua script call. Returns the
+        status of every job in the order they were given.
+        """
+        if extend_ms is None:
+            extend_ms = self._job_expire_interval
+
+        if not is_valid_interval(extend_ms):
+            raise BadArgumentException('`extend_ms` has an invalid value.')
+
+        jobs = list(jobs)
+        queue_type_jobs = self._group_jobs_by_queue_type(jobs)
+
+        timestamp = str(generate_epoch())
+        responses = [None] * len(jobs)
+        for queue_type, job_list in queue_type_jobs.items():
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+            args = [
+                timestamp,
+                extend_ms
+            ]
+            for _, queue_id, job_id in job_list:
+                args.extend([queue_id, job_id])
+
+            touch_response = self._lua_touch(keys=keys, args=args)
+            self._update_job_responses(responses, job_list, touch_response)
+
+        return responses
+
+    def release(self, job_id, queue_id, queue_type='default', delay_ms=0):
+        """Releases a dequeued job without waiting for it to expire.
+        The job is put back at the front of its queue, and does not
+        get ready again before `delay_ms` milliseconds. Just like an
+        expired job, the release counts as a requeue of the job, and
+        the job is discarded when it has no requeues remaining.
+        """
+        keys, args = self._build_release_args(
+            job_id, queue_id, queue_type, delay_ms)
+
+        requeued_job_count, discarded_job_count, _ = self._lua_requeue(
+            keys=keys, args=args)
+
+        return self._parse_release_response(
+            requeued_job_count, discarded_job_count)
+
+    def _build_release_args(self, job_id, queue_id, queue_type, delay_ms):
+        """Validates the arguments of a release and returns the
+        keys and args of the requeue Lua script.
+        """
+        if not is_valid_identifier(job_id):
+            raise BadArgumentException('`job_id` has an invalid value.')
+
+        if not is_valid_identifier(queue_id):
+            raise BadArgumentException('`queue_id` has an invalid value.')
+
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if not is_valid_interval(delay_ms):
+            raise BadArgumentException('`delay_ms` has an invalid value.')
+
+        timestamp = str(generate_epoch())
+
+        keys = [
+            self._key_prefix,
+            queue_type
+        ]
+
+        args = self._build_requeue_args(
+            queue_type, timestamp, delay_ms,
+            0,  # batch_size, unused when the jobs are given.
+            ['%s:%s' % (queue_id, job_id)])
+
+        return keys, args
+
+    def _parse_release_response(self, requeued_job_count,
+                                discarded_job_count):
+        """Converts the response of the requeue Lua script into
+        the response of a release.
+        """
+        response = {
+            'status': 'success',
+            'discarded': False
+        }
+        if discarded_job_count:
+            # the job had no requeues remaining.
+            response.update({
+                'discarded': True
+            })
+        elif requeued_job_count == 0:
+            # the job is not active. Non existent job or the
+            # job is expired and was requeued back.
+            response = {
+                'status': 'failure'
+            }
         return response
 
     def interval(self, interval, queue_id, queue_type='default'):
         """Updates the interval for a specific queue_id
         of a particular queue type.
         """
+        keys, args = self._build_interval_args(interval, queue_id, queue_type)
+        interval_response = self._lua_interval(keys=keys, args=args)
+        return self._parse_interval_response(interval_response)
+
+    def _build_interval_args(self, interval, queue_id, queue_type):
+        """Validates the arguments of an interval update and returns
+        the keys and args of the interval Lua script.
+        """
         # validate all the input
         if not is_valid_interval(interval):
             raise BadArgumentException('`interval` has an invalid value.')
@@ -298,7 +1034,12 @@ class SharQ(object):
         args = [
             interval
         ]
-        interval_response = self._lua_interval(keys=keys, args=args)
+        return keys, args
+
+    def _parse_interval_response(self, interval_response):
+        """Converts the response of the interval Lua script into
+        the response of an interval update.
+        """
         if interval_response == 0:
             # the queue with the id and type does not exist.
             response = {
@@ -311,48 +1052,252 @@ class SharQ(object):
 
         return response
 
-    def requeue(self):
+    def _is_clustered(self):
+        """Returns True when the redis client talks to a cluster."""
+        return (StrictRedisCluster is not None and
+                isinstance(self._r, StrictRedisCluster))
+
+    def _get_requeue_lanes(self, queue_type_list, concurrency):
+        """Splits the queue_types into up to `concurrency` lanes, which
+        are requeued in parallel, one queue_type after the other within
+        a lane. So a slow queue_type holds up a share of the others only.
+
+        The lanes are not grouped by redis node: a cluster routes a
+        requeue Lua script call by its keys [key_prefix, queue_type],
+        which have to hash to the same slot, so the calls of every
+        queue_type go to the node of the slot of the key_prefix.
+        """
+        queue_types = sorted(queue_type_list)
+        lane_count = min(concurrency, len(queue_types))
+        return [queue_types[i::lane_count] for i in range(lane_count)]
+
+    def _requeue_lane(self, queue_types, timestamp, batch_size):
+        """Requeues the expired jobs of the queue_types, one after
+        the other. Returns the number of requeued and discarded jobs.
+        """
+        requeued_count = discarded_count = 0
+        for queue_type in queue_types:
+            keys = [
+                self._key_prefix,
+                queue_type
+            ]
+
+            args = self._build_requeue_args(
+                queue_type, timestamp, 0, batch_size)
+            remaining_job_count = 1
+            while remaining_job_count > 0:
+                requeued_job_count, discarded_job_count, remaining_job_count = \
+                    self._lua_requeue(keys=keys, args=args)
+                requeued_count += requeued_job_count
+                discarded_count += discarded_job_count
+
+        return requeued_count, discarded_count
+
+    def _validate_requeue_args(self, batch_size, concurrency):
+        """Validates the arguments of requeue and returns them with
+        the defaults of the config filled in.
+        """
+        if batch_size is None:
+            batch_size = self._requeue_batch_size
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        if concurrency is None:
+            concurrency = self._requeue_concurrency
+
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise BadArgumentException('`concurrency` has an invalid value.')
+
+        return batch_size, concurrency
+
+    def requeue(self, batch_size=None, concurrency=None):
         """Re-queues any expired job (one which does not get an expire
         before the job_expiry_interval) back into their respective queue.
         This function has to be run at specified intervals to ensure the
         expired jobs are re-queued back.
+
+        The expired jobs of a queue_type are requeued in chunks of
+        `batch_size` jobs (defaults to the requeue_batch_size in the
+        config), one Lua script call per chunk, until none remain. So a
+        large backlog of expired jobs never blocks redis for long.
+
+        The queue_types are requeued in parallel, by up to `concurrency`
+        threads (defaults to the requeue_concurrency in the config). In
+        the cluster mode, the keys of a Lua script call, the key_prefix
+        and the queue_type, have to hash to the same slot, so all the
+        requeue calls go to a single node.
+
+        The jobs which have no requeues remaining are discarded by the
+        same Lua script call. Returns the number of requeued and
+        discarded jobs.
         """
+        batch_size, concurrency = self._validate_requeue_args(
+            batch_size, concurrency)
+
         timestamp = str(generate_epoch())
-        # get all queue_types and requeue one by one.
+        # get all queue_types and requeue them in lanes.
         # not recommended to do this entire process
         # in lua as it might take long and block other
         # enqueues and dequeues.
-        active_queue_type_list = self._r.smembers(
-            '%s:active:queue_type' % self._key_prefix)
-        for queue_type in active_queue_type_list:
-            # requeue all expired jobs in all queue types.
+        active_queue_type_list = [
+            queue_type.decode('utf-8') for queue_type in self._r.smembers(
+                '%s:active:queue_type' % self._key_prefix)]
+        lanes = self._get_requeue_lanes(active_queue_type_list, concurrency)
+
+        if len(lanes) > 1:
+            # every lane runs in a copy of the context of this call,
+            # which carries the operation being timed, if any.
+            with ThreadPoolExecutor(max_workers=len(lanes)) as executor:
+                lane_responses = list(executor.map(
+                    lambda lane, context: context.run(
+                        self._requeue_lane, lane, timestamp, batch_size),
+                    lanes, [contextvars.copy_context() for _ in lanes]))
+        else:
+            lane_responses = [
+                self._requeue_lane(lane, timestamp, batch_size)
+                for lane in lanes]
 
-            queue_type = queue_type.decode('utf-8')
+        return {
+            'status': 'success',
+            'requeued': sum(requeued for requeued, _ in lane_responses),
+            'discarded': sum(discarded for _, discarded in lane_responses)
+        }
 
-            keys = [
-                self._key_prefix,
-                queue_type
-            ]
+    def get_dead_letters(self, queue_type='default', offset=0, limit=100):
+        """Returns a page of the jobs in the dead letter store of the
+        queue_type, oldest first, along with the total number of jobs
+        in the store. A job is moved to the dead letter store when it
+        is discarded, if `dead_letter` is enabled in the config.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
 
-            args = [
-                timestamp
-            ]
-            job_discard_list = self._lua_requeue(keys=keys, args=args)
-            # discard the jobs if any
-            for job in job_discard_list:
-                queue_id, job_id = job.decode('utf-8').split(':')
-                # explicitly finishing a job
-                # is nothing but discard.
-                self.finish(
-                    job_id=job_id,
-                    queue_id=queue_id,
-                    queue_type=queue_type
-                )
+        if not isinstance(offset, int) or offset < 0:
+            raise BadArgumentException('`offset` has an invalid value.')
+
+        if not isinstance(limit, int) or limit < 1:
+            raise BadArgumentException('`limit` has an invalid value.')
+
+        dead_letter_key = '%s:%s:dead' % (self._key_prefix, queue_type)
+        pipe = self._r.pipeline()
+        pipe.zcard(dead_letter_key)
+        pipe.zrange(
+            dead_letter_key, offset, offset + limit - 1, withscores=True)
+        total, dead_jobs = pipe.execute()
+
+        job_details = []
+        if dead_jobs:
+            job_details = self._r.hmget(
+                '%s:job' % dead_letter_key, [job for job, _ in dead_jobs])
+
+        response = {
+            'status': 'success',
+            'total': int(total),
+            'dead_letters': self._parse_dead_letters(
+                queue_type, dead_jobs, job_details)
+        }
+        return response
+
+    def _parse_dead_letters(self, queue_type, dead_jobs, job_details):
+        """Converts the dead letter sorted set entries and their
+        details into a list of jobs.
+        """
+        dead_letters = []
+        for (job, discarded_at), details in zip(dead_jobs, job_details):
+            if details is None:
+                # replayed in the meantime.
+                continue
+
+            queue_id, job_id = job.decode('utf-8').split(':')
+            payload, interval = msgpack.unpackb(details, raw=True)
+            dead_letters.append({
+                'queue_type': queue_type,
+                'queue_id': queue_id,
+                'job_id': job_id,
+                'payload': deserialize_payload(payload),
+                'interval': int(interval),
+                'discarded_at': int(discarded_at)
+            })
+
+        return dead_letters
+
+    def replay_dead_letters(self, queue_type='default', limit=None,
+                            batch_size=500, requeue_limit=None):
+        """Re-enqueues up to `limit` jobs (all by default) from the
+        dead letter store of the queue_type, oldest first, in batches
+        of `batch_size` jobs. The jobs keep their queue_id, job_id,
+        payload and interval, and get `requeue_limit` requeues (the
+        default_job_requeue_limit by default).
+
+        Returns a generator, which replays the next batch when the
+        jobs of the previous one are consumed, and yields the enqueue
+        response of every job. A job is removed from the dead letter
+        store after it is enqueued, so a replay which gets interrupted
+        may enqueue the jobs of a batch again, but never loses one.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise BadArgumentException('`limit` has an invalid value.')
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        if requeue_limit is not None and not is_valid_requeue_limit(
+                requeue_limit):
+            raise BadArgumentException(
+                '`requeue_limit` has an invalid value.')
+
+        return self._replay_dead_letters(
+            queue_type, limit, batch_size, requeue_limit)
+
+    def _replay_dead_letters(self, queue_type, limit, batch_size,
+                             requeue_limit):
+        dead_letter_key = '%s:%s:dead' % (self._key_prefix, queue_type)
+        replayed_job_count = 0
+        while limit is None or replayed_job_count < limit:
+            count = batch_size
+            if limit is not None:
+                count = min(batch_size, limit - replayed_job_count)
+
+            dead_jobs = self._r.zrange(
+                dead_letter_key, 0, count - 1, withscores=True)
+            if not dead_jobs:
+                return
+
+            job_list = [job for job, _ in dead_jobs]
+            job_details = self._r.hmget('%s:job' % dead_letter_key, job_list)
+            jobs = self._build_replay_jobs(
+                self._parse_dead_letters(queue_type, dead_jobs, job_details),
+                requeue_limit)
+            responses = self.enqueue_many(jobs, batch_size=batch_size)
+
+            pipe = self._r.pipeline()
+            pipe.zrem(dead_letter_key, *job_list)
+            pipe.hdel('%s:job' % dead_letter_key, *job_list)
+            pipe.execute()
+
+            replayed_job_count += len(dead_jobs)
+            for response in responses:
+                yield response
+
+    def _build_replay_jobs(self, dead_letters, requeue_limit):
+        """Converts dead letters into the jobs of an enqueue_many."""
+        return [{
+            'payload': dead_letter['payload'],
+            'interval': dead_letter['interval'],
+            'job_id': dead_letter['job_id'],
+            'queue_id': dead_letter['queue_id'],
+            'queue_type': dead_letter['queue_type'],
+            'requeue_limit': requeue_limit
+        } for dead_letter in dead_letters]
 
     def metrics(self, queue_type=None, queue_id=None):
         """Provides a way to get statistics about various parameters like,
-        * global enqueue / dequeue rates per min.
-        * per queue enqueue / dequeue rates per min.
+        * global enqueue / dequeue rates per metrics bucket.
+        * per queue enqueue / dequeue rates per metrics bucket.
         * queue length of each queue.
         * list of queue ids for each queue type.
         """
@@ -374,25 +1319,14 @@ class SharQ(object):
                 '%s:ready:queue_type' % self._key_prefix)
             all_queue_types = active_queue_types | ready_queue_types
             queue_types = convert_to_str(all_queue_types)
-            # global rates for past 10 minutes
+            # global rates over the metrics retention
             timestamp = str(generate_epoch())
             keys = [
                 self._key_prefix
             ]
-            args = [
-                timestamp
-            ]
-            enqueue_details, dequeue_details = self._lua_metrics(
-                keys=keys, args=args)
-
-            enqueue_counts = {}
-            dequeue_counts = {}
-            # the length of enqueue & dequeue details are always same.
-            for i in range(0, len(enqueue_details), 2):
-                enqueue_counts[str(enqueue_details[i])] = int(
-                    enqueue_details[i + 1] or 0)
-                dequeue_counts[str(dequeue_details[i])] = int(
-                    dequeue_details[i + 1] or 0)
+            args = self._build_metrics_args(timestamp)
+            enqueue_counts, dequeue_counts = self._parse_metrics_response(
+                self._lua_metrics(keys=keys, args=args))
 
             response.update({
                 'status': 'success',
@@ -402,47 +1336,45 @@ class SharQ(object):
             })
             return response
         elif queue_type and not queue_id:
-            # return list of queue_ids.
-            # get data from two sorted sets in a transaction
-            pipe = self._r.pipeline()
-            pipe.zrange('%s:%s' % (self._key_prefix, queue_type), 0, -1)
-            pipe.zrange('%s:%s:active' % (self._key_prefix, queue_type), 0, -1)
-            ready_queues, active_queues = pipe.execute()
-            # extract the queue_ids from the queue_id:job_id string
-            active_queues = [i.decode('utf-8').split(':')[0] for i in active_queues]
-            all_queue_set = set(ready_queues) | set(active_queues)
-            queue_list = convert_to_str(all_queue_set)
+            # return list of queue_ids, read a page at a time.
+            queue_list = [
+                queue_id for queue_ids in self.iter_queue_ids(queue_type)
+                for queue_id in queue_ids]
             response.update({
                 'status': 'success',
                 'queue_ids': queue_list
             })
+            response.update(self.get_queue_type_stats(queue_type))
+            if self._get_queue_type_boolean(queue_type, 'queue_type_metrics'):
+                # queue_type rates over the metrics retention
+                keys = [
+                    '%s:%s' % (self._key_prefix, queue_type)
+                ]
+                args = self._build_metrics_args(str(generate_epoch()))
+                enqueue_counts, dequeue_counts = self._parse_metrics_response(
+                    self._lua_metrics(keys=keys, args=args))
+                response.update({
+                    'enqueue_counts': enqueue_counts,
+                    'dequeue_counts': dequeue_counts
+                })
+            if self._get_latency_metrics_mode(queue_type) > 0:
+                wait_time, service_time = self._get_latency_metrics(
+                    '%s:%s' % (self._key_prefix, queue_type))
+                response.update({
+                    'wait_time': wait_time,
+                    'service_time': service_time
+                })
             return response
         elif queue_type and queue_id:
             # return specific details.
-            active_queue_types = self._r.smembers(
-                '%s:active:queue_type' % self._key_prefix)
-            ready_queue_types = self._r.smembers(
-                '%s:ready:queue_type' % self._key_prefix)
-            all_queue_types = active_queue_types | ready_queue_types
-            # queue specific rates for past 10 minutes
+            # queue specific rates over the metrics retention
             timestamp = str(generate_epoch())
             keys = [
                 '%s:%s:%s' % (self._key_prefix, queue_type, queue_id)
             ]
-            args = [
-                timestamp
-            ]
-            enqueue_details, dequeue_details = self._lua_metrics(
-                keys=keys, args=args)
-
-            enqueue_counts = {}
-            dequeue_counts = {}
-            # the length of enqueue & dequeue details are always same.
-            for i in range(0, len(enqueue_details), 2):
-                enqueue_counts[str(enqueue_details[i])] = int(
-                    enqueue_details[i + 1] or 0)
-                dequeue_counts[str(dequeue_details[i])] = int(
-                    dequeue_details[i + 1] or 0)
+            args = self._build_metrics_args(timestamp)
+            enqueue_counts, dequeue_counts = self._parse_metrics_response(
+                self._lua_metrics(keys=keys, args=args))
 
             # get the queue length for the job queue
             queue_length = self._r.llen('%s:%s:%s' % (
@@ -454,6 +1386,13 @@ class SharQ(object):
                 'enqueue_counts': enqueue_counts,
                 'dequeue_counts': dequeue_counts
             })
+            if self._get_latency_metrics_mode(queue_type) == 2:
+                wait_time, service_time = self._get_latency_metrics(
+                    '%s:%s:%s' % (self._key_prefix, queue_type, queue_id))
+                response.update({
+                    'wait_time': wait_time,
+                    'service_time': service_time
+                })
             return response
         elif not queue_type and queue_id:
             raise BadArgumentException(
@@ -461,6 +1400,189 @@ class SharQ(object):
 
         return response
 
+    def iter_queue_ids(self, queue_type, page_size=1000, count_only=False):
+        """Iterates over the queue_ids of the queue_type, the ones with
+        jobs waiting to be dequeued and the ones with dequeued jobs. The
+        ready and the active sets are walked with ZSCAN cursors, about
+        `page_size` members per call, so neither redis nor the client
+        holds all the members at once.
+
+        Returns a generator, which yields the list of the queue_ids new
+        in every page, or only their number with `count_only`. Every
+        queue_id is yielded once, so the queue_ids seen are kept in
+        memory, but the dequeued jobs are not.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if not isinstance(page_size, int) or page_size < 1:
+            raise BadArgumentException('`page_size` has an invalid value.')
+
+        return self._iter_queue_ids(queue_type, page_size, count_only)
+
+    def _iter_queue_ids(self, queue_type, page_size, count_only):
+        seen_queue_ids = set()
+        for key, is_active in self._build_queue_id_keys(queue_type):
+            cursor = 0
+            while True:
+                cursor, members = self._r.zscan(key, cursor, count=page_size)
+                queue_ids = self._parse_queue_id_page(
+                    members, is_active, seen_queue_ids)
+                if queue_ids:
+                    yield len(queue_ids) if count_only else [
+                        queue_id.decode('utf-8') for queue_id in queue_ids]
+                if cursor == 0:
+                    break
+
+    def _build_queue_id_keys(self, queue_type):
+        """Returns the (key, is_active) of the sorted sets which hold
+        the queue_ids of the queue_type. The members of the active set
+        are queue_id:job_id.
+        """
+        return [
+            ('%s:%s' % (self._key_prefix, queue_type), False),
+            ('%s:%s:active' % (self._key_prefix, queue_type), True)
+        ]
+
+    def _parse_queue_id_page(self, members, is_active, seen_queue_ids):
+        """Returns the queue_ids of a ZSCAN page which are not in
+        seen_queue_ids, and adds them to it.
+        """
+        queue_ids = []
+        for member, _ in members:
+            if is_active:
+                member = member.split(b':', 1)[0]
+            if member not in seen_queue_ids:
+                seen_queue_ids.add(member)
+                queue_ids.append(member)
+
+        return queue_ids
+
+    def get_queue_type_stats(self, queue_type):
+        """Returns the number of jobs of the queue_type which are
+        queued (waiting to be dequeued) and in flight (dequeued, not
+        finished yet), along with the total number of jobs requeued
+        and discarded so far. The counters are kept up to date by the
+        Lua scripts, and are read with a single HGETALL.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        return self._parse_queue_type_stats(self._r.hgetall(
+            '%s:%s:stats' % (self._key_prefix, queue_type)))
+
+    def _parse_queue_type_stats(self, stats):
+        """Converts the stats hash of a queue_type into a dict of
+        its counters. The jobs queued or in flight before the counters
+        were kept can take a counter below 0, which is reported as 0.
+        """
+        return dict(
+            (field, max(int(stats.get(field.encode('utf-8'), 0)), 0))
+            for field in QUEUE_TYPE_STATS)
+
+    def _parse_metrics_response(self, metrics_response):
+        """Converts the response of the metrics Lua script into
+        the enqueue and dequeue counts, keyed by the start of
+        every metrics bucket.
+        """
+        enqueue_details, dequeue_details = metrics_response
+        enqueue_counts = {}
+        dequeue_counts = {}
+        # the length of enqueue & dequeue details are always same.
+        for i in range(0, len(enqueue_details), 2):
+            enqueue_counts[str(enqueue_details[i])] = int(
+                enqueue_details[i + 1] or 0)
+            dequeue_counts[str(dequeue_details[i])] = int(
+                dequeue_details[i + 1] or 0)
+
+        return enqueue_counts, dequeue_counts
+
+    def _get_latency_metrics(self, key):
+        """Returns the summaries of the wait time and the service time
+        histograms of `key` (a queue_type or a queue) over the metrics
+        retention. The histograms of all the buckets are read in a
+        single pipeline.
+        """
+        pipe = self._r.pipeline()
+        for histogram_key in self._build_latency_keys(key, generate_epoch()):
+            pipe.hgetall(histogram_key)
+        return self._parse_latency_response(pipe.execute())
+
+    def _build_latency_keys(self, key, timestamp):
+        """Returns the keys of the wait time histograms of `key` over
+        the metrics retention, followed by the keys of its service time
+        histograms.
+        """
+        timestamp_bucket = (
+            timestamp // self._metrics_bucket_size * self._metrics_bucket_size)
+        bucket_list = [
+            timestamp_bucket - i * self._metrics_bucket_size
+            for i in range(self._metrics_retention // self._metrics_bucket_size)
+        ]
+        return [
+            '%s:%s:%d' % (key, histogram, bucket)
+            for histogram in ('wait_time', 'service_time')
+            for bucket in bucket_list
+        ]
+
+    def _parse_latency_response(self, histograms):
+        """Converts the histograms read from the keys returned by
+        `_build_latency_keys` into the summaries of the wait time and
+        the service time.
+        """
+        bucket_count = len(histograms) // 2
+        return (self._summarize_latencies(histograms[:bucket_count]),
+                self._summarize_latencies(histograms[bucket_count:]))
+
+    def _summarize_latencies(self, histograms):
+        """Merges latency histograms into their count, their sum, the
+        counts of every latency bucket (keyed by its upper bound) and
+        the LATENCY_PERCENTILES. A percentile is interpolated linearly
+        within its bucket, and is the largest finite upper bound when
+        it falls into the +Inf bucket. The latencies are in milliseconds.
+        """
+        latency_sum = 0
+        bucket_counts = {}
+        for histogram in histograms:
+            for bucket, count in histogram.items():
+                bucket = bucket.decode('utf-8')
+                if bucket == 'sum':
+                    latency_sum += int(count)
+                else:
+                    bucket_counts[bucket] = (
+                        bucket_counts.get(bucket, 0) + int(count))
+
+        latency_count = sum(bucket_counts.values())
+        summary = {
+            'count': latency_count,
+            'sum': latency_sum,
+            'buckets': bucket_counts
+        }
+        for percentile in LATENCY_PERCENTILES:
+            summary['p%d' % percentile] = None
+
+        if not latency_count:
+            return summary
+
+        for percentile in LATENCY_PERCENTILES:
+            rank = latency_count * percentile / 100.0
+            lower_bound = cumulative_count = 0
+            for bucket in sorted(bucket_counts, key=float):
+                count = bucket_counts[bucket]
+                if cumulative_count + count >= rank:
+                    if bucket == '+Inf':
+                        value = lower_bound
+                    else:
+                        value = lower_bound + (int(bucket) - lower_bound) * (
+                            rank - cumulative_count) / count
+                    summary['p%d' % percentile] = int(round(value))
+                    break
+                cumulative_count += count
+                if bucket != '+Inf':
+                    lower_bound = int(bucket)
+
+        return summary
+
     def deep_status(self):
         """
         To check the availability of redis. If redis is down get will throw exception
@@ -468,6 +1590,20 @@ class SharQ(object):
         """
         return self._r.set('sharq:deep_status:{}'.format(self._key_prefix), 'sharq_deep_status')
 
+    def _build_clear_queue_args(self, queue_type, queue_id, purge_all):
+        """Returns the keys and the arguments of the clear_queue
+        Lua script.
+        """
+        keys = [
+            self._key_prefix,
+            queue_type
+        ]
+        args = [
+            queue_id,
+            1 if purge_all else 0
+        ]
+        return keys, args
+
     def clear_queue(self, queue_type=None, queue_id=None, purge_all=False):
         """clear the all entries in queue with particular queue_id
         and queue_type. It takes an optional argument, 
@@ -484,38 +1620,19 @@ class SharQ(object):
             'status': 'Failure',
             'message': 'No queued calls found'
         }
-        # remove from the primary sorted set
-        primary_set = '{}:{}'.format(self._key_prefix, queue_type)
-        queued_status = self._r.zrem(primary_set, queue_id)
-        if queued_status:
-            response.update({'status': 'Success',
-                             'message': 'Successfully removed all queued calls'})
-        # do a full cleanup of reources
-        # although this is not necessary as we don't remove resources 
-        # while dequeue operation
-        job_queue_list = '{}:{}:{}'.format(self._key_prefix, queue_type, queue_id)
+        # the queue is removed from the primary sorted set, and its job
+        # queue list is deleted along with its jobs in the queued stats,
+        # in a single script call. a full cleanup of the resources is
+        # not necessary, as the dequeue does not remove them either.
+        keys, args = self._build_clear_queue_args(
+            queue_type, queue_id, purge_all)
+        queued_status = self._lua_clear_queue(keys=keys, args=args)
         if queued_status and purge_all:
-            job_list = self._r.lrange(job_queue_list, 0, -1)
-            pipe = self._r.pipeline()
-            # clear the payload data for job_uuid
-            for job_uuid in job_list:
-                if job_uuid is None:
-                    continue
-                payload_set = '{}:payload'.format(self._key_prefix)
-                job_payload_key = '{}:{}:{}'.format(queue_type, queue_id, job_uuid)
-                pipe.hdel(payload_set, job_payload_key)
-            # clear jobrequest interval
-            interval_set = '{}:interval'.format(self._key_prefix)
-            job_interval_key = '{}:{}'.format(queue_type, queue_id)
-            pipe.hdel(interval_set, job_interval_key)
-            # clear job_queue_list
-            pipe.delete(job_queue_list)
-            pipe.execute()
             response.update({'status': 'Success',
                              'message': 'Successfully removed all queued calls and purged related resources'})
-        else:
-            # always delete the job queue list
-            self._r.delete(job_queue_list)
+        elif queued_status:
+            response.update({'status': 'Success',
+                             'message': 'Successfully removed all queued calls'})
         return response
 
     def get_queue_length(self, queue_type, queue_id):
@@ -535,3 +1652,151 @@ class SharQ(object):
         current_queue_length = self._r.llen(redis_key)
         return current_queue_length
 
+
+    def get_queue_lengths(self, queue_type, queue_ids, batch_size=1000):
+        """Returns the lengths of many queues of the queue_type, as an
+        array.array aligned with `queue_ids`. The lengths are read in
+        pipelines of `batch_size` queues, one round trip per chunk.
+        """
+        queue_ids = self._validate_bulk_args(queue_type, queue_ids, batch_size)
+
+        queue_lengths = array.array('q')
+        for i in range(0, len(queue_ids), batch_size):
+            # the reads need no transaction, which blocks redis for
+            # the whole chunk.
+            pipe = self._r.pipeline(transaction=False)
+            self._queue_metrics_many_commands(
+                pipe, queue_type, queue_ids[i:i + batch_size], [])
+            queue_lengths.extend(pipe.execute())
+
+        return queue_lengths
+
+    def metrics_many(self, queue_type, queue_ids, batch_size=1000):
+        """Returns the lengths and the enqueue / dequeue counts per
+        metrics bucket of many queues of the queue_type at once, in
+        columns aligned with `queue_ids`. The lengths are an array.array,
+        and the counts are a dict of the start of every metrics bucket
+        to an array.array. The queues are read in pipelines of
+        `batch_size` queues, one round trip per chunk, with one MGET of
+        the enqueue and one of the dequeue counters of every queue. A
+        call takes at most MAX_BULK_QUEUE_COUNT queues.
+
+        The counts are not read, and the response has no buckets, when
+        the queue_metrics of the queue_type are off.
+        """
+        queue_ids = self._validate_bulk_args(queue_type, queue_ids, batch_size)
+        buckets = self._get_metrics_buckets(queue_type)
+        batch_size = self._get_metrics_many_batch_size(buckets, batch_size)
+
+        response = self._build_metrics_many_response(queue_ids, buckets)
+        for i in range(0, len(queue_ids), batch_size):
+            pipe = self._r.pipeline(transaction=False)
+            self._queue_metrics_many_commands(
+                pipe, queue_type, queue_ids[i:i + batch_size], buckets)
+            self._update_metrics_many_response(
+                response, buckets, pipe.execute())
+
+        return response
+
+    def _validate_bulk_args(self, queue_type, queue_ids, batch_size):
+        """Validates the arguments of a bulk read of queues and
+        returns the queue_ids as a list.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        queue_ids = list(queue_ids)
+        if len(queue_ids) > MAX_BULK_QUEUE_COUNT:
+            raise BadArgumentException('`queue_ids` has an invalid value.')
+        for queue_id in queue_ids:
+            if not is_valid_identifier(queue_id):
+                raise BadArgumentException('`queue_id` has an invalid value.')
+
+        return queue_ids
+
+    def _get_metrics_buckets(self, queue_type):
+        """Returns the start of every metrics bucket in the retention,
+        latest first, or an empty list when the queue_metrics of the
+        queue_type are off.
+        """
+        if self._build_counter_args(queue_type)[0] == 0:
+            return []
+
+        timestamp_bucket = (generate_epoch() // self._metrics_bucket_size *
+                            self._metrics_bucket_size)
+        return [
+            timestamp_bucket - i * self._metrics_bucket_size
+            for i in range(
+                self._metrics_retention // self._metrics_bucket_size)
+        ]
+
+    def _get_metrics_many_batch_size(self, buckets, batch_size):
+        """Returns the batch_size of a metrics_many, made smaller so that
+        a chunk reads at most MAX_METRICS_MANY_KEY_COUNT counter keys.
+        """
+        if not buckets:
+            return batch_size
+        return max(1, min(
+            batch_size, MAX_METRICS_MANY_KEY_COUNT // (2 * len(buckets))))
+
+    def _queue_metrics_many_commands(self, pipe, queue_type, queue_ids,
+                                     buckets):
+        """Adds the read of the length of every queue to the pipeline,
+        along with one MGET of its enqueue counters and one MGET of its
+        dequeue counters over all the buckets, as the metrics Lua script
+        does. The counters of a queue are spread over the slots of a
+        cluster, where they are read with a GET per bucket instead.
+        """
+        clustered = self._is_clustered()
+        for queue_id in queue_ids:
+            queue_key = '%s:%s:%s' % (self._key_prefix, queue_type, queue_id)
+            pipe.llen(queue_key)
+            if not buckets:
+                continue
+            for counter in ('enqueue_counter', 'dequeue_counter'):
+                counter_keys = [
+                    '%s:%s:%d' % (queue_key, counter, bucket)
+                    for bucket in buckets]
+                if clustered:
+                    for counter_key in counter_keys:
+                        pipe.get(counter_key)
+                else:
+                    pipe.mget(counter_keys)
+
+    def _build_metrics_many_response(self, queue_ids, buckets):
+        """Returns the response of a metrics_many with empty columns."""
+        return {
+            'status': 'success',
+            'queue_ids': queue_ids,
+            'queue_lengths': array.array('q'),
+            'enqueue_counts': dict(
+                (str(bucket), array.array('q')) for bucket in buckets),
+            'dequeue_counts': dict(
+                (str(bucket), array.array('q')) for bucket in buckets)
+        }
+
+    def _update_metrics_many_response(self, response, buckets,
+                                      pipe_response):
+        """Appends the values read by the commands of
+        `_queue_metrics_many_commands` to the columns of the response.
+        """
+        enqueue_columns = [
+            response['enqueue_counts'][str(bucket)] for bucket in buckets]
+        dequeue_columns = [
+            response['dequeue_counts'][str(bucket)] for bucket in buckets]
+        clustered = self._is_clustered()
+        values = iter(pipe_response)
+        for queue_length in values:
+            response['queue_lengths'].append(queue_length)
+            if not buckets:
+                continue
+            for columns in (enqueue_columns, dequeue_columns):
+                if clustered:
+                    counts = itertools.islice(values, len(buckets))
+                else:
+                    counts = next(values)
+                for column, count in zip(columns, counts):
+                    column.append(int(count or 0))
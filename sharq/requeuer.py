@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+"""Runs SharQ.requeue whenever a dequeued job expires, and at least
+every job_requeue_interval. Any number of requeuers can run against
+the same Redis, and a single one of them, the holder of a lease in
+Redis, does the requeue at any time.
+
+    sharq-requeuer /path/to/sharq.conf
+"""
+import os
+import time
+import uuid
+import signal
+import socket
+import logging
+import argparse
+import threading
+from sharq.queue import SharQ
+from sharq.utils import is_valid_interval, generate_epoch
+from sharq.exceptions import BadArgumentException
+
+logger = logging.getLogger(__name__)
+
+# minimum milliseconds between a failed pass and the next one, so that
+# a failing requeue does not retry in a loop against redis.
+ERROR_BACKOFF_INTERVAL = 1000
+
+
+class Requeuer(object):
+    """A Requeuer requeues the expired jobs of a SharQ periodically.
+    Before every pass, it acquires (or renews) a lease in Redis. Only
+    the holder of the lease requeues, the other requeuers stand by
+    and take over once the lease expires or is released.
+
+    After a pass, the leader sleeps until the earliest lease of the
+    active jobs expires, but never longer than the interval. The time
+    of the next pass is kept in Redis, and a dequeue which creates a
+    lease expiring before it wakes the leader up to reschedule, which
+    looks the earliest lease up again and goes back to sleep. So the
+    expired jobs are requeued right away, without scanning on a tight
+    interval.
+
+    A failed pass is retried after the interval, or ERROR_BACKOFF_INTERVAL
+    if that is longer, rather than at the earliest lease, which has
+    expired already when the failed pass was to requeue it.
+
+    A requeue is safe to run concurrently, so a pass which outlives
+    its lease does no harm other than a redundant scan.
+    """
+
+    def __init__(self, sharq, interval=None, lease_interval=None):
+        """Construct a Requeuer.
+            * sharq - the SharQ object to requeue the jobs of.
+            * interval - maximum milliseconds between two passes,
+              defaults to the job_requeue_interval in the config.
+            * lease_interval - milliseconds the lease is held for
+              without a renewal, defaults to thrice the interval.
+        """
+        if interval is None:
+            interval = sharq._job_requeue_interval
+
+        if not is_valid_interval(interval) or interval < 1:
+            raise BadArgumentException('`interval` has an invalid value.')
+
+        if lease_interval is None:
+            lease_interval = 3 * interval
+
+        if not is_valid_interval(lease_interval) or lease_interval <= interval:
+            raise BadArgumentException(
+                '`lease_interval` has an invalid value.')
+
+        self._sharq = sharq
+        self._interval = interval
+        self._lease_interval = lease_interval
+        self._lease_key = '%s:requeue:lease' % sharq._key_prefix
+        self._next_pass_key = '%s:requeue:next' % sharq._key_prefix
+        self._notify_key = '%s:requeue:notify' % sharq._key_prefix
+        # identifies this requeuer as the owner of the lease.
+        self._owner = '%s:%d:%s' % (
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'is_leader': False,
+            'passes': 0,
+            'errors': 0,
+            'requeued': 0,
+            'discarded': 0,
+            'last_pass_at': None,
+            'next_pass_at': None,
+            'wakeups': 0,
+            'last_pass_duration': None,
+            'max_pass_duration': 0,
+            'total_pass_duration': 0
+        }
+
+    def stats(self):
+        """Returns the statistics of the passes done by this
+        requeuer. The durations are in milliseconds.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def start(self):
+        """Runs the requeuer in a daemon thread."""
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the requeuer, and waits for the thread started
+        by `start` to exit.
+        """
+        self._stop_event.set()
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+
+    def install_signal_handlers(self):
+        """Stops the requeuer on SIGINT and SIGTERM. Has to be
+        called from the main thread.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self._stop_event.set())
+
+    def run(self):
+        """Requeues the expired jobs, while holding the lease,
+        until the requeuer is stopped.
+        """
+        try:
+            while not self._stop_event.is_set():
+                next_pass_time = generate_epoch() + self._interval
+                if self._acquire_lease():
+                    # the dequeues during the pass compare their leases
+                    # with the latest time the next pass can be at.
+                    self._announce_next_pass(next_pass_time)
+                    if self._requeue():
+                        next_pass_time = self._schedule_next_pass(
+                            next_pass_time)
+                        self._wait(next_pass_time, wake_up=True)
+                    else:
+                        # the wake ups would bring the retry forward.
+                        next_pass_time = self._schedule_retry()
+                        self._wait(next_pass_time, wake_up=False)
+                else:
+                    self._wait(next_pass_time, wake_up=False)
+        finally:
+            self._release_lease()
+
+    def _announce_next_pass(self, next_pass_time):
+        """Stores the time of the next pass, which is looked up by
+        the dequeues to decide whether to wake the requeuer up.
+        """
+        try:
+            self._sharq._r.set(self._next_pass_key, next_pass_time,
+                               px=self._lease_interval)
+        except Exception:
+            logger.exception('could not announce the next requeue pass')
+
+    def _schedule_next_pass(self, next_pass_time):
+        """Returns the time of the next pass, which is when the
+        earliest lease of the active jobs expires, or next_pass_time
+        if that is earlier.
+        """
+        try:
+            # the leases read below cover the wake ups so far. the ones
+            # pushed after the read are kept, and reschedule again.
+            self._sharq._r.delete(self._notify_key)
+            next_expiry_time = self._get_next_expiry_time()
+        except Exception:
+            logger.exception('could not read the next job expiry')
+            next_expiry_time = None
+
+        if next_expiry_time is not None:
+            next_pass_time = min(next_pass_time, next_expiry_time)
+
+        self._announce_next_pass(next_pass_time)
+        with self._stats_lock:
+            self._stats['next_pass_at'] = next_pass_time
+        return next_pass_time
+
+    def _schedule_retry(self):
+        """Returns the time of the pass which retries a failed one,
+        at least ERROR_BACKOFF_INTERVAL from now.
+        """
+        next_pass_time = generate_epoch() + max(
+            self._interval, ERROR_BACKOFF_INTERVAL)
+        self._announce_next_pass(next_pass_time)
+        with self._stats_lock:
+            self._stats['next_pass_at'] = next_pass_time
+        return next_pass_time
+
+    def _get_next_expiry_time(self):
+        """Returns the time at which the earliest lease of the active
+        jobs expires, or None if there are no active jobs.
+        """
+        active_queue_type_list = self._sharq._r.smembers(
+            '%s:active:queue_type' % self._sharq._key_prefix)
+        pipe = self._sharq._r.pipeline()
+        for queue_type in active_queue_type_list:
+            pipe.zrange('%s:%s:active' % (
+                self._sharq._key_prefix, queue_type.decode('utf-8')),
+                0, 0, withscores=True)
+
+        expiry_time_list = [
+            int(earliest_job[0][1])
+            for earliest_job in pipe.execute() if earliest_job]
+        if not expiry_time_list:
+            return None
+        return min(expiry_time_list)
+
+    def _wait(self, next_pass_time, wake_up):
+        """Sleeps until next_pass_time, or until the requeuer is
+        stopped. When wake_up is set, a dequeue of a job which
+        expires earlier reschedules the next pass, and the sleep
+        goes on until the new time.
+        """
+        while not self._stop_event.is_set():
+            wait_time = next_pass_time - generate_epoch()
+            if wait_time <= 0:
+                return
+
+            if wake_up and wait_time >= 1000:
+                # blocking timeouts are in whole seconds. block for a
+                # second at a time, so that a stop is noticed quickly.
+                try:
+                    if self._sharq._r.blpop(self._notify_key, timeout=1):
+                        with self._stats_lock:
+                            self._stats['wakeups'] += 1
+                        next_pass_time = self._schedule_next_pass(
+                            next_pass_time)
+                except Exception:
+                    logger.exception('could not wait for a wake up')
+                    self._stop_event.wait(1)
+            else:
+                self._stop_event.wait(min(wait_time, 1000) / 1000.0)
+
+    def _acquire_lease(self):
+        """Acquires or renews the lease. Returns True if this
+        requeuer is the leader.
+        """
+        try:
+            is_leader = self._sharq._lua_lease(
+                keys=[self._lease_key],
+                args=[self._owner, self._lease_interval]) == 1
+        except Exception:
+            logger.exception('could not acquire the requeue lease')
+            is_leader = False
+
+        with self._stats_lock:
+            if is_leader != self._stats['is_leader']:
+                logger.info('%s the requeue lease', (
+                    'acquired' if is_leader else 'lost'))
+            self._stats['is_leader'] = is_leader
+        return is_leader
+
+    def _release_lease(self):
+        """Releases the lease, so that another requeuer can take
+        over without waiting for the lease to expire.
+        """
+        with self._stats_lock:
+            was_leader = self._stats['is_leader']
+            self._stats['is_leader'] = False
+
+        try:
+            self._sharq._lua_lease(
+                keys=[self._lease_key], args=[self._owner, 0])
+            if was_leader:
+                # no pass is scheduled anymore.
+                self._sharq._r.delete(self._next_pass_key)
+        except Exception:
+            logger.exception('could not release the requeue lease')
+
+    def _requeue(self):
+        """Does a requeue pass and records its statistics. Returns
+        False if the pass failed.
+        """
+        start_time = time.time()
+        try:
+            response = self._sharq.requeue()
+        except Exception:
+            logger.exception('requeue failed')
+            with self._stats_lock:
+                self._stats['errors'] += 1
+            return False
+
+        pass_duration = int((time.time() - start_time) * 1000)
+        with self._stats_lock:
+            self._stats['passes'] += 1
+            self._stats['requeued'] += response['requeued']
+            self._stats['discarded'] += response['discarded']
+            self._stats['last_pass_at'] = int(start_time * 1000)
+            self._stats['last_pass_duration'] = pass_duration
+            self._stats['max_pass_duration'] = max(
+                self._stats['max_pass_duration'], pass_duration)
+            self._stats['total_pass_duration'] += pass_duration
+
+        # passes which find no expired job are only logged when debugging.
+        log = logger.info if (
+            response['requeued'] or response['discarded']) else logger.debug
+        log('requeue pass took %dms: %d requeued, %d discarded',
+            pass_duration, response['requeued'], response['discarded'])
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('config', help='path to the SharQ config file.')
+    parser.add_argument('--interval', type=int, default=None,
+                        help='milliseconds between two requeue passes. '
+                             'defaults to the job_requeue_interval.')
+    parser.add_argument('--lease-interval', type=int, default=None,
+                        help='milliseconds the requeue lease is held for. '
+                             'defaults to thrice the interval.')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    requeuer = Requeuer(
+        SharQ(args.config), interval=args.interval,
+        lease_interval=args.lease_interval)
+    requeuer.install_signal_handlers()
+    requeuer.run()
+
+
+if __name__ == '__main__':
+    main()
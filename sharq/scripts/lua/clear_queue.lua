@@ -0,0 +1,49 @@
+-- script to clear a queue.
+
+-- input:
+--     KEYS[1] - <key_prefix>
+--     KEYS[2] - <queue_type>
+--
+--     ARGV[1] - <queue_id>
+--     ARGV[2] - <purge_all> (1 removes the payloads of the jobs
+--               and the interval of the queue too)
+--
+--     the queue is removed from the ready sorted set and its job queue
+--     is deleted. the deleted jobs are taken off the queued field of
+--     <key_prefix>:<queue_type>:stats, in the same call, so that the
+--     counter matches the jobs which were actually deleted.
+--
+--     the payloads and the interval are purged only when the queue was
+--     in the ready sorted set.
+-- output:
+--     1 if the queue was in the ready sorted set, 0 otherwise.
+
+local prefix = KEYS[1]
+local queue_type = KEYS[2]
+local queue_id = ARGV[1]
+local purge_all = ARGV[2] == '1'
+
+local queue_key = prefix .. ':' .. queue_type .. ':' .. queue_id
+
+-- remove from the ready sorted set.
+local removed = redis.call('ZREM', prefix .. ':' .. queue_type, queue_id)
+
+local queue_length = redis.call('LLEN', queue_key)
+if removed == 1 and purge_all then
+   -- clear the payloads of the jobs.
+   local job_ids = redis.call('LRANGE', queue_key, 0, -1)
+   for _, job_id in ipairs(job_ids) do
+      redis.call('HDEL', prefix .. ':payload', queue_type .. ':' .. queue_id .. ':' .. job_id)
+   end
+   -- clear the interval of the queue.
+   redis.call('HDEL', prefix .. ':interval', queue_type .. ':' .. queue_id)
+end
+
+-- always delete the job queue, and take its jobs off the queued jobs
+-- of the queue_type.
+redis.call('DEL', queue_key)
+if queue_length > 0 then
+   redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'queued', -queue_length)
+end
+
+return removed
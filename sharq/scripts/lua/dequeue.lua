@@ -1,4 +1,4 @@
--- script to dequeue a job from sharq.
+-- script to dequeue one or more jobs from sharq.
 
 -- input:
 --     KEYS[1] - <key_prefix>
@@ -6,8 +6,63 @@
 --
 --     ARGV[1] - <current_timestamp>
 --     ARGV[2] - <job_expiry_interval>
+--     ARGV[3] - <count> (optional, defaults to 1)
+--     ARGV[4] - <strategy> (optional, defaults to 'earliest')
+--     ARGV[5] - <sample_size> (optional, defaults to <count>)
+--     ARGV[6] - <random_seed> (optional, used by the 'random' strategy)
+--     ARGV[7] - <metrics_bucket_size> (optional, defaults to a minute)
+--     ARGV[8] - <metrics_retention> (optional, defaults to 10 minutes)
+--     ARGV[9] - <queue_metrics_rate> (optional, defaults to 1)
+--     ARGV[10] - <queue_type_metrics> (optional, defaults to 0)
+--     ARGV[11] - <latency_metrics> (optional, defaults to 0)
+--     ARGV[12] - <metrics_seed> (optional, defaults to 0)
+--     ARGV[13] - <notify> (optional, 1 after the consumer was woken up)
+--
+--     the dequeues are counted the same way as the enqueues are
+--     counted by enqueue.lua, with <metrics_seed> to sample the queues.
+--     it is apart from <random_seed>, so that the sampling does not
+--     replay the shuffle of the 'random' strategy and follow the
+--     queues it picked.
+--
+--     when <latency_metrics> is not 0, the wait time of every job (from
+--     its enqueue or requeue to now) is added to the histogram of the
+--     queue_type, and when it is 2, to the histogram of the queue too,
+--         <key_prefix>:<queue_type>:wait_time:<bucket>
+--         <key_prefix>:<queue_type>:<queue_id>:wait_time:<bucket>
+--     every histogram is a hash of the upper bound of every latency
+--     bucket (in milliseconds, or +Inf) to its count, along with the
+--     sum of the latencies. the dequeue time replaces the enqueue time
+--     in the <job_id>:time field, for finish.lua to measure the
+--     service time of the job.
+--
+--     the dequeued jobs are moved from the queued to the in_flight
+--     field of <key_prefix>:<queue_type>:stats.
 -- output:
---     { queue_id, job_id, payload, requeues_remaining }
+--     { { queue_id, job_id, payload, requeues_remaining }, ... }
+--
+--     at most one job is dequeued from each ready queue, so that
+--     the interval of every queue is honoured within a single call.
+--
+--     the ready queues are picked using one of these strategies,
+--         earliest - the queues which have been ready the longest.
+--         random   - random queues among the <sample_size> queues
+--                    which have been ready the longest.
+--         backlog  - the queues with the most jobs among the
+--                    <sample_size> queues which have been ready
+--                    the longest.
+--     the ready sorted set is never read beyond <sample_size>
+--     entries, so the cost of a dequeue does not depend on the
+--     number of queues in the queue_type.
+--
+--     when <notify> is 1 and a ready queue is left after the dequeue,
+--     a token is pushed back to the <key_prefix>:<queue_type>:notify
+--     list, unless one is pending already. so a consumer which was
+--     woken up passes the wake up on to the next blocked consumer,
+--     while ready queues remain.
+--
+--     a running requeuer keeps the time of its next pass in
+--     <key_prefix>:requeue:next. when the dequeued jobs expire
+--     before that, the requeuer is woken up to reschedule.
 
 
 local prefix = KEYS[1]
@@ -15,28 +70,68 @@ local queue_type = KEYS[2]
 
 local current_timestamp = ARGV[1]
 local job_expiry_interval = ARGV[2]
+local count = tonumber(ARGV[3]) or 1
+local strategy = ARGV[4] or 'earliest'
+local sample_size = math.max(tonumber(ARGV[5]) or count, count)
+local latency_metrics = tonumber(ARGV[11]) or 0
 
 
-local ready_queue_id_list = redis.call('ZRANGEBYSCORE', prefix .. ':' .. queue_type, 0, current_timestamp)
-if next(ready_queue_id_list) ~= nil then
+local ready_queue_id_list
+if strategy == 'earliest' then
+   ready_queue_id_list = redis.call('ZRANGEBYSCORE', prefix .. ':' .. queue_type, 0, current_timestamp, 'LIMIT', 0, count)
+else
+   local candidate_list = redis.call('ZRANGEBYSCORE', prefix .. ':' .. queue_type, 0, current_timestamp, 'LIMIT', 0, sample_size)
+   if strategy == 'random' then
+      -- shuffle the candidates (fisher-yates) with the seed from the client.
+      math.randomseed(tonumber(ARGV[6]) or 0)
+      for i = #candidate_list, 2, -1 do
+	 local j = math.random(i)
+	 candidate_list[i], candidate_list[j] = candidate_list[j], candidate_list[i]
+      end
+   elseif strategy == 'backlog' then
+      -- order the candidates by the length of their job queue.
+      local queue_length = {}
+      for _, queue_id in ipairs(candidate_list) do
+	 queue_length[queue_id] = redis.call('LLEN', prefix .. ':' .. queue_type .. ':' .. queue_id)
+      end
+      table.sort(candidate_list, function(a, b) return queue_length[a] > queue_length[b] end)
+   end
+   ready_queue_id_list = {}
+   for i = 1, math.min(count, #candidate_list) do
+      ready_queue_id_list[i] = candidate_list[i]
+   end
+end
+local dequeued_job_list = {}
+local enqueue_time_list = {}
+local job_expiry_time = current_timestamp + job_expiry_interval
+for _, ready_queue_id in ipairs(ready_queue_id_list) do
    -- there is a queue ready to be dequeued.
-   local ready_queue_id = ready_queue_id_list[1]
    -- dequeue a job from the job queue.
    local job_id = redis.call('LPOP', prefix .. ':' .. queue_type .. ':' .. ready_queue_id)
-   -- get the payload for this job
-   local payload = redis.call('HGET', prefix .. ':payload', queue_type .. ':' .. ready_queue_id .. ':' .. job_id)
-   -- update the time keeper with the current dequeue time.
-   redis.call('PSETEX', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':time', job_expiry_interval, current_timestamp)
+   if job_id then
+      -- get the payload for this job
+      local payload = redis.call('HGET', prefix .. ':payload', queue_type .. ':' .. ready_queue_id .. ':' .. job_id)
+      -- update the time keeper with the current dequeue time.
+      redis.call('PSETEX', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':time', job_expiry_interval, current_timestamp)
+      -- finally, add the job_id and queue_id that was dequeued into the active sorted set.
+      redis.call('ZADD', prefix .. ':' .. queue_type .. ':active', job_expiry_time, ready_queue_id .. ':' .. job_id)
+      -- get the requeues_remaining for this job
+      local requeues_remaining
+      if latency_metrics > 0 then
+	 -- along with the enqueue time of the job.
+	 local job_details = redis.call('HMGET', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':requeues_remaining', job_id, job_id .. ':time')
+	 requeues_remaining = job_details[1]
+	 enqueue_time_list[#dequeued_job_list + 1] = tonumber(job_details[2])
+      else
+	 requeues_remaining = redis.call('HGET', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':requeues_remaining', job_id)
+      end
+      table.insert(dequeued_job_list, { ready_queue_id, job_id, payload, requeues_remaining })
+   end
+
    -- check if there are any more jobs of this queue in the job queue.
    if redis.call('LLEN', prefix .. ':' .. queue_type .. ':' .. ready_queue_id) == 0 then
       -- there are no more jobs of this queue. remove this queue from the ready sorted set.
       redis.call('ZREM', prefix .. ':' .. queue_type, ready_queue_id)
-      -- now check if the ready sorted set is empty.
-      if redis.call('EXISTS', prefix .. ':' .. queue_type) ~= 1 then
-	 -- the ready sorted set is empty. remove this 'queue_type' from
-	 -- the metris ready queue type set
-	 redis.call('SREM', prefix .. ':ready:queue_type', queue_type)
-      end
    else
       -- there are more jobs in the queue. update the next
       -- dequeue time for this queue in the ready sorted set.
@@ -47,39 +142,107 @@ if next(ready_queue_id_list) ~= nil then
       end
       redis.call('ZADD', prefix .. ':' .. queue_type, next_dequeue_time, ready_queue_id)
    end
-   local job_expiry_time = current_timestamp + job_expiry_interval
-   -- finally, add the job_id and queue_id that was dequeued into the active sorted set.
-   redis.call('ZADD', prefix .. ':' .. queue_type .. ':active', job_expiry_time, ready_queue_id .. ':' .. job_id)
-   -- add the queue_type to metrics active queue type set.
-   redis.call('SADD', prefix .. ':active:queue_type', queue_type)
-
-   -- get the requeues_remaining for this job
-   local requeues_remaining = redis.call('HGET', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':requeues_remaining', job_id)
-
-   -- update the metrics counters
-   -- update global counter.
-   local timestamp_minute = math.floor(current_timestamp/60000) * 60000 -- get the epoch for the minute
-   local expiry_time = math.floor((timestamp_minute + 600000) / 1000) -- store the data for 10 minutes.
-   if redis.call('EXISTS', prefix .. ':dequeue_counter:' .. timestamp_minute) ~= 1 then
-      -- counter does not exists. set the initial value and expiry.
-      redis.call('SET', prefix .. ':dequeue_counter:' .. timestamp_minute, 1)
-      redis.call('EXPIREAT', prefix .. ':dequeue_counter:' .. timestamp_minute, expiry_time)
-   else
-      -- counter already exists. just increment the value.
-      redis.call('INCR', prefix .. ':dequeue_counter:' .. timestamp_minute)
+end
+
+-- now check if the ready sorted set is empty.
+if next(ready_queue_id_list) ~= nil and redis.call('EXISTS', prefix .. ':' .. queue_type) ~= 1 then
+   -- the ready sorted set is empty. remove this 'queue_type' from
+   -- the metris ready queue type set
+   redis.call('SREM', prefix .. ':ready:queue_type', queue_type)
+end
+
+if next(dequeued_job_list) == nil then
+   return dequeued_job_list
+end
+
+-- add the queue_type to metrics active queue type set.
+redis.call('SADD', prefix .. ':active:queue_type', queue_type)
+
+-- update the number of queued and in flight jobs of the queue_type.
+redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'queued', -#dequeued_job_list)
+redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'in_flight', #dequeued_job_list)
+
+-- pass the wake up on to the next blocked consumer.
+if ARGV[13] == '1' and #redis.call('ZRANGEBYSCORE', prefix .. ':' .. queue_type, 0, current_timestamp, 'LIMIT', 0, 1) > 0 then
+   local notify_key = prefix .. ':' .. queue_type .. ':notify'
+   if redis.call('LLEN', notify_key) == 0 then
+      redis.call('RPUSH', notify_key, 1)
    end
+end
 
-   -- update the current queue counter.
-   if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':dequeue_counter:' .. timestamp_minute) ~= 1 then
-      -- counter does not exists. set the initial value and expiry.
-      redis.call('SET', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':dequeue_counter:' .. timestamp_minute, 1)
-      redis.call('EXPIREAT', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':dequeue_counter:' .. timestamp_minute, expiry_time)
-   else
-      -- counter already exists. just increment the value.
-      redis.call('INCR', prefix .. ':' .. queue_type .. ':' .. ready_queue_id .. ':dequeue_counter:' .. timestamp_minute)
+-- wake up the requeuer if these jobs expire before its next pass.
+local next_requeue_time = tonumber(redis.call('GET', prefix .. ':requeue:next'))
+if next_requeue_time and job_expiry_time < next_requeue_time then
+   -- the key expires along with the lease of the requeuer.
+   local ttl = redis.call('PTTL', prefix .. ':requeue:next')
+   if ttl > 0 then
+      redis.call('PSETEX', prefix .. ':requeue:next', ttl, job_expiry_time)
    end
+   -- a single pending token is enough, the requeuer reads the next
+   -- expiry time itself.
+   if redis.call('LLEN', prefix .. ':requeue:notify') == 0 then
+      redis.call('RPUSH', prefix .. ':requeue:notify', 1)
+   end
+end
 
-   return { ready_queue_id, job_id, payload, requeues_remaining }
-else
-   return { }
+-- update the metrics counters
+-- update global counter.
+local bucket_size = tonumber(ARGV[7]) or 60000
+local retention = tonumber(ARGV[8]) or 600000
+local queue_metrics_rate = tonumber(ARGV[9]) or 1
+local queue_type_metrics = ARGV[10] == '1'
+local timestamp_bucket = math.floor(current_timestamp / bucket_size) * bucket_size -- get the epoch for the bucket
+local expiry_time = math.floor((timestamp_bucket + retention) / 1000) -- store the data for the retention.
+redis.call('INCRBY', prefix .. ':dequeue_counter:' .. timestamp_bucket, #dequeued_job_list)
+redis.call('EXPIREAT', prefix .. ':dequeue_counter:' .. timestamp_bucket, expiry_time)
+
+-- update the wait time histograms.
+if latency_metrics > 0 then
+   -- the upper bounds of the latency buckets, in milliseconds.
+   local latency_bucket_list = { 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000 }
+   local observe = function(histogram_key, latency)
+      local latency_bucket = '+Inf'
+      for _, upper_bound in ipairs(latency_bucket_list) do
+	 if latency <= upper_bound then
+	    latency_bucket = upper_bound
+	    break
+	 end
+      end
+      redis.call('HINCRBY', histogram_key, latency_bucket, 1)
+      redis.call('HINCRBY', histogram_key, 'sum', latency)
+      redis.call('EXPIREAT', histogram_key, expiry_time)
+   end
+   for i, job in ipairs(dequeued_job_list) do
+      local job_time_key = prefix .. ':' .. queue_type .. ':' .. job[1] .. ':requeues_remaining'
+      local enqueue_time = enqueue_time_list[i]
+      if enqueue_time then
+	 local latency = math.max(current_timestamp - enqueue_time, 0)
+	 observe(prefix .. ':' .. queue_type .. ':wait_time:' .. timestamp_bucket, latency)
+	 if latency_metrics == 2 then
+	    observe(prefix .. ':' .. queue_type .. ':' .. job[1] .. ':wait_time:' .. timestamp_bucket, latency)
+	 end
+      end
+      redis.call('HSET', job_time_key, job[2] .. ':time', current_timestamp)
+   end
+end
+
+-- update the counter of the queue_type.
+if queue_type_metrics then
+   local counter_key = prefix .. ':' .. queue_type .. ':dequeue_counter:' .. timestamp_bucket
+   redis.call('INCRBY', counter_key, #dequeued_job_list)
+   redis.call('EXPIREAT', counter_key, expiry_time)
 end
+
+-- update the counter of every dequeued queue.
+if queue_metrics_rate > 0 then
+   math.randomseed(tonumber(ARGV[12]) or 0)
+   for _, job in ipairs(dequeued_job_list) do
+      if queue_metrics_rate >= 1 or math.random() < queue_metrics_rate then
+	 local counter_key = prefix .. ':' .. queue_type .. ':' .. job[1] .. ':dequeue_counter:' .. timestamp_bucket
+	 redis.call('INCRBY', counter_key, math.floor(1 / queue_metrics_rate + 0.5))
+	 redis.call('EXPIREAT', counter_key, expiry_time)
+      end
+   end
+end
+
+return dequeued_job_list
@@ -1,75 +1,149 @@
--- script to enqueue a job into sharq.
+-- script to enqueue one or more jobs into sharq.
 
 -- input:
 --     KEYS[1] - <key_prefix>
 --     KEYS[2] - <queue_type>
 --
 --     ARGV[1] - <current_timestamp>
---     ARGV[2] - <queue_id>
---     ARGV[3] - <job_id>
---     ARGV[4] - <serialized_payload>
---     ARGV[5] - <interval>
---     ARGV[6] - <requeue_limit>
+--     ARGV[2] - <metrics_bucket_size>
+--     ARGV[3] - <metrics_retention>
+--     ARGV[4] - <queue_metrics_rate>
+--     ARGV[5] - <queue_type_metrics>
+--     ARGV[6] - <latency_metrics>
+--     ARGV[7] - <random_seed>
+--     ARGV[8] - <queue_id>
+--     ARGV[9] - <job_id>
+--     ARGV[10] - <serialized_payload>
+--     ARGV[11] - <interval>
+--     ARGV[12] - <requeue_limit>
+--
+--     ARGV[8] to ARGV[12] can be repeated any number of times
+--     to enqueue a batch of jobs of the same queue_type.
+--
+--     the enqueues are counted in buckets of <metrics_bucket_size>
+--     milliseconds, kept for <metrics_retention> milliseconds. the
+--     global counter is always updated. the counter of every queue is
+--     updated with the probability of <queue_metrics_rate> (1 counts
+--     every queue, 0 none), by the count scaled up by its inverse. the
+--     counter of the queue_type is updated when <queue_type_metrics>
+--     is 1.
+--
+--     when <latency_metrics> is not 0, the enqueue time of every job is
+--     kept in the <job_id>:time field of its requeues_remaining hash,
+--     for dequeue.lua to measure the wait time of the job.
+--
+--     the enqueued jobs are added to the queued field of
+--     <key_prefix>:<queue_type>:stats, the number of jobs of the
+--     queue_type waiting to be dequeued.
 -- output:
 --     nil
+--
+--     every queue that gets added to the ready sorted set and is ready
+--     already pushes a token to the <key_prefix>:<queue_type>:notify
+--     list, which wakes up a consumer blocked on this queue_type. the
+--     list is topped up to one token per such queue only, so that it
+--     does not build up while no consumer is waiting. a queue which
+--     gets ready later wakes up nobody, the consumers wait for its
+--     ready time themselves.
 
 local prefix = KEYS[1]
 local queue_type = KEYS[2]
 
 local current_timestamp = ARGV[1]
-local queue_id = ARGV[2]
-local job_id = ARGV[3]
-local payload = ARGV[4]
-local interval = ARGV[5]
-local requeue_limit = ARGV[6]
-
--- push the job id into the job queue.
-redis.call('RPUSH', prefix .. ':' .. queue_type .. ':' .. queue_id, job_id)
-
--- update the payload map.
-redis.call('HSET', prefix .. ':payload', queue_type .. ':' .. queue_id .. ':' .. job_id, payload)
-
--- update the interval map.
-redis.call('HSET', prefix .. ':interval', queue_type .. ':' .. queue_id, interval)
-
--- update the requeue limit map.
-redis.call('HSET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id, requeue_limit)
-
--- check if the queue of this job is already present in the ready sorted set.
-if not redis.call('ZRANK', prefix .. ':' .. queue_type, queue_id) then
-   -- the ready sorted set is empty, update it and add it to metrics ready queue type set.
-   redis.call('SADD', prefix .. ':ready:queue_type', queue_type)
-   if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':time') ~= 1 then
-      -- time keeper does not exist
-      -- update the ready sorted set with current time as ready time.
-      redis.call('ZADD', prefix .. ':' .. queue_type, current_timestamp, queue_id)
+local bucket_size = tonumber(ARGV[2])
+local retention = tonumber(ARGV[3])
+local queue_metrics_rate = tonumber(ARGV[4])
+local queue_type_metrics = ARGV[5] == '1'
+local latency_metrics = tonumber(ARGV[6])
+
+-- number of jobs enqueued into each queue, used to
+-- update the metrics counters once for the whole batch.
+local job_count = 0
+local queue_job_count = {}
+local ready_queue_count = 0
+
+for i = 8, #ARGV, 5 do
+   local queue_id = ARGV[i]
+   local job_id = ARGV[i + 1]
+   local payload = ARGV[i + 2]
+   local interval = ARGV[i + 3]
+   local requeue_limit = ARGV[i + 4]
+
+   -- push the job id into the job queue.
+   redis.call('RPUSH', prefix .. ':' .. queue_type .. ':' .. queue_id, job_id)
+
+   -- update the payload map.
+   redis.call('HSET', prefix .. ':payload', queue_type .. ':' .. queue_id .. ':' .. job_id, payload)
+
+   -- update the interval map.
+   redis.call('HSET', prefix .. ':interval', queue_type .. ':' .. queue_id, interval)
+
+   -- update the requeue limit map.
+   if latency_metrics > 0 then
+      -- along with the enqueue time of the job.
+      redis.call('HMSET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id, requeue_limit, job_id .. ':time', current_timestamp)
    else
-      -- time keeper exists
-      local last_dequeue_time = redis.call('GET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':time')
-      local ready_time = interval + last_dequeue_time
-      redis.call('ZADD', prefix .. ':' .. queue_type, ready_time, queue_id)
+      redis.call('HSET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id, requeue_limit)
+   end
+
+   -- check if the queue of this job is already present in the ready sorted set.
+   if not redis.call('ZRANK', prefix .. ':' .. queue_type, queue_id) then
+      -- the ready sorted set is empty, update it and add it to metrics ready queue type set.
+      redis.call('SADD', prefix .. ':ready:queue_type', queue_type)
+      if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':time') ~= 1 then
+	 -- time keeper does not exist
+	 -- update the ready sorted set with current time as ready time.
+	 redis.call('ZADD', prefix .. ':' .. queue_type, current_timestamp, queue_id)
+	 ready_queue_count = ready_queue_count + 1
+      else
+	 -- time keeper exists
+	 local last_dequeue_time = redis.call('GET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':time')
+	 local ready_time = interval + last_dequeue_time
+	 redis.call('ZADD', prefix .. ':' .. queue_type, ready_time, queue_id)
+	 if ready_time <= tonumber(current_timestamp) then
+	    ready_queue_count = ready_queue_count + 1
+	 end
+      end
+   end
+
+   job_count = job_count + 1
+   queue_job_count[queue_id] = (queue_job_count[queue_id] or 0) + 1
+end
+
+-- update the number of queued jobs of the queue_type.
+redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'queued', job_count)
+
+if ready_queue_count > 0 then
+   -- notify the blocked consumers about the new ready queues, one token
+   -- per queue, counting the tokens which are pending already.
+   local notify_key = prefix .. ':' .. queue_type .. ':notify'
+   for i = redis.call('LLEN', notify_key) + 1, ready_queue_count do
+      redis.call('RPUSH', notify_key, 1)
    end
 end
 
 -- update the metrics counters
 -- update global counter.
-local timestamp_minute = math.floor(current_timestamp/60000) * 60000 -- get the epoch for the minute
-local expiry_time = math.floor((timestamp_minute + 600000) / 1000) -- store the data for 10 minutes.
-if redis.call('EXISTS', prefix .. ':enqueue_counter:' .. timestamp_minute) ~= 1 then
-   -- counter does not exists. set the initial value and expiry.
-   redis.call('SET', prefix .. ':enqueue_counter:' .. timestamp_minute, 1)
-   redis.call('EXPIREAT', prefix .. ':enqueue_counter:' .. timestamp_minute, expiry_time)
-else
-   -- counter already exists. just increment the value.
-   redis.call('INCR', prefix .. ':enqueue_counter:' .. timestamp_minute)
+local timestamp_bucket = math.floor(current_timestamp / bucket_size) * bucket_size -- get the epoch for the bucket
+local expiry_time = math.floor((timestamp_bucket + retention) / 1000) -- store the data for the retention.
+redis.call('INCRBY', prefix .. ':enqueue_counter:' .. timestamp_bucket, job_count)
+redis.call('EXPIREAT', prefix .. ':enqueue_counter:' .. timestamp_bucket, expiry_time)
+
+-- update the counter of the queue_type.
+if queue_type_metrics then
+   local counter_key = prefix .. ':' .. queue_type .. ':enqueue_counter:' .. timestamp_bucket
+   redis.call('INCRBY', counter_key, job_count)
+   redis.call('EXPIREAT', counter_key, expiry_time)
 end
 
--- update the current queue counter.
-if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':enqueue_counter:' .. timestamp_minute) ~= 1 then
-   -- counter does not exists. set the initial value and expiry.
-   redis.call('SET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':enqueue_counter:' .. timestamp_minute, 1)
-   redis.call('EXPIREAT', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':enqueue_counter:' .. timestamp_minute, expiry_time)
-else
-   -- counter already exists. just increment the value.
-   redis.call('INCR', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':enqueue_counter:' .. timestamp_minute)
+-- update the counter of every queue in this batch.
+if queue_metrics_rate > 0 then
+   math.randomseed(tonumber(ARGV[7]) or 0)
+   for queue_id, count in pairs(queue_job_count) do
+      if queue_metrics_rate >= 1 or math.random() < queue_metrics_rate then
+	 local counter_key = prefix .. ':' .. queue_type .. ':' .. queue_id .. ':enqueue_counter:' .. timestamp_bucket
+	 redis.call('INCRBY', counter_key, math.floor(count / queue_metrics_rate + 0.5))
+	 redis.call('EXPIREAT', counter_key, expiry_time)
+      end
+   end
 end
@@ -1,42 +1,106 @@
--- script to mark a job as completed (finished) successfully.
+-- script to mark one or more jobs as completed (finished) successfully.
 
 -- input:
 --     KEYS[1] - <key_prefix>
 --     KEYS[2] - <queue_type>
 --
---     ARGV[1] - <queue_id>
---     ARGV[2] - <job_id>
+--     ARGV[1] - <current_timestamp>
+--     ARGV[2] - <metrics_bucket_size>
+--     ARGV[3] - <metrics_retention>
+--     ARGV[4] - <latency_metrics>
+--     ARGV[5] - <queue_id>
+--     ARGV[6] - <job_id>
+--
+--     ARGV[5] and ARGV[6] can be repeated any number of times
+--     to finish a batch of jobs of the same queue_type.
+--
+--     when <latency_metrics> is not 0, the service time of every job
+--     (from its dequeue to now) is added to the histograms of the
+--     queue_type (and of the queue when it is 2), the same way as
+--     dequeue.lua adds the wait time.
+--         <key_prefix>:<queue_type>:service_time:<bucket>
+--         <key_prefix>:<queue_type>:<queue_id>:service_time:<bucket>
+--
+--     the finished jobs are taken off the in_flight field of
+--     <key_prefix>:<queue_type>:stats.
 -- output:
---     nil
+--     { 1 or 0, ... } - one entry per job, 0 when the job was not found.
 
 local prefix = KEYS[1]
 local queue_type = KEYS[2]
-local queue_id = ARGV[1]
-local job_id = ARGV[2]
 
+local current_timestamp = tonumber(ARGV[1])
+local latency_metrics = tonumber(ARGV[4])
+local observe
+if latency_metrics > 0 then
+   local bucket_size = tonumber(ARGV[2])
+   local timestamp_bucket = math.floor(current_timestamp / bucket_size) * bucket_size -- get the epoch for the bucket
+   local expiry_time = math.floor((timestamp_bucket + tonumber(ARGV[3])) / 1000) -- store the data for the retention.
+   -- the upper bounds of the latency buckets, in milliseconds.
+   local latency_bucket_list = { 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000 }
+   observe = function(histogram_key, latency)
+      histogram_key = histogram_key .. ':service_time:' .. timestamp_bucket
+      local latency_bucket = '+Inf'
+      for _, upper_bound in ipairs(latency_bucket_list) do
+	 if latency <= upper_bound then
+	    latency_bucket = upper_bound
+	    break
+	 end
+      end
+      redis.call('HINCRBY', histogram_key, latency_bucket, 1)
+      redis.call('HINCRBY', histogram_key, 'sum', latency)
+      redis.call('EXPIREAT', histogram_key, expiry_time)
+   end
+end
+
+local finish_response = {}
+local finished_job_count = 0
+for i = 5, #ARGV, 2 do
+   local queue_id = ARGV[i]
+   local job_id = ARGV[i + 1]
+
+   -- remove the job from active sorted set.
+   local response = redis.call('ZREM', prefix .. ':' .. queue_type .. ':active', queue_id .. ':' .. job_id)
+   if response ~= 1 then
+      -- the job was not found in the active sorted set. Non existent job or
+      -- the job is expired and was requeued back.
+      table.insert(finish_response, 0)
+   else
+      -- delete the payload related to this job from the payload map.
+      redis.call('HDEL', prefix .. ':payload', queue_type .. ':' .. queue_id .. ':' .. job_id)
+      if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':' .. queue_id) ~= 1 then
+	 -- there are no more jobs in this queue. we can safely delete the interval.
+	 redis.call('HDEL', prefix .. ':interval', queue_type .. ':' .. queue_id)
+      end
 
--- remove the job from active sorted set.
-local response = redis.call('ZREM', prefix .. ':' .. queue_type .. ':active', queue_id .. ':' .. job_id)
-if response ~= 1 then
-   -- the job was not found in the active sorted set. Non existent job or
-   -- the job is expired and was requeued back.
-   return 0
+      if latency_metrics > 0 then
+	 local dequeue_time = tonumber(redis.call('HGET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id .. ':time'))
+	 if dequeue_time then
+	    local latency = math.max(current_timestamp - dequeue_time, 0)
+	    observe(prefix .. ':' .. queue_type, latency)
+	    if latency_metrics == 2 then
+	       observe(prefix .. ':' .. queue_type .. ':' .. queue_id, latency)
+	    end
+	 end
+      end
+
+      -- delete the requeues_remaining, attempts and time entries for this job.
+      redis.call('HDEL', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id, job_id .. ':attempts', job_id .. ':time')
+      table.insert(finish_response, 1)
+      finished_job_count = finished_job_count + 1
+   end
+end
+
+-- update the number of in flight jobs of the queue_type.
+if finished_job_count > 0 then
+   redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'in_flight', -finished_job_count)
 end
 
--- check if the just-removed job was the last job in the active sorted set.
+-- check if the just-removed jobs were the last jobs in the active sorted set.
 if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':active') ~= 1 then
-   -- yes. this was the last job. remove this queue_type
+   -- yes. these were the last jobs. remove this queue_type
    -- from the metrics active queue type set.
    redis.call('SREM', prefix .. ':active:queue_type', queue_type)
 end
--- delete the payload related to this job from the payload map.
-redis.call('HDEL', prefix .. ':payload', queue_type .. ':' .. queue_id .. ':' .. job_id)
-if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':' .. queue_id) ~= 1 then
-   -- there are no more jobs in this queue. we can safely delete the interval.
-   redis.call('HDEL', prefix .. ':interval', queue_type .. ':' .. queue_id)
-end
-
--- delete the requeues_remaining entry for this job.
-redis.call('HDEL', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id)
 
-return 1
+return finish_response
@@ -0,0 +1,23 @@
+-- script to finish a job and dequeue the next job of the same queue_type.
+
+-- the finish and dequeue scripts are prepended to this script as the
+-- `finish` and `dequeue` functions when the scripts are loaded, so
+-- both run back to back in a single script call.
+
+-- input:
+--     KEYS[1] - <key_prefix>
+--     KEYS[2] - <queue_type>
+--
+--     ARGV[1] to ARGV[6] - the arguments of the finish script,
+--         for the job to finish.
+--     ARGV[7] onwards - the arguments of the dequeue script.
+-- output:
+--     { finish_response, dequeue_response }
+
+local finish_args = { ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6] }
+local dequeue_args = {}
+for i = 7, #ARGV do
+   table.insert(dequeue_args, ARGV[i])
+end
+
+return { finish(KEYS, finish_args), dequeue(KEYS, dequeue_args) }
@@ -0,0 +1,33 @@
+-- script to acquire, renew or release a lease, which elects a
+-- single leader among many processes.
+
+-- input:
+--     KEYS[1] - <lease_key>
+--
+--     ARGV[1] - <owner>
+--     ARGV[2] - <lease_interval> (0 releases the lease)
+--
+-- output:
+--     1 if the owner holds the lease after the call, 0 otherwise.
+
+local lease_key = KEYS[1]
+local owner = ARGV[1]
+local lease_interval = tonumber(ARGV[2])
+
+local current_owner = redis.call('GET', lease_key)
+if current_owner and current_owner ~= owner then
+   -- the lease is held by someone else.
+   return 0
+end
+
+if lease_interval == 0 then
+   -- release the lease, if it is held by this owner.
+   if current_owner then
+      redis.call('DEL', lease_key)
+   end
+   return 0
+end
+
+-- acquire a free lease or renew the lease held by this owner.
+redis.call('SET', lease_key, owner, 'PX', lease_interval)
+return 1
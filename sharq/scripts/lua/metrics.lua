@@ -1,23 +1,40 @@
--- script to return a sliding window of rates over the past 10 mins.
+-- script to return a sliding window of rates over the retention.
 
 -- input:
 --     KEYS[1] - <key_prefix>
 --
 --     ARGV[1] - <current_timestamp>
+--     ARGV[2] - <metrics_bucket_size>
+--     ARGV[3] - <metrics_retention>
 -- output:
 --     { enqueue_response, dequeue_response }
+--
+--     every response is a flat list of the start of every bucket
+--     and its counter, latest first. all the counters are read
+--     with a single MGET.
+
+local bucket_size = tonumber(ARGV[2])
+local bucket_count = math.floor(tonumber(ARGV[3]) / bucket_size)
+local timestamp_bucket = math.floor(ARGV[1] / bucket_size) * bucket_size -- get the epoch for the bucket
+local bucket_list = {}
+local counter_key_list = {}
+for i = 1, bucket_count do
+   bucket_list[i] = timestamp_bucket
+   counter_key_list[i] = KEYS[1] .. ':enqueue_counter:' .. timestamp_bucket
+   counter_key_list[bucket_count + i] = KEYS[1] .. ':dequeue_counter:' .. timestamp_bucket
+   timestamp_bucket = timestamp_bucket - bucket_size
+end
 
 local enqueue_response = {}
 local dequeue_response = {}
-local timestamp_minute = math.floor(ARGV[1]/60000) * 60000 -- get the epoch for the minute
-for i=0, 9 do
-   local enqueue_counter_value = redis.call('GET', KEYS[1] .. ':enqueue_counter:' .. timestamp_minute)
-   local dequeue_counter_value = redis.call('GET', KEYS[1] .. ':dequeue_counter:' .. timestamp_minute)
-   table.insert(enqueue_response, timestamp_minute)
-   table.insert(enqueue_response, enqueue_counter_value)
-   table.insert(dequeue_response, timestamp_minute)
-   table.insert(dequeue_response, dequeue_counter_value)
-   timestamp_minute = timestamp_minute - 60000
+if bucket_count > 0 then
+   local counter_value_list = redis.call('MGET', unpack(counter_key_list))
+   for i = 1, bucket_count do
+      table.insert(enqueue_response, bucket_list[i])
+      table.insert(enqueue_response, counter_value_list[i])
+      table.insert(dequeue_response, bucket_list[i])
+      table.insert(dequeue_response, counter_value_list[bucket_count + i])
+   end
 end
 
 return { enqueue_response, dequeue_response }
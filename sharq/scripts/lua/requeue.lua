@@ -5,17 +5,95 @@
 --     KEYS[2] - <queue_type>
 --
 --     ARGV[1] - <current_timestamp>
+--     ARGV[2] - <delay> (optional, defaults to 0)
+--     ARGV[3] - <batch_size> (optional, 0 requeues all expired jobs)
+--     ARGV[4] - <dead_letter> (optional, 1 keeps the discarded jobs)
+--     ARGV[5] - <retry_base_delay> (optional, 0 disables the backoff)
+--     ARGV[6] - <retry_multiplier>
+--     ARGV[7] - <retry_max_delay>
+--     ARGV[8] - <retry_jitter>
+--     ARGV[9] - <random_seed>
+--     ARGV[10] - <queue_id>:<job_id> (optional)
+--
+--     at most <batch_size> expired jobs are requeued in one call, so
+--     that a large backlog of expired jobs does not block redis for
+--     long. the caller keeps calling until no expired job remains.
+--
+--     ARGV[10] can be repeated any number of times. when given, only
+--     these jobs are requeued (if they are active), whether they have
+--     expired or not. this is used to release jobs before they expire.
+--     the requeued jobs do not get ready before <delay> milliseconds.
+--
+--     with a <retry_base_delay>, the attempts of every job are counted
+--     in the <job_id>:attempts field of its requeues_remaining hash.
+--     a job requeued for the n-th time does not get ready before
+--         min(<retry_base_delay> * <retry_multiplier> ^ (n - 1), <retry_max_delay>)
+--     milliseconds, reduced by a random fraction of up to <retry_jitter>,
+--     so that the retries of jobs which failed together spread out.
+--     the backoff delays the ready time of the whole queue, as a
+--     requeued job goes to the front of its job queue. so when other
+--     jobs wait in the queue, a backed off job goes behind them instead,
+--     and is retried after them rather than after its backoff.
+--
+--     the wait time of a requeued job, measured when the latency
+--     metrics are enabled, starts over from the requeue.
+--
+--     the jobs which have no requeues remaining are discarded, which
+--     cleans them up the same way as finish.lua does. when <dead_letter>
+--     is 1, the discarded jobs are moved to the dead letter store of the
+--     queue_type instead,
+--         <key_prefix>:<queue_type>:dead - sorted set of
+--             <queue_id>:<job_id>, scored by the discard time.
+--         <key_prefix>:<queue_type>:dead:job - hash of
+--             <queue_id>:<job_id> to msgpack { payload, interval }.
+--
+--     the requeued and discarded jobs are counted in the requeued and
+--     discarded fields of <key_prefix>:<queue_type>:stats, which only
+--     grow. both are taken off its in_flight field, and the requeued
+--     jobs are added to its queued field.
+--
+--     every requeued job which makes its queue ready right away pushes
+--     a token to the <key_prefix>:<queue_type>:notify list, which wakes
+--     up a consumer blocked on this queue_type. as in enqueue.lua, the
+--     list is topped up to one token per such queue only.
 --
 -- output:
---     {} or job_discard_list
+--     { requeued_job_count, discarded_job_count, remaining_job_count }
+--
+--     remaining_job_count is the number of expired jobs left to be
+--     requeued.
 
 local prefix = KEYS[1]
 local queue_type = KEYS[2]
 local current_timestamp = ARGV[1]
+local delay = tonumber(ARGV[2]) or 0
+local batch_size = tonumber(ARGV[3]) or 0
+local dead_letter = ARGV[4] == '1'
+local retry_base_delay = tonumber(ARGV[5]) or 0
+local retry_multiplier = tonumber(ARGV[6]) or 1
+local retry_max_delay = tonumber(ARGV[7]) or 0
+local retry_jitter = tonumber(ARGV[8]) or 0
+math.randomseed(tonumber(ARGV[9]) or 0)
 
--- check if any of the jobs need to be retried
-local requeue_job_list = redis.call('ZRANGEBYSCORE', prefix .. ':' .. queue_type .. ':active', 0, current_timestamp)
-local job_discard_list = {}
+local requeue_job_list = {}
+if #ARGV > 9 then
+   -- requeue only the given jobs, if they are still active.
+   for i = 10, #ARGV do
+      if redis.call('ZSCORE', prefix .. ':' .. queue_type .. ':active', ARGV[i]) then
+	 table.insert(requeue_job_list, ARGV[i])
+      end
+   end
+else
+   -- check if any of the jobs need to be retried
+   if batch_size > 0 then
+      requeue_job_list = redis.call('ZRANGEBYSCORE', prefix .. ':' .. queue_type .. ':active', 0, current_timestamp, 'LIMIT', 0, batch_size)
+   else
+      requeue_job_list = redis.call('ZRANGEBYSCORE', prefix .. ':' .. queue_type .. ':active', 0, current_timestamp)
+   end
+end
+local requeued_job_count = 0
+local discarded_job_count = 0
+local ready_queue_count = 0
 -- iterate over each job and requeue it.
 for _, job in pairs(requeue_job_list) do
    local requeue = true
@@ -25,21 +103,59 @@ for _, job in pairs(requeue_job_list) do
    if requeues_remaining and tonumber(requeues_remaining) > -1 then
       -- finite requeues_remaining. decrement by one and check.
       requeues_remaining = requeues_remaining - 1
-      -- update the new requeues_remaining value.
-      redis.call('HSET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id, requeues_remaining)
-      if requeues_remaining == -1 then
-         -- discard this job
-	 table.insert(job_discard_list, job)
+      if requeues_remaining > -1 then
+	 -- update the new requeues_remaining value.
+	 redis.call('HSET', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id, requeues_remaining)
+      else
+	 if dead_letter then
+	    -- keep the job in the dead letter store.
+	    local payload = redis.call('HGET', prefix .. ':payload', queue_type .. ':' .. queue_id .. ':' .. job_id)
+	    local interval = tonumber(redis.call('HGET', prefix .. ':interval', queue_type .. ':' .. queue_id)) or 0
+	    if payload then
+	       redis.call('ZADD', prefix .. ':' .. queue_type .. ':dead', current_timestamp, job)
+	       redis.call('HSET', prefix .. ':' .. queue_type .. ':dead:job', job, cmsgpack.pack({ payload, interval }))
+	    end
+	 end
+         -- discard this job. delete its payload and requeues_remaining.
+	 redis.call('HDEL', prefix .. ':payload', queue_type .. ':' .. queue_id .. ':' .. job_id)
+	 redis.call('HDEL', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id, job_id .. ':attempts', job_id .. ':time')
+	 if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':' .. queue_id) ~= 1 then
+	    -- there are no more jobs in this queue. we can safely delete the interval.
+	    redis.call('HDEL', prefix .. ':interval', queue_type .. ':' .. queue_id)
+	 end
+	 discarded_job_count = discarded_job_count + 1
          -- using these flags as Lua doesn't support 'continue'
 	 requeue = false
       end
    end
    if requeue == true then
-       -- enqueue the job at the front of the job queue
+       local job_delay = delay
+       if retry_base_delay > 0 then
+	  -- back off exponentially with the number of attempts.
+	  local attempts = redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining', job_id .. ':attempts', 1)
+	  local backoff = math.min(retry_base_delay * math.pow(retry_multiplier, attempts - 1), retry_max_delay)
+	  backoff = backoff - backoff * retry_jitter * math.random()
+	  job_delay = math.max(delay, math.floor(backoff))
+       end
+       -- the wait time of the job starts over, if it is measured.
+       local job_time_key = prefix .. ':' .. queue_type .. ':' .. queue_id .. ':requeues_remaining'
+       if redis.call('HEXISTS', job_time_key, job_id .. ':time') == 1 then
+	  redis.call('HSET', job_time_key, job_id .. ':time', current_timestamp)
+       end
        local job_queue_key = prefix .. ':' .. queue_type .. ':' .. queue_id
-       redis.call('LPUSH', job_queue_key, job_id)
+       local job_queue_length = redis.call('LLEN', job_queue_key)
+       if retry_base_delay > 0 and job_queue_length > 0 then
+	  -- enqueue the job behind the other jobs of the queue, so that
+	  -- its backoff does not hold them up.
+	  redis.call('RPUSH', job_queue_key, job_id)
+	  job_delay = delay
+       else
+	  -- enqueue the job at the front of the job queue
+	  redis.call('LPUSH', job_queue_key, job_id)
+       end
+       requeued_job_count = requeued_job_count + 1
        -- check if this is the only job in the job queue
-       if redis.call('LLEN', job_queue_key) == 1 then
+       if job_queue_length == 0 then
 	  -- default when time keeper does not exist. next ready time is now.
 	  local next_ready_time = current_timestamp
 	  -- check if the time keeper exists
@@ -51,18 +167,58 @@ for _, job in pairs(requeue_job_list) do
 		next_ready_time = last_dequeue_time + interval
 	     end
 	  end
+	  -- the job is not ready before the delay.
+	  next_ready_time = math.max(next_ready_time, current_timestamp + job_delay)
 	  -- insert this queue into the ready sorted set.
 	  redis.call('ZADD', prefix .. ':' .. queue_type, next_ready_time, queue_id)
 	  redis.call('SADD', prefix .. ':ready:queue_type', queue_type)
-       end
-       -- remove this queue_id & job_id from active sorted set.
-       redis.call('ZREM', prefix .. ':' .. queue_type .. ':active', queue_id .. ':' .. job_id)
-       -- check if the removed queue_id was the last item in this active set.
-       if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':active') ~= 1 then
-	  -- the active set does not exist. remove it from the metrics active queue type set.
-	  redis.call('SREM', prefix .. ':active:queue_type', queue_type)
+	  -- wake up a consumer blocked on this queue_type, if the queue is
+	  -- ready already.
+	  if next_ready_time <= tonumber(current_timestamp) then
+	     ready_queue_count = ready_queue_count + 1
+	  end
+       elseif job_delay > 0 then
+	  -- the queue is already in the ready sorted set. as the job is at
+	  -- the front of the job queue, push the ready time of the queue
+	  -- back until the delay has passed.
+	  local ready_time = tonumber(redis.call('ZSCORE', prefix .. ':' .. queue_type, queue_id))
+	  if not ready_time or ready_time < current_timestamp + job_delay then
+	     redis.call('ZADD', prefix .. ':' .. queue_type, current_timestamp + job_delay, queue_id)
+	  end
        end
    end
+   -- remove this queue_id & job_id from active sorted set.
+   redis.call('ZREM', prefix .. ':' .. queue_type .. ':active', queue_id .. ':' .. job_id)
+end
+
+if ready_queue_count > 0 then
+   local notify_key = prefix .. ':' .. queue_type .. ':notify'
+   for i = redis.call('LLEN', notify_key) + 1, ready_queue_count do
+      redis.call('RPUSH', notify_key, 1)
+   end
+end
+
+-- update the counters of the queue_type.
+if requeued_job_count > 0 then
+   redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'requeued', requeued_job_count)
+   redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'queued', requeued_job_count)
+end
+if discarded_job_count > 0 then
+   redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'discarded', discarded_job_count)
+end
+if requeued_job_count + discarded_job_count > 0 then
+   redis.call('HINCRBY', prefix .. ':' .. queue_type .. ':stats', 'in_flight', -(requeued_job_count + discarded_job_count))
+end
+
+-- check if the removed jobs were the last items in this active set.
+if redis.call('EXISTS', prefix .. ':' .. queue_type .. ':active') ~= 1 then
+   -- the active set does not exist. remove it from the metrics active queue type set.
+   redis.call('SREM', prefix .. ':active:queue_type', queue_type)
+end
+
+local remaining_job_count = 0
+if #ARGV <= 9 then
+   remaining_job_count = redis.call('ZCOUNT', prefix .. ':' .. queue_type .. ':active', 0, current_timestamp)
 end
 
-return job_discard_list
+return { requeued_job_count, discarded_job_count, remaining_job_count }
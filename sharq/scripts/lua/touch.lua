@@ -0,0 +1,40 @@
+-- script to extend the lease of one or more dequeued jobs.
+
+-- input:
+--     KEYS[1] - <key_prefix>
+--     KEYS[2] - <queue_type>
+--
+--     ARGV[1] - <current_timestamp>
+--     ARGV[2] - <extend_interval>
+--     ARGV[3] - <queue_id>
+--     ARGV[4] - <job_id>
+--
+--     ARGV[3] and ARGV[4] can be repeated any number of times
+--     to extend the lease of a batch of jobs of the same queue_type.
+-- output:
+--     { 1 or 0, ... } - one entry per job, 0 when the job is not active.
+
+local prefix = KEYS[1]
+local queue_type = KEYS[2]
+local current_timestamp = ARGV[1]
+local extend_interval = ARGV[2]
+
+local job_expiry_time = current_timestamp + extend_interval
+local touch_response = {}
+for i = 3, #ARGV, 2 do
+   local job = ARGV[i] .. ':' .. ARGV[i + 1]
+   local current_expiry_time = redis.call('ZSCORE', prefix .. ':' .. queue_type .. ':active', job)
+   if not current_expiry_time then
+      -- the job is not active. Non existent job or the job
+      -- is expired and was requeued back.
+      table.insert(touch_response, 0)
+   else
+      -- only ever move the expiry time of the job forward.
+      if job_expiry_time > tonumber(current_expiry_time) then
+	 redis.call('ZADD', prefix .. ':' .. queue_type .. ':active', job_expiry_time, job)
+      end
+      table.insert(touch_response, 1)
+   end
+end
+
+return touch_response
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from sharq.utils import is_valid_identifier, is_valid_interval
+from sharq.exceptions import BadArgumentException
+
+logger = logging.getLogger(__name__)
+
+# pools in which the handler of a worker can be run.
+#   thread  - a pool of threads, suited for I/O bound handlers.
+#   process - a pool of processes, suited for CPU bound handlers. the
+#             handler and the job payloads should be picklable.
+WORKER_EXECUTORS = ('thread', 'process')
+
+# milliseconds the worker waits before it dequeues again,
+# after a dequeue failed (e.g. redis could not be reached).
+ERROR_BACKOFF_INTERVAL = 1000
+
+
+class Worker(object):
+    """A Worker runs a handler on the jobs of a queue_type. It does
+    the following.
+
+        1. Dequeues jobs in batches, as many as there are free slots
+           in the pool, blocking on SharQ while no job is ready.
+        2. Runs the handler on every job in a thread or process pool.
+        3. Finishes the job when the handler returns, and releases it
+           back into its queue when the handler raises. A failed
+           dequeue is logged and retried after ERROR_BACKOFF_INTERVAL.
+        4. Extends the lease of the running jobs periodically, so that
+           long running jobs do not get requeued.
+        5. Stops dequeuing on `stop` (or SIGINT / SIGTERM once the
+           signal handlers are installed), and waits for the running
+           jobs to complete before `run` returns.
+
+    The handler is called with the dequeued job, which is the response
+    of `SharQ.dequeue`.
+    """
+
+    def __init__(self, sharq, handler, queue_type='default', concurrency=4,
+                 executor='thread', batch_size=None, dequeue_timeout=1000,
+                 heartbeat_interval=None, release_delay_ms=0):
+        """Construct a Worker.
+            * sharq - the SharQ object to work with.
+            * handler - the callable which processes a job.
+            * concurrency - the number of jobs processed in parallel.
+            * executor - one of `WORKER_EXECUTORS`.
+            * batch_size - the maximum number of jobs dequeued in one
+              call, defaults to the concurrency.
+            * dequeue_timeout - milliseconds a dequeue blocks for,
+              which bounds the time taken by a stop to be noticed.
+            * heartbeat_interval - milliseconds between two lease
+              extensions, defaults to a third of the job_expire_interval.
+            * release_delay_ms - delay of the release of a failed job.
+        """
+        if not is_valid_identifier(queue_type):
+            raise BadArgumentException('`queue_type` has an invalid value.')
+
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise BadArgumentException('`concurrency` has an invalid value.')
+
+        if executor not in WORKER_EXECUTORS:
+            raise BadArgumentException('`executor` has an invalid value.')
+
+        if batch_size is None:
+            batch_size = concurrency
+
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise BadArgumentException('`batch_size` has an invalid value.')
+
+        if not is_valid_interval(dequeue_timeout):
+            raise BadArgumentException(
+                '`dequeue_timeout` has an invalid value.')
+
+        if heartbeat_interval is None:
+            heartbeat_interval = max(sharq._job_expire_interval // 3, 1)
+
+        if not is_valid_interval(heartbeat_interval) or heartbeat_interval < 1:
+            raise BadArgumentException(
+                '`heartbeat_interval` has an invalid value.')
+
+        if not is_valid_interval(release_delay_ms):
+            raise BadArgumentException(
+                '`release_delay_ms` has an invalid value.')
+
+        self._sharq = sharq
+        self._handler = handler
+        self._queue_type = queue_type
+        self._concurrency = concurrency
+        self._executor_type = executor
+        self._batch_size = batch_size
+        self._dequeue_timeout = dequeue_timeout
+        self._heartbeat_interval = heartbeat_interval
+        self._release_delay_ms = release_delay_ms
+
+        # the jobs being processed, keyed by (queue_id, job_id).
+        self._running_jobs = {}
+        self._running_jobs_changed = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def _create_executor(self):
+        if self._executor_type == 'process':
+            return ProcessPoolExecutor(max_workers=self._concurrency)
+        return ThreadPoolExecutor(max_workers=self._concurrency)
+
+    def install_signal_handlers(self):
+        """Stops the worker gracefully on SIGINT and SIGTERM. Has
+        to be called from the main thread.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: self.stop())
+
+    def stop(self):
+        """Asks the worker to stop. The running jobs are completed
+        before `run` returns.
+        """
+        self._stop_event.set()
+        with self._running_jobs_changed:
+            self._running_jobs_changed.notify_all()
+
+    def run(self):
+        """Processes the jobs until the worker is stopped."""
+        executor = self._create_executor()
+        # the heartbeat runs until the running jobs complete,
+        # which is after the worker is stopped.
+        heartbeat_stop_event = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(heartbeat_stop_event,))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            while not self._stop_event.is_set():
+                free_slots = self._wait_for_free_slots()
+                if not free_slots:
+                    continue
+
+                try:
+                    jobs = self._sharq.dequeue_many(
+                        queue_type=self._queue_type,
+                        count=min(free_slots, self._batch_size),
+                        timeout=self._dequeue_timeout)
+                    for job in jobs:
+                        self._submit(executor, job)
+                except Exception:
+                    # the worker keeps running, the dequeued jobs which
+                    # could not be submitted get requeued once their
+                    # lease expires.
+                    logger.exception('could not dequeue the jobs')
+                    self._stop_event.wait(ERROR_BACKOFF_INTERVAL / 1000.0)
+        finally:
+            # the done callbacks finish / release the running
+            # jobs before the shutdown returns.
+            executor.shutdown(wait=True)
+            heartbeat_stop_event.set()
+            heartbeat.join()
+
+    def _wait_for_free_slots(self):
+        """Waits until the pool has a free slot and returns the
+        number of free slots, or 0 if the worker is stopped.
+        """
+        with self._running_jobs_changed:
+            while (len(self._running_jobs) >= self._concurrency and
+                   not self._stop_event.is_set()):
+                self._running_jobs_changed.wait()
+
+            if self._stop_event.is_set():
+                return 0
+            return self._concurrency - len(self._running_jobs)
+
+    def _submit(self, executor, job):
+        with self._running_jobs_changed:
+            self._running_jobs[(job['queue_id'], job['job_id'])] = job
+
+        future = executor.submit(self._handler, job)
+        future.add_done_callback(
+            lambda future: self._on_job_done(job, future))
+
+    def _on_job_done(self, job, future):
+        """Finishes the job if the handler succeeded, and
+        releases it otherwise.
+        """
+        try:
+            exception = future.exception()
+            if exception is None:
+                self._sharq.finish(
+                    job_id=job['job_id'],
+                    queue_id=job['queue_id'],
+                    queue_type=self._queue_type
+                )
+            else:
+                logger.error(
+                    'job %s of queue %s failed: %r', job['job_id'],
+                    job['queue_id'], exception)
+                self._sharq.release(
+                    job_id=job['job_id'],
+                    queue_id=job['queue_id'],
+                    queue_type=self._queue_type,
+                    delay_ms=self._release_delay_ms
+                )
+        except Exception:
+            # the job gets requeued once its lease expires.
+            logger.exception(
+                'could not acknowledge job %s of queue %s', job['job_id'],
+                job['queue_id'])
+        finally:
+            with self._running_jobs_changed:
+                self._running_jobs.pop((job['queue_id'], job['job_id']), None)
+                self._running_jobs_changed.notify_all()
+
+    def _heartbeat(self, stop_event):
+        """Extends the lease of the running jobs every
+        heartbeat_interval until the stop_event is set.
+        """
+        while not stop_event.wait(self._heartbeat_interval / 1000.0):
+            with self._running_jobs_changed:
+                running_jobs = list(self._running_jobs)
+            if not running_jobs:
+                continue
+
+            try:
+                self._sharq.touch_many([
+                    (self._queue_type, queue_id, job_id)
+                    for queue_id, job_id in running_jobs])
+            except Exception:
+                logger.exception('could not extend the lease of the jobs')
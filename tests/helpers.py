@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+"""Helpers shared by the test cases of the worker, the requeuer
+and the exporter.
+"""
+import time
+import uuid
+
+
+def enqueue_jobs(sharq, queue_type, count, requeue_limit=None):
+    """Enqueues a job into each of `count` queues of the queue_type,
+    named queue-0, queue-1, ..., and returns the jobs. The payload of
+    every job holds the number of its queue.
+    """
+    jobs = [{
+        'payload': {'number': i},
+        'interval': 0,
+        'job_id': str(uuid.uuid4()),
+        'queue_id': 'queue-%d' % i,
+        'queue_type': queue_type,
+        'requeue_limit': requeue_limit
+    } for i in range(count)]
+    sharq.enqueue_many(jobs)
+    return jobs
+
+
+def wait_until(test_case, condition, timeout=10):
+    """Polls the condition until it holds, for up to `timeout`
+    seconds, and fails the test case if it does not.
+    """
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    test_case.assertTrue(condition())
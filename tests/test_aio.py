@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+import os
+import uuid
+import array
+import asyncio
+import unittest
+from sharq import SharQ
+from sharq.aio import AsyncSharQ, aioredis
+from sharq.exceptions import BadArgumentException
+from sharq.instrumentation import HistogramRecorder
+
+
+@unittest.skipIf(aioredis is None, 'redis-py 4.3 or above is not installed.')
+class AsyncSharQTestCase(unittest.TestCase):
+    """
+    `AsyncSharQTestCase` contains the functional test cases
+    that validate the asyncio client of SharQ.
+    """
+
+    def setUp(self):
+        cwd = os.path.dirname(os.path.realpath(__file__))
+        config_path = os.path.join(cwd, 'sharq.test.conf')  # test config
+        self.queue = AsyncSharQ(config_path)
+        self.sync_queue = SharQ(config_path)
+        # flush all the keys in the test db before starting test
+        self.sync_queue._r.flushdb()
+        # test specific values
+        self._test_queue_id = 'johndoe'
+        self._test_queue_type = 'sms'
+        self._test_payload_1 = {
+            'to': '1000000000',
+            'message': 'Hello, world'
+        }
+
+    def tearDown(self):
+        self.sync_queue._r.flushdb()
+
+    def _get_job_id(self):
+        """Generates a uuid4 and returns the string
+        representation of it.
+        """
+        return str(uuid.uuid4())
+
+    def _run(self, coroutine):
+        """Runs the coroutine with a fresh connection pool, as
+        the pool is bound to the event loop it was used in.
+        """
+        async def run():
+            try:
+                return await coroutine
+            finally:
+                await self.queue.close()
+        return asyncio.run(run())
+
+    def test_enqueue_dequeue_finish(self):
+        job_id = self._get_job_id()
+        response = self._run(self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['status'], 'queued')
+
+        response = self._run(self.queue.dequeue(
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['job_id'], job_id)
+        self.assertEqual(response['queue_id'], self._test_queue_id)
+        self.assertEqual(response['payload'], self._test_payload_1)
+
+        response = self._run(self.queue.finish(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(
+            self.sync_queue.get_queue_length(
+                self._test_queue_type, self._test_queue_id), 0)
+
+    def test_shares_queues_with_sync_client(self):
+        job_id = self._get_job_id()
+        self.sync_queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type)
+
+        response = self._run(self.queue.dequeue(
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['job_id'], job_id)
+
+        response = self.sync_queue.finish(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type)
+        self.assertEqual(response['status'], 'success')
+
+    def test_enqueue_many_dequeue_many(self):
+        jobs = [{
+            'payload': self._test_payload_1,
+            'interval': 10000,
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(3)]
+        responses = self._run(self.queue.enqueue_many(jobs))
+        self.assertEqual([r['status'] for r in responses], ['queued'] * 3)
+
+        dequeued_jobs = self._run(self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=5))
+        self.assertEqual(
+            sorted(job['job_id'] for job in dequeued_jobs),
+            sorted(job['job_id'] for job in jobs))
+
+        responses = self._run(self.queue.finish_many([
+            (self._test_queue_type, job['queue_id'], job['job_id'])
+            for job in dequeued_jobs]))
+        self.assertEqual([r['status'] for r in responses], ['success'] * 3)
+
+    def test_dequeue_timeout(self):
+        async def dequeue_and_enqueue():
+            dequeue = asyncio.ensure_future(self.queue.dequeue(
+                queue_type=self._test_queue_type, timeout=3000))
+            await asyncio.sleep(0.2)
+            await self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,
+                job_id=job_id,
+                queue_id=self._test_queue_id,
+                queue_type=self._test_queue_type)
+            return await dequeue
+
+        job_id = self._get_job_id()
+        response = self._run(dequeue_and_enqueue())
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['job_id'], job_id)
+
+        response = self._run(self.queue.dequeue(
+            queue_type=self._test_queue_type, timeout=100))
+        self.assertEqual(response['status'], 'failure')
+
+    def test_touch_release_requeue(self):
+        job_id = self._get_job_id()
+        self._run(self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            requeue_limit=1))
+        self._run(self.queue.dequeue(queue_type=self._test_queue_type))
+
+        response = self._run(self.queue.touch(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['status'], 'success')
+
+        response = self._run(self.queue.release(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self.assertEqual(response, {'status': 'success', 'discarded': False})
+
+        response = self._run(self.queue.dequeue(
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['job_id'], job_id)
+        self.assertEqual(response['requeues_remaining'], 0)
+
+        self._run(self.queue.requeue())
+        response = self._run(self.queue.release(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self.assertEqual(response, {'status': 'success', 'discarded': True})
+
+    def test_interval_and_metrics(self):
+        self._run(self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,
+            job_id=self._get_job_id(),
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+
+        response = self._run(self.queue.interval(
+            interval=5000,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['status'], 'success')
+
+        response = self._run(self.queue.metrics())
+        self.assertEqual(response['queue_types'], [self._test_queue_type])
+        self.assertEqual(sum(response['enqueue_counts'].values()), 1)
+
+        response = self._run(self.queue.metrics(
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['queue_ids'], [self._test_queue_id])
+        self.assertEqual(response['queued'], 1)
+        self.assertEqual(
+            self._run(self.queue.get_queue_type_stats(self._test_queue_type)),
+            {'queued': 1, 'in_flight': 0, 'requeued': 0, 'discarded': 0})
+
+        response = self._run(self.queue.metrics(
+            queue_type=self._test_queue_type, queue_id=self._test_queue_id))
+        self.assertEqual(response['queue_length'], 1)
+
+    def test_metrics_many(self):
+        for i in range(3):
+            self.sync_queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,
+                job_id=self._get_job_id(),
+                queue_id='queue-%d' % (i % 2),
+                queue_type=self._test_queue_type)
+
+        queue_ids = ['queue-0', 'queue-1', 'queue-2']
+        self.assertEqual(
+            self._run(self.queue.get_queue_lengths(
+                self._test_queue_type, queue_ids, batch_size=2)),
+            array.array('q', [2, 1, 0]))
+        response = self._run(self.queue.metrics_many(
+            self._test_queue_type, queue_ids, batch_size=2))
+        self.assertEqual(response['queue_lengths'], array.array('q', [2, 1, 0]))
+        self.assertEqual(
+            [sum(counts[i] for counts in response['enqueue_counts'].values())
+             for i in range(3)], [2, 1, 0])
+
+    def test_iter_queue_ids(self):
+        for i in range(12):
+            self.sync_queue.enqueue(
+                payload=self._test_payload_1,
+                interval=0,
+                job_id=self._get_job_id(),
+                queue_id='queue-%d' % (i % 6),
+                queue_type=self._test_queue_type)
+        self.sync_queue.dequeue_many(queue_type=self._test_queue_type, count=3)
+
+        async def iter_queue_ids(count_only):
+            return [page async for page in self.queue.iter_queue_ids(
+                self._test_queue_type, page_size=2, count_only=count_only)]
+        queue_ids = [queue_id for page in self._run(iter_queue_ids(False))
+                     for queue_id in page]
+        self.assertEqual(
+            sorted(queue_ids), sorted('queue-%d' % i for i in range(6)))
+        self.assertEqual(sum(self._run(iter_queue_ids(True))), 6)
+
+    def test_latency_metrics(self):
+        self.queue._config.set('sharq', 'latency_metrics', 'queue')
+        job_id = self._get_job_id()
+        self._run(self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self._run(self.queue.dequeue(queue_type=self._test_queue_type))
+        self._run(self.queue.finish(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+
+        response = self._run(self.queue.metrics(
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['wait_time']['count'], 1)
+        self.assertEqual(response['service_time']['count'], 1)
+        response = self._run(self.queue.metrics(
+            queue_type=self._test_queue_type, queue_id=self._test_queue_id))
+        self.assertEqual(response['service_time']['count'], 1)
+
+    def test_instrumentation(self):
+        recorder = HistogramRecorder()
+        self.queue.set_recorder(recorder)
+        self._run(self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=self._get_job_id(),
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self._run(self.queue.dequeue(queue_type=self._test_queue_type))
+
+        snapshot = recorder.snapshot()
+        self.assertEqual(
+            sorted(snapshot['enqueue']),
+            ['lua_enqueue', 'serialize', 'total', 'validate'])
+        self.assertEqual(snapshot['dequeue']['lua_dequeue']['count'], 1)
+        self.assertTrue(snapshot['dequeue']['total']['sum'] >=
+                        snapshot['dequeue']['lua_dequeue']['sum'])
+        self.assertNotIn('dequeue_many', snapshot)
+
+    def test_dead_letters(self):
+        self.queue._config.add_section('sharq:%s' % self._test_queue_type)
+        self.queue._config.set(
+            'sharq:%s' % self._test_queue_type, 'dead_letter', 'true')
+        job_id = self._get_job_id()
+        self._run(self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            requeue_limit=0))
+        self._run(self.queue.dequeue(queue_type=self._test_queue_type))
+        response = self._run(self.queue.release(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type))
+        self.assertEqual(response, {'status': 'success', 'discarded': True})
+
+        response = self._run(self.queue.get_dead_letters(
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['total'], 1)
+        self.assertEqual(
+            response['dead_letters'][0]['payload'], self._test_payload_1)
+
+        async def replay():
+            return [response async for response in
+                    self.queue.replay_dead_letters(
+                        queue_type=self._test_queue_type)]
+        self.assertEqual(
+            self._run(replay()), [{'status': 'queued', 'job_id': job_id}])
+        response = self._run(self.queue.get_dead_letters(
+            queue_type=self._test_queue_type))
+        self.assertEqual(response['total'], 0)
+
+    def test_invalid_arguments(self):
+        self.assertRaisesRegex(
+            BadArgumentException, '`count` has an invalid value.',
+            self._run, self.queue.dequeue_many(count=0))
+        self.assertRaisesRegex(
+            BadArgumentException, '`job_id` has an invalid value.',
+            self._run, self.queue.finish(
+                job_id='$#', queue_id=self._test_queue_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
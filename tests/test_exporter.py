@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+import os
+import unittest
+from sharq import SharQ
+from sharq.exporter import Exporter, CONTENT_TYPE
+from tests.helpers import enqueue_jobs
+
+
+class ExporterTestCase(unittest.TestCase):
+    """
+    `ExporterTestCase` contains the functional test cases
+    that validate the OpenMetrics exporter of SharQ.
+    """
+
+    def setUp(self):
+        cwd = os.path.dirname(os.path.realpath(__file__))
+        config_path = os.path.join(cwd, 'sharq.test.conf')  # test config
+        self.queue = SharQ(config_path)
+        # flush all the keys in the test db before starting test
+        self.queue._r.flushdb()
+        self.exporter = Exporter(self.queue)
+
+    def tearDown(self):
+        self.queue._r.flushdb()
+
+    def _expire_jobs(self, queue_type):
+        active_key = '%s:%s:active' % (self.queue._key_prefix, queue_type)
+        for member in self.queue._r.zrange(active_key, 0, -1):
+            self.queue._r.zadd(active_key, {member: 1})
+
+    def _get_samples(self):
+        """Renders the metrics and returns a dict of every sample
+        line to its value.
+        """
+        text = self.exporter.render()
+        self.assertTrue(text.endswith('# EOF\n'))
+        samples = {}
+        for line in text.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_exporter_renders_queue_state(self):
+        enqueue_jobs(self.queue, 'sms', 3)
+        enqueue_jobs(self.queue, 'call', 2, requeue_limit=0)
+        self.queue.dequeue_many(queue_type='sms', count=2)
+        self.queue.dequeue_many(queue_type='call', count=2)
+        self._expire_jobs('call')
+
+        samples = self._get_samples()
+        self.assertEqual(samples['sharq_ready_queues{queue_type="sms"}'], 1)
+        self.assertEqual(samples['sharq_due_queues{queue_type="sms"}'], 1)
+        self.assertEqual(samples['sharq_queued_jobs{queue_type="sms"}'], 1)
+        self.assertEqual(samples['sharq_in_flight_jobs{queue_type="sms"}'], 2)
+        self.assertEqual(samples['sharq_expired_jobs{queue_type="sms"}'], 0)
+        self.assertEqual(samples['sharq_expired_jobs{queue_type="call"}'], 2)
+        self.assertEqual(samples['sharq_enqueue_rate'], 0)
+        # the queue type rates are only exported when they are kept.
+        self.assertNotIn(
+            'sharq_queue_type_enqueue_rate{queue_type="sms"}', samples)
+
+        self.queue.requeue()
+        samples = self._get_samples()
+        self.assertEqual(
+            samples['sharq_discarded_jobs_total{queue_type="sms"}'], 0)
+        self.assertEqual(
+            samples['sharq_requeued_jobs_total{queue_type="sms"}'], 0)
+        # the call jobs have no requeues, and are discarded.
+        self.assertNotIn(
+            'sharq_discarded_jobs_total{queue_type="call"}', samples)
+        self.assertEqual(int(self.queue._r.hget(
+            '%s:call:stats' % self.queue._key_prefix, 'discarded')), 2)
+
+    def test_exporter_requeue_counters(self):
+        enqueue_jobs(self.queue, 'sms', 3)
+        self.queue.dequeue_many(queue_type='sms', count=3)
+        self._expire_jobs('sms')
+        self.queue.requeue()
+
+        samples = self._get_samples()
+        self.assertEqual(
+            samples['sharq_requeued_jobs_total{queue_type="sms"}'], 3)
+        self.assertEqual(
+            samples['sharq_discarded_jobs_total{queue_type="sms"}'], 0)
+        self.assertEqual(samples['sharq_in_flight_jobs{queue_type="sms"}'], 0)
+        self.assertEqual(samples['sharq_ready_queues{queue_type="sms"}'], 3)
+        self.assertEqual(samples['sharq_queued_jobs{queue_type="sms"}'], 3)
+
+    def test_exporter_reads_in_two_round_trips(self):
+        # many queues of a few queue types.
+        enqueue_jobs(self.queue, 'sms', 200)
+        enqueue_jobs(self.queue, 'call', 100)
+        self.queue.dequeue_many(queue_type='sms', count=50)
+
+        self.queue._r.config_resetstat()
+        self._get_samples()
+        command_stats = self.queue._r.info('commandstats')
+        self.assertEqual(command_stats['cmdstat_exec']['calls'], 2)
+        # a fixed number of commands per queue type.
+        self.assertEqual(command_stats['cmdstat_zcard']['calls'], 6)
+        self.assertNotIn('cmdstat_llen', command_stats)
+
+    def test_exporter_wsgi_app(self):
+        enqueue_jobs(self.queue, 'sms', 1)
+        statuses = []
+
+        def start_response(status, headers):
+            statuses.append((status, dict(headers)))
+
+        body = b''.join(self.exporter.wsgi_app(
+            {'PATH_INFO': '/metrics'}, start_response))
+        status, headers = statuses[0]
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], CONTENT_TYPE)
+        self.assertIn(b'# TYPE sharq_requeued_jobs counter\n', body)
+        self.assertIn(b'sharq_ready_queues{queue_type="sms"} 1\n', body)
+
+        self.exporter.wsgi_app({'PATH_INFO': '/'}, start_response)
+        self.assertEqual(statuses[1][0], '404 Not Found')
+
+
+if __name__ == '__main__':
+    unittest.main()
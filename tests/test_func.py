@@ -2,12 +2,14 @@
 # Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
 import os
 import uuid
+import array
 import time
 import math
 import unittest
+import threading
 import msgpack
 from sharq import SharQ
-from sharq.utils import generate_epoch
+from sharq.utils import generate_epoch, deserialize_payload
 
 
 class SharQTestCase(unittest.TestCase):
@@ -687,6 +689,80 @@ class SharQTestCase(unittest.TestCase):
             '%s:active:queue_type' % self.queue._key_prefix)
         self.assertEqual(len(queue_type_ready_set), 0)
 
+    def test_enqueue_many_response_status(self):
+        job_id_1 = self._get_job_id()
+        job_id_2 = self._get_job_id()
+        response = self.queue.enqueue_many([
+            {
+                'payload': self._test_payload_1,
+                'interval': 10000,  # 10s (10000ms)
+                'job_id': job_id_1,
+                'queue_id': self._test_queue_id,
+                'queue_type': self._test_queue_type
+            },
+            {
+                'payload': self._test_payload_2,
+                'interval': 10000,  # 10s (10000ms)
+                'job_id': job_id_2,
+                'queue_id': self._test2_queue_id,
+                'queue_type': self._test2_queue_type
+            }
+        ])
+        self.assertEqual(response, [
+            {'status': 'queued', 'job_id': job_id_1},
+            {'status': 'queued', 'job_id': job_id_2}
+        ])
+
+    def test_enqueue_many_job_queue_order(self):
+        job_ids = [self._get_job_id() for _ in range(5)]
+        self.queue.enqueue_many([
+            {
+                'payload': self._test_payload_1,
+                'interval': 10000,  # 10s (10000ms)
+                'job_id': job_id,
+                'queue_id': self._test_queue_id,
+                'queue_type': self._test_queue_type
+            } for job_id in job_ids
+        ], batch_size=2)
+
+        queue_name = '%s:%s:%s' % (
+            self.queue._key_prefix,
+            self._test_queue_type,
+            self._test_queue_id
+        )
+        queued_job_ids = self.queue._r.lrange(queue_name, 0, -1)
+        self.assertEqual(
+            [job_id.decode('utf-8') for job_id in queued_job_ids], job_ids)
+
+        # the first job is dequeued first with its own payload.
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_ids[0])
+        self.assertEqual(response['payload'], self._test_payload_1)
+
+    def test_enqueue_many_metrics_enqueue_counter(self):
+        self.queue.enqueue_many([
+            {
+                'payload': self._test_payload_1,
+                'interval': 10000,  # 10s (10000ms)
+                'job_id': self._get_job_id(),
+                'queue_id': queue_id,
+                'queue_type': self._test_queue_type
+            } for queue_id in [self._test_queue_id] * 3 + [
+                self._test2_queue_id]
+        ])
+        timestamp = int(generate_epoch())
+        # epoch for the minute.
+        timestamp_minute = str(int(math.floor(timestamp / 60000.0) * 60000))
+        counter_value = self.queue._r.get('%s:enqueue_counter:%s' % (
+            self.queue._key_prefix, timestamp_minute))
+        self.assertEqual(int(counter_value), 4)
+        counter_value = self.queue._r.get('%s:%s:%s:enqueue_counter:%s' % (
+            self.queue._key_prefix,
+            self._test_queue_type,
+            self._test_queue_id,
+            timestamp_minute))
+        self.assertEqual(int(counter_value), 3)
+
     def test_dequeue_response_status_failure(self):
         response = self.queue.dequeue(
             queue_type=self._test_queue_type
@@ -943,6 +1019,256 @@ class SharQTestCase(unittest.TestCase):
             timestamp_minute))
         self.assertEqual(counter_value, '1')
 
+    def test_dequeue_many_on_empty_queue(self):
+        response = self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=10)
+        self.assertEqual(response, [])
+
+    def test_dequeue_many_distinct_queues(self):
+        job_id_1 = self._get_job_id()
+        job_id_2 = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id_1,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        self.queue.enqueue(
+            payload=self._test_payload_2,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id_2,
+            queue_id=self._test2_queue_id,
+            queue_type=self._test_queue_type,
+        )
+
+        response = self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=10)
+        self.assertEqual(len(response), 2)
+        jobs = dict((job['job_id'], job) for job in response)
+        self.assertEqual(jobs[job_id_1]['queue_id'], self._test_queue_id)
+        self.assertEqual(jobs[job_id_1]['payload'], self._test_payload_1)
+        self.assertEqual(jobs[job_id_2]['queue_id'], self._test2_queue_id)
+        self.assertEqual(jobs[job_id_2]['payload'], self._test_payload_2)
+
+        # both the jobs should be in the active sorted set.
+        active_jobs = self.queue._r.zrange('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type), 0, -1)
+        self.assertEqual(len(active_jobs), 2)
+
+        timestamp = int(generate_epoch())
+        # epoch for the minute.
+        timestamp_minute = str(int(math.floor(timestamp / 60000.0) * 60000))
+        counter_value = self.queue._r.get('%s:dequeue_counter:%s' % (
+            self.queue._key_prefix, timestamp_minute))
+        self.assertEqual(int(counter_value), 2)
+
+    def test_dequeue_many_respects_interval(self):
+        job_id_1 = self._get_job_id()
+        job_id_2 = self._get_job_id()
+        for job_id in [job_id_1, job_id_2]:
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,  # 10s (10000ms)
+                job_id=job_id,
+                queue_id=self._test_queue_id,
+                queue_type=self._test_queue_type,
+            )
+
+        # only one job of a queue can be dequeued per interval.
+        response = self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=10)
+        self.assertEqual(len(response), 1)
+        self.assertEqual(response[0]['job_id'], job_id_1)
+
+        # the queue is ready again only after the interval.
+        ready_time = self.queue._r.zscore('%s:%s' % (
+            self.queue._key_prefix, self._test_queue_type),
+            self._test_queue_id)
+        self.assertTrue(ready_time >= generate_epoch() + 9000)
+
+        response = self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=10)
+        self.assertEqual(response, [])
+
+    def test_dequeue_timeout_on_empty_queue(self):
+        start_time = generate_epoch()
+        response = self.queue.dequeue(
+            queue_type=self._test_queue_type, timeout=1500)
+        self.assertEqual(response['status'], 'failure')
+        self.assertTrue(generate_epoch() - start_time >= 1500)
+
+    def test_dequeue_timeout_wakes_up_on_enqueue(self):
+        job_id = self._get_job_id()
+
+        def enqueue_job():
+            time.sleep(1)
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,  # 10s (10000ms)
+                job_id=job_id,
+                queue_id=self._test_queue_id,
+                queue_type=self._test_queue_type,
+            )
+
+        thread = threading.Thread(target=enqueue_job)
+        thread.start()
+        start_time = generate_epoch()
+        response = self.queue.dequeue(
+            queue_type=self._test_queue_type, timeout=10000)
+        thread.join()
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['job_id'], job_id)
+        self.assertTrue(generate_epoch() - start_time < 5000)
+
+    def test_dequeue_timeout_wakes_up_all_consumers(self):
+        responses = []
+
+        def dequeue():
+            response = self.queue.dequeue(
+                queue_type=self._test_queue_type, timeout=10000)
+            responses.append((response, generate_epoch()))
+
+        threads = [threading.Thread(target=dequeue) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        # let the consumers block.
+        time.sleep(1.5)
+        enqueue_time = generate_epoch()
+        self.queue.enqueue_many([{
+            'payload': self._test_payload_1,
+            'interval': 10000,  # 10s (10000ms)
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(3)])
+        for thread in threads:
+            thread.join()
+
+        # every consumer gets a job right after the enqueue, well
+        # before the end of its blocking call.
+        self.assertEqual(
+            sorted(response['queue_id'] for response, _ in responses),
+            ['queue-0', 'queue-1', 'queue-2'])
+        for _, return_time in responses:
+            self.assertTrue(return_time - enqueue_time < 500)
+
+    def test_dequeue_timeout_waits_for_interval(self):
+        job_id_1 = self._get_job_id()
+        job_id_2 = self._get_job_id()
+        for job_id in [job_id_1, job_id_2]:
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=1500,  # 1.5s (1500ms)
+                job_id=job_id,
+                queue_id=self._test_queue_id,
+                queue_type=self._test_queue_type,
+            )
+
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_id_1)
+
+        # the second job gets ready only after the interval.
+        start_time = generate_epoch()
+        response = self.queue.dequeue(
+            queue_type=self._test_queue_type, timeout=5000)
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['job_id'], job_id_2)
+        self.assertTrue(generate_epoch() - start_time >= 1000)
+
+    def test_enqueue_notify_token(self):
+        notify_key = '%s:%s:notify' % (
+            self.queue._key_prefix, self._test_queue_type)
+        job_id = self._get_job_id()
+        for i in range(3):
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,  # 10s (10000ms)
+                job_id=job_id if i == 0 else self._get_job_id(),
+                queue_id='queue-%d' % i,
+                queue_type=self._test_queue_type,
+            )
+        # every call tops the tokens up to its own ready queues only.
+        self.assertEqual(self.queue._r.llen(notify_key), 1)
+
+        # a batch leaves a token per ready queue.
+        self.queue.enqueue_many([{
+            'payload': self._test_payload_1,
+            'interval': 10000,  # 10s (10000ms)
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(3, 6)])
+        self.assertEqual(self.queue._r.llen(notify_key), 3)
+
+        # a dequeue after a wake up passes it on, while ready queues
+        # remain.
+        self.queue._r.delete(notify_key)
+        jobs = self.queue._dequeue_many(
+            self._test_queue_type, 1, 'earliest', notify=True)
+        self.assertEqual(jobs[0]['job_id'], job_id)
+        self.assertEqual(self.queue._r.llen(notify_key), 1)
+        self.queue._r.delete(notify_key)
+        self.queue.dequeue_many(queue_type=self._test_queue_type, count=5)
+        self.assertEqual(self.queue._r.llen(notify_key), 0)
+
+        # the queue gets ready only after its interval, which does not
+        # wake up a consumer.
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=self._get_job_id(),
+            queue_id='queue-0',
+            queue_type=self._test_queue_type,
+        )
+        self.assertEqual(self.queue._r.llen(notify_key), 0)
+
+    def test_dequeue_strategy_backlog(self):
+        # the second queue has the larger backlog, even though
+        # the first queue has been ready for longer.
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=self._get_job_id(),
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        time.sleep(0.01)
+        for _ in range(3):
+            self.queue.enqueue(
+                payload=self._test_payload_2,
+                interval=10000,  # 10s (10000ms)
+                job_id=self._get_job_id(),
+                queue_id=self._test2_queue_id,
+                queue_type=self._test_queue_type,
+            )
+
+        response = self.queue.dequeue(
+            queue_type=self._test_queue_type, strategy='backlog')
+        self.assertEqual(response['queue_id'], self._test2_queue_id)
+
+        response = self.queue.dequeue(
+            queue_type=self._test_queue_type, strategy='earliest')
+        self.assertEqual(response['queue_id'], self._test_queue_id)
+
+    def test_dequeue_strategy_random(self):
+        queue_ids = ['queue%d' % i for i in range(5)]
+        for queue_id in queue_ids:
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,  # 10s (10000ms)
+                job_id=self._get_job_id(),
+                queue_id=queue_id,
+                queue_type=self._test_queue_type,
+            )
+
+        response = self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=3, strategy='random')
+        self.assertEqual(len(response), 3)
+        dequeued_queue_ids = set(job['queue_id'] for job in response)
+        self.assertEqual(len(dequeued_queue_ids), 3)
+        self.assertTrue(dequeued_queue_ids.issubset(queue_ids))
+
     def test_finish_on_empty_queue(self):
         job_id = self._get_job_id()
         response = self.queue.finish(
@@ -1206,6 +1532,156 @@ class SharQTestCase(unittest.TestCase):
             '%s:active:queue_type' % self.queue._key_prefix)
         self.assertEqual(len(queue_type_active_set), 0)
 
+    def test_finish_many_response_status(self):
+        job_ids = [self._get_job_id() for _ in range(3)]
+        queue_ids = [self._test_queue_id, self._test2_queue_id, 'janedoe']
+        for job_id, queue_id in zip(job_ids, queue_ids):
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,  # 10s (10000ms)
+                job_id=job_id,
+                queue_id=queue_id,
+                queue_type=self._test_queue_type,
+            )
+        jobs = self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=2)
+        dequeued_jobs = [(job['job_id'], job['queue_id']) for job in jobs]
+        queued_jobs = [
+            job for job in zip(job_ids, queue_ids) if job not in dequeued_jobs
+        ]
+
+        # the last job was never dequeued and cannot be finished.
+        response = self.queue.finish_many([
+            (self._test_queue_type, queue_id, job_id)
+            for job_id, queue_id in dequeued_jobs + queued_jobs
+        ], batch_size=2)
+        self.assertEqual(response, [
+            {'status': 'success'},
+            {'status': 'success'},
+            {'status': 'failure'}
+        ])
+
+        # the finished jobs are cleaned up.
+        payload_map_name = '%s:payload' % (self.queue._key_prefix)
+        for job_id, queue_id in dequeued_jobs:
+            job_payload_key = '%s:%s:%s' % (
+                self._test_queue_type, queue_id, job_id)
+            self.assertFalse(
+                self.queue._r.hexists(payload_map_name, job_payload_key))
+        self.assertFalse(self.queue._r.exists('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type)))
+        self.assertEqual(len(self.queue._r.smembers(
+            '%s:active:queue_type' % self.queue._key_prefix)), 0)
+
+    def test_finish_and_dequeue_next_job(self):
+        job_id_1 = self._get_job_id()
+        job_id_2 = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id_1,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        self.queue.enqueue(
+            payload=self._test_payload_2,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id_2,
+            queue_id=self._test2_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_id_1)
+
+        response = self.queue.finish_and_dequeue(
+            job_id=job_id_1,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type
+        )
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['next_job']['status'], 'success')
+        self.assertEqual(response['next_job']['job_id'], job_id_2)
+        self.assertEqual(response['next_job']['payload'], self._test_payload_2)
+
+        # only the next job is active now.
+        active_jobs = self.queue._r.zrange('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type), 0, -1)
+        self.assertEqual(active_jobs, [
+            ('%s:%s' % (self._test2_queue_id, job_id_2)).encode('utf-8')])
+
+        response = self.queue.finish_and_dequeue(
+            job_id=job_id_2,
+            queue_id=self._test2_queue_id,
+            queue_type=self._test_queue_type
+        )
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['next_job'], {'status': 'failure'})
+
+    def test_touch_extends_lease(self):
+        job_id = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        self.queue.dequeue(queue_type=self._test_queue_type)
+
+        active_set = '%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type)
+        job = '%s:%s' % (self._test_queue_id, job_id)
+        expiry_time = self.queue._r.zscore(active_set, job)
+
+        # extend the lease well past the job expiry interval.
+        response = self.queue.touch(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            extend_ms=60000
+        )
+        self.assertEqual(response['status'], 'success')
+        self.assertTrue(
+            self.queue._r.zscore(active_set, job) >= expiry_time + 50000)
+
+        # a shorter extension never moves the expiry time back.
+        response = self.queue.touch(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            extend_ms=1000
+        )
+        self.assertEqual(response['status'], 'success')
+        self.assertTrue(
+            self.queue._r.zscore(active_set, job) >= expiry_time + 50000)
+
+        # the job is not requeued once the original lease expires.
+        time.sleep(self.queue._job_expire_interval / 1000.00)
+        self.queue.requeue()
+        self.assertEqual(self.queue._r.zrange(active_set, 0, -1),
+                         [job.encode('utf-8')])
+
+    def test_touch_many_response_status(self):
+        job_id_1 = self._get_job_id()
+        job_id_2 = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id_1,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        self.queue.dequeue(queue_type=self._test_queue_type)
+
+        response = self.queue.touch_many([
+            (self._test_queue_type, self._test_queue_id, job_id_1),
+            (self._test_queue_type, self._test_queue_id, job_id_2)
+        ])
+        self.assertEqual(response, [
+            {'status': 'success'},
+            {'status': 'failure'}
+        ])
+
     def test_requeue_active_sorted_set(self):
         job_id = self._get_job_id()
         response = self.queue.enqueue(
@@ -1428,6 +1904,503 @@ class SharQTestCase(unittest.TestCase):
         # wait until the job expires
         time.sleep(self.queue._job_expire_interval / 1000.00)
 
+    def test_requeue_in_batches(self):
+        jobs = [{
+            'payload': self._test_payload_1,
+            'interval': 10000,  # 10s (10000ms)
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(5)]
+        self.queue.enqueue_many(jobs)
+        self.queue.dequeue_many(queue_type=self._test_queue_type, count=5)
+
+        # expire all the jobs right away.
+        active_set = '%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type)
+        for member in self.queue._r.zrange(active_set, 0, -1):
+            self.queue._r.zadd(active_set, {member: 1})
+
+        # a chunk requeues at most batch_size jobs, and
+        # returns the number of expired jobs remaining.
+        requeued_job_count, discarded_job_count, remaining_job_count = \
+            self.queue._lua_requeue(
+                keys=[self.queue._key_prefix, self._test_queue_type],
+                args=[str(generate_epoch()), 0, 2])
+        self.assertEqual(requeued_job_count, 2)
+        self.assertEqual(discarded_job_count, 0)
+        self.assertEqual(remaining_job_count, 3)
+
+        # requeue loops until no expired job remains.
+        response = self.queue.requeue(batch_size=2)
+        self.assertEqual(
+            response, {'status': 'success', 'requeued': 3, 'discarded': 0})
+        self.assertFalse(self.queue._r.exists(active_set))
+        self.assertEqual(self.queue._r.zcard('%s:%s' % (
+            self.queue._key_prefix, self._test_queue_type)), 5)
+
+    def test_requeue_queue_types_in_parallel(self):
+        queue_types = ['type-%d' % i for i in range(6)]
+        jobs = [{
+            'payload': self._test_payload_1,
+            'interval': 10000,  # 10s (10000ms)
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': queue_type
+        } for queue_type in queue_types for i in range(3)]
+        self.queue.enqueue_many(jobs)
+        for queue_type in queue_types:
+            self.queue.dequeue_many(queue_type=queue_type, count=3)
+            # expire all the jobs right away.
+            active_set = '%s:%s:active' % (self.queue._key_prefix, queue_type)
+            for member in self.queue._r.zrange(active_set, 0, -1):
+                self.queue._r.zadd(active_set, {member: 1})
+
+        response = self.queue.requeue(batch_size=2, concurrency=4)
+        self.assertEqual(
+            response, {'status': 'success', 'requeued': 18, 'discarded': 0})
+        for queue_type in queue_types:
+            self.assertEqual(self.queue._r.zcard('%s:%s' % (
+                self.queue._key_prefix, queue_type)), 3)
+        self.assertFalse(self.queue._r.exists(
+            '%s:active:queue_type' % self.queue._key_prefix))
+
+    def test_requeue_lanes(self):
+        queue_types = ['a-%d' % i for i in range(5)] + ['b-0']
+        self.assertEqual(
+            self.queue._get_requeue_lanes(queue_types, 2),
+            [['a-0', 'a-2', 'a-4'], ['a-1', 'a-3', 'b-0']])
+        # never more lanes than queue_types.
+        self.assertEqual(
+            self.queue._get_requeue_lanes(['b-0', 'a-0'], 4),
+            [['a-0'], ['b-0']])
+        self.assertEqual(self.queue._get_requeue_lanes([], 4), [])
+
+    def test_requeue_discards_exhausted_jobs(self):
+        jobs = [{
+            'payload': self._test_payload_1,
+            'interval': 10000,  # 10s (10000ms)
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type,
+            'requeue_limit': self._test_requeue_limit_0 if i < 3 else None
+        } for i in range(4)]
+        self.queue.enqueue_many(jobs)
+        self.queue.dequeue_many(queue_type=self._test_queue_type, count=4)
+
+        # expire all the jobs right away.
+        active_set = '%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type)
+        for member in self.queue._r.zrange(active_set, 0, -1):
+            self.queue._r.zadd(active_set, {member: 1})
+
+        response = self.queue.requeue(batch_size=2)
+        self.assertEqual(
+            response, {'status': 'success', 'requeued': 1, 'discarded': 3})
+
+        # the discarded jobs are cleaned up like a finish.
+        self.assertFalse(self.queue._r.exists(active_set))
+        payload_map_name = '%s:payload' % self.queue._key_prefix
+        self.assertEqual(self.queue._r.hkeys(payload_map_name), [
+            ('%s:queue-3:%s' % (
+                self._test_queue_type, jobs[3]['job_id'])).encode('utf-8')])
+        interval_map_name = '%s:interval' % self.queue._key_prefix
+        self.assertEqual(self.queue._r.hkeys(interval_map_name), [
+            ('%s:queue-3' % self._test_queue_type).encode('utf-8')])
+        for job in jobs[:3]:
+            self.assertFalse(self.queue._r.exists(
+                '%s:%s:%s:requeues_remaining' % (
+                    self.queue._key_prefix, self._test_queue_type,
+                    job['queue_id'])))
+        self.assertEqual(
+            self.queue._r.smembers(
+                '%s:active:queue_type' % self.queue._key_prefix), set())
+
+    def test_release_requeues_job_at_front(self):
+        job_id_1 = self._get_job_id()
+        job_id_2 = self._get_job_id()
+        for job_id in [job_id_1, job_id_2]:
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=0,
+                job_id=job_id,
+                queue_id=self._test_queue_id,
+                queue_type=self._test_queue_type,
+                requeue_limit=self._test_requeue_limit_5
+            )
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_id_1)
+
+        response = self.queue.release(
+            job_id=job_id_1,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type
+        )
+        self.assertEqual(response, {'status': 'success', 'discarded': False})
+        self.assertFalse(self.queue._r.exists('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type)))
+
+        # the released job is dequeued again, before the second job.
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_id_1)
+        self.assertEqual(
+            response['requeues_remaining'], self._test_requeue_limit_5 - 1)
+
+        # a job can only be released while it is active.
+        self.queue.finish(
+            job_id=job_id_1,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type
+        )
+        response = self.queue.release(
+            job_id=job_id_1,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type
+        )
+        self.assertEqual(response, {'status': 'failure'})
+
+    def test_release_with_delay(self):
+        job_id = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        response = self.queue.release(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            delay_ms=1000
+        )
+        self.assertEqual(response['status'], 'success')
+
+        # the job is not ready until the delay has passed.
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['status'], 'failure')
+        time.sleep(1)
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_id)
+
+    def test_release_discards_exhausted_job(self):
+        job_id = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            requeue_limit=self._test_requeue_limit_0
+        )
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        response = self.queue.release(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type
+        )
+        self.assertEqual(response, {'status': 'success', 'discarded': True})
+
+        payload_map_name = '%s:payload' % (self.queue._key_prefix)
+        job_payload_key = '%s:%s:%s' % (
+            self._test_queue_type, self._test_queue_id, job_id)
+        self.assertFalse(
+            self.queue._r.hexists(payload_map_name, job_payload_key))
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['status'], 'failure')
+
+    def _enable_retry_backoff(self, queue_type, **options):
+        section = 'sharq:%s' % queue_type
+        self.queue._config.add_section(section)
+        for option, value in options.items():
+            self.queue._config.set(section, option, str(value))
+
+    def test_release_with_retry_backoff(self):
+        self._enable_retry_backoff(
+            self._test_queue_type, retry_base_delay=1000,
+            retry_multiplier=2, retry_max_delay=3000)
+        job_id = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            requeue_limit=self._test_requeue_limit_5
+        )
+        ready_key = '%s:%s' % (self.queue._key_prefix, self._test_queue_type)
+        requeues_remaining_key = '%s:%s:%s:requeues_remaining' % (
+            self.queue._key_prefix, self._test_queue_type,
+            self._test_queue_id)
+
+        # the delay doubles with every attempt, up to retry_max_delay.
+        for attempt, backoff in enumerate([1000, 2000, 3000, 3000], 1):
+            response = self.queue.dequeue(queue_type=self._test_queue_type)
+            self.assertEqual(response['job_id'], job_id)
+            timestamp = generate_epoch()
+            self.queue.release(
+                job_id=job_id,
+                queue_id=self._test_queue_id,
+                queue_type=self._test_queue_type
+            )
+            delay = self.queue._r.zscore(
+                ready_key, self._test_queue_id) - timestamp
+            self.assertTrue(backoff <= delay < backoff + 1000)
+            self.assertEqual(int(self.queue._r.hget(
+                requeues_remaining_key, '%s:attempts' % job_id)), attempt)
+            # make the job ready right away.
+            self.queue._r.zadd(ready_key, {self._test_queue_id: 0})
+
+        # an explicit delay longer than the backoff wins.
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        timestamp = generate_epoch()
+        self.queue.release(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            delay_ms=10000
+        )
+        delay = self.queue._r.zscore(
+            ready_key, self._test_queue_id) - timestamp
+        self.assertTrue(10000 <= delay < 11000)
+        self.queue._r.zadd(ready_key, {self._test_queue_id: 0})
+
+        # the attempts are cleaned up on finish.
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        self.queue.finish(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type
+        )
+        self.assertFalse(self.queue._r.exists(requeues_remaining_key))
+
+    def test_release_with_retry_backoff_behind_other_jobs(self):
+        self._enable_retry_backoff(
+            self._test_queue_type, retry_base_delay=10000)
+        self.assertEqual(
+            self.queue._get_retry_policy(self._test_queue_type)[2], 60000)
+        job_ids = [self._get_job_id() for _ in range(2)]
+        for job_id in job_ids:
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=0,
+                job_id=job_id,
+                queue_id=self._test_queue_id,
+                queue_type=self._test_queue_type)
+
+        # the failed job goes behind the other job of the queue, which
+        # does not wait for the backoff.
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_ids[0])
+        self.queue.release(
+            job_id=job_ids[0],
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type)
+        for job_id in (job_ids[1], job_ids[0]):
+            response = self.queue.dequeue(queue_type=self._test_queue_type)
+            self.assertEqual(response['job_id'], job_id)
+
+        # alone in its queue, the failed job delays the queue.
+        timestamp = generate_epoch()
+        self.queue.release(
+            job_id=job_ids[0],
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type)
+        ready_key = '%s:%s' % (self.queue._key_prefix, self._test_queue_type)
+        delay = self.queue._r.zscore(
+            ready_key, self._test_queue_id) - timestamp
+        self.assertTrue(20000 <= delay < 21000)
+
+    def test_requeue_with_retry_backoff_jitter(self):
+        self._enable_retry_backoff(
+            self._test_queue_type, retry_base_delay=10000, retry_jitter=0.5)
+        jobs = [{
+            'payload': self._test_payload_1,
+            'interval': 0,
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type,
+            'requeue_limit': 1
+        } for i in range(20)]
+        self.queue.enqueue_many(jobs)
+        self.queue.dequeue_many(queue_type=self._test_queue_type, count=20)
+        # expire the jobs right away.
+        active_key = '%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type)
+        self.queue._r.zadd(active_key, dict(
+            ('%s:%s' % (job['queue_id'], job['job_id']), 1)
+            for job in jobs))
+
+        timestamp = generate_epoch()
+        response = self.queue.requeue()
+        self.assertEqual(response['requeued'], 20)
+        ready_key = '%s:%s' % (self.queue._key_prefix, self._test_queue_type)
+        delays = [
+            self.queue._r.zscore(ready_key, job['queue_id']) - timestamp
+            for job in jobs]
+        # the jitter spreads the retries over half of the backoff.
+        self.assertTrue(all(5000 <= delay < 11000 for delay in delays))
+        self.assertTrue(len(set(delays)) > 1)
+
+        # the attempts are cleaned up when the jobs are discarded.
+        self.queue._r.zadd(ready_key, dict(
+            (job['queue_id'], 0) for job in jobs))
+        self.queue.dequeue_many(queue_type=self._test_queue_type, count=20)
+        self.queue._r.zadd(active_key, dict(
+            ('%s:%s' % (job['queue_id'], job['job_id']), 1)
+            for job in jobs))
+        response = self.queue.requeue()
+        self.assertEqual(response['discarded'], 20)
+        self.assertEqual(self.queue._r.keys('*:requeues_remaining'), [])
+
+    def _discard_jobs(self, queue_type, count):
+        """Enqueues `count` jobs with no requeues, dequeues and
+        releases them, which discards them. Returns the jobs.
+        """
+        jobs = [{
+            'payload': {'message': 'Hello, %d' % i},
+            'interval': 1000 * (i + 1),
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': queue_type,
+            'requeue_limit': self._test_requeue_limit_0
+        } for i in range(count)]
+        self.queue.enqueue_many(jobs)
+        for job in jobs:
+            self.queue.dequeue(queue_type=queue_type)
+            response = self.queue.release(
+                job_id=job['job_id'],
+                queue_id=job['queue_id'],
+                queue_type=queue_type
+            )
+            self.assertEqual(
+                response, {'status': 'success', 'discarded': True})
+        return jobs
+
+    def _enable_dead_letter(self, queue_type):
+        section = 'sharq:%s' % queue_type
+        self.queue._config.add_section(section)
+        self.queue._config.set(section, 'dead_letter', 'true')
+
+    def test_dead_letter_disabled(self):
+        self._discard_jobs(self._test_queue_type, 1)
+        response = self.queue.get_dead_letters(
+            queue_type=self._test_queue_type)
+        self.assertEqual(
+            response, {'status': 'success', 'total': 0, 'dead_letters': []})
+        self.assertEqual(
+            list(self.queue.replay_dead_letters(
+                queue_type=self._test_queue_type)), [])
+
+    def test_dead_letter_per_queue_type(self):
+        self._enable_dead_letter(self._test_queue_type)
+        jobs = self._discard_jobs(self._test_queue_type, 3)
+        self._discard_jobs(self._test2_queue_type, 1)
+
+        response = self.queue.get_dead_letters(
+            queue_type=self._test_queue_type, offset=1, limit=5)
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['total'], 3)
+        self.assertEqual(len(response['dead_letters']), 2)
+        dead_letter = response['dead_letters'][0]
+        discarded_at = dead_letter.pop('discarded_at')
+        self.assertTrue(abs(discarded_at - generate_epoch()) < 5000)
+        self.assertEqual(dead_letter, {
+            'queue_type': self._test_queue_type,
+            'queue_id': jobs[1]['queue_id'],
+            'job_id': jobs[1]['job_id'],
+            'payload': jobs[1]['payload'],
+            'interval': jobs[1]['interval']
+        })
+
+        # the discarded job is cleaned up like a finish.
+        payload_map_name = '%s:payload' % self.queue._key_prefix
+        self.assertFalse(self.queue._r.exists(payload_map_name))
+
+        # dead_letter is not enabled for the other queue type.
+        response = self.queue.get_dead_letters(
+            queue_type=self._test2_queue_type)
+        self.assertEqual(response['total'], 0)
+
+    def test_dead_letter_expired_job(self):
+        self._enable_dead_letter(self._test_queue_type)
+        job_id = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            requeue_limit=self._test_requeue_limit_0
+        )
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        # expire the job right away.
+        self.queue._r.zadd('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type),
+            {'%s:%s' % (self._test_queue_id, job_id): 1})
+
+        response = self.queue.requeue()
+        self.assertEqual(response['discarded'], 1)
+        response = self.queue.get_dead_letters(
+            queue_type=self._test_queue_type)
+        self.assertEqual(response['total'], 1)
+        self.assertEqual(response['dead_letters'][0]['job_id'], job_id)
+        self.assertEqual(
+            response['dead_letters'][0]['payload'], self._test_payload_1)
+        self.assertEqual(response['dead_letters'][0]['interval'], 10000)
+
+    def test_replay_dead_letters(self):
+        self._enable_dead_letter(self._test_queue_type)
+        jobs = self._discard_jobs(self._test_queue_type, 5)
+
+        replay = self.queue.replay_dead_letters(
+            queue_type=self._test_queue_type, limit=3, batch_size=2,
+            requeue_limit=2)
+        responses = list(replay)
+        self.assertEqual(responses, [
+            {'status': 'queued', 'job_id': job['job_id']}
+            for job in jobs[:3]])
+        response = self.queue.get_dead_letters(
+            queue_type=self._test_queue_type)
+        self.assertEqual(response['total'], 2)
+        self.assertEqual(
+            [dead_letter['job_id'] for dead_letter in response['dead_letters']],
+            [job['job_id'] for job in jobs[3:]])
+
+        # the replayed jobs are queued with their payload and interval.
+        # (they get ready after their interval, as they were dequeued
+        # just before.)
+        self.assertEqual(
+            sorted(self.queue._r.zrange('%s:%s' % (
+                self.queue._key_prefix, self._test_queue_type), 0, -1)),
+            sorted(job['queue_id'].encode('utf-8') for job in jobs[:3]))
+        for job in jobs[:3]:
+            self.assertEqual(
+                deserialize_payload(self.queue._r.hget(
+                    '%s:payload' % self.queue._key_prefix,
+                    '%s:%s:%s' % (self._test_queue_type, job['queue_id'],
+                                  job['job_id']))),
+                job['payload'])
+            self.assertEqual(
+                int(self.queue._r.hget(
+                    '%s:interval' % self.queue._key_prefix,
+                    '%s:%s' % (self._test_queue_type, job['queue_id']))),
+                job['interval'])
+            self.assertEqual(
+                int(self.queue._r.hget('%s:%s:%s:requeues_remaining' % (
+                    self.queue._key_prefix, self._test_queue_type,
+                    job['queue_id']), job['job_id'])), 2)
+
+        # replay the rest.
+        responses = list(self.queue.replay_dead_letters(
+            queue_type=self._test_queue_type))
+        self.assertEqual(len(responses), 2)
+        self.assertFalse(self.queue._r.exists('%s:%s:dead' % (
+            self.queue._key_prefix, self._test_queue_type)))
+        self.assertFalse(self.queue._r.exists('%s:%s:dead:job' % (
+            self.queue._key_prefix, self._test_queue_type)))
+
     def test_interval_non_existent_queue(self):
         response = self.queue.interval(
             interval=1000,
@@ -1608,6 +2581,457 @@ class SharQTestCase(unittest.TestCase):
             queue_type=self._test_queue_type, queue_id=self._test_queue_id)
         self.assertEqual(response['queue_length'], 0)
 
+    def test_iter_queue_ids(self):
+        # the jobs of queue-0 to queue-149 are dequeued. a sorted set
+        # is scanned a page at a time once it has more than 128 members.
+        self.queue.enqueue_many([{
+            'payload': self._test_payload_1,
+            'interval': 0,
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(200)])
+        self.queue.dequeue_many(queue_type=self._test_queue_type, count=150)
+        # queue-0 to queue-49 have both ready and dequeued jobs.
+        self.queue.enqueue_many([{
+            'payload': self._test_payload_1,
+            'interval': 0,
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(50)])
+
+        self.queue._r.config_resetstat()
+        pages = list(self.queue.iter_queue_ids(
+            self._test_queue_type, page_size=5))
+        queue_ids = [queue_id for page in pages for queue_id in page]
+        self.assertEqual(
+            sorted(queue_ids), sorted('queue-%d' % i for i in range(200)))
+        self.assertTrue(len(pages) > 2)
+        command_stats = self.queue._r.info('commandstats')
+        self.assertTrue(command_stats['cmdstat_zscan']['calls'] > 2)
+        self.assertNotIn('cmdstat_zrange', command_stats)
+
+        self.assertEqual(sum(self.queue.iter_queue_ids(
+            self._test_queue_type, page_size=5, count_only=True)), 200)
+        self.assertEqual(
+            sorted(self.queue.metrics(self._test_queue_type)['queue_ids']),
+            sorted(queue_ids))
+        self.assertEqual(list(self.queue.iter_queue_ids('call')), [])
+
+    def test_get_queue_lengths(self):
+        for i in range(6):
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,
+                job_id=self._get_job_id(),
+                queue_id='queue-%d' % (i % 3),
+                queue_type=self._test_queue_type)
+
+        queue_ids = ['queue-2', 'queue-0', 'queue-9', 'queue-1']
+        self.queue._r.config_resetstat()
+        queue_lengths = self.queue.get_queue_lengths(
+            self._test_queue_type, queue_ids, batch_size=3)
+        self.assertEqual(queue_lengths, array.array('q', [2, 2, 0, 2]))
+        # one round trip per chunk, and no transactions.
+        command_stats = self.queue._r.info('commandstats')
+        self.assertEqual(command_stats['cmdstat_llen']['calls'], 4)
+        self.assertNotIn('cmdstat_exec', command_stats)
+
+        self.assertEqual(
+            self.queue.get_queue_lengths(self._test_queue_type, []),
+            array.array('q'))
+
+    def test_metrics_many(self):
+        # per second buckets, kept for 3 seconds.
+        self.queue._config.set('sharq', 'metrics_bucket_size', '1000')
+        self.queue._config.set('sharq', 'metrics_retention', '3000')
+        self.queue._initialize()
+        for i in range(5):
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=0,
+                job_id=self._get_job_id(),
+                queue_id='queue-%d' % (i % 2),
+                queue_type=self._test_queue_type)
+        self.queue.dequeue(queue_type=self._test_queue_type)
+
+        queue_ids = ['queue-0', 'queue-1', 'queue-2']
+        self.queue._r.config_resetstat()
+        response = self.queue.metrics_many(
+            self._test_queue_type, queue_ids, batch_size=2)
+        self.assertEqual(response['status'], 'success')
+        # one MGET per queue for each of the enqueue and dequeue counters.
+        command_stats = self.queue._r.info('commandstats')
+        self.assertEqual(command_stats['cmdstat_mget']['calls'], 6)
+        self.assertNotIn('cmdstat_get', command_stats)
+        self.assertEqual(response['queue_ids'], queue_ids)
+        self.assertEqual(len(response['enqueue_counts']), 3)
+        self.assertEqual(len(response['dequeue_counts']), 3)
+
+        # the columns match the metrics of every queue.
+        for i, queue_id in enumerate(queue_ids):
+            queue_metrics = self.queue.metrics(
+                queue_type=self._test_queue_type, queue_id=queue_id)
+            self.assertEqual(
+                response['queue_lengths'][i], queue_metrics['queue_length'])
+            self.assertEqual(
+                sum(counts[i] for counts in
+                    response['enqueue_counts'].values()),
+                sum(queue_metrics['enqueue_counts'].values()))
+            self.assertEqual(
+                sum(counts[i] for counts in
+                    response['dequeue_counts'].values()),
+                sum(queue_metrics['dequeue_counts'].values()))
+        self.assertEqual(sum(sum(counts) for counts in
+                             response['enqueue_counts'].values()), 5)
+        self.assertEqual(sum(sum(counts) for counts in
+                             response['dequeue_counts'].values()), 1)
+
+        # the counters of the queues are not read when they are off.
+        self.queue._config.set('sharq', 'queue_metrics', 'off')
+        self.queue._r.config_resetstat()
+        response = self.queue.metrics_many(self._test_queue_type, queue_ids)
+        self.assertEqual(response['enqueue_counts'], {})
+        self.assertEqual(
+            response['queue_lengths'], array.array('q', [2, 2, 0]))
+        command_stats = self.queue._r.info('commandstats')
+        self.assertNotIn('cmdstat_get', command_stats)
+        self.assertNotIn('cmdstat_mget', command_stats)
+
+        # a chunk is kept below MAX_METRICS_MANY_KEY_COUNT counter keys.
+        self.assertEqual(
+            self.queue._get_metrics_many_batch_size([0] * 3, 1000), 1000)
+        self.assertEqual(
+            self.queue._get_metrics_many_batch_size([0] * 3600, 1000), 13)
+        self.assertEqual(
+            self.queue._get_metrics_many_batch_size([0] * 3600, 5), 5)
+
+    def test_metrics_bucket_size_and_retention(self):
+        # per second buckets, kept for 30 seconds.
+        self.queue._metrics_bucket_size = 1000
+        self.queue._metrics_retention = 30000
+        job_id = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=10000,  # 10s (10000ms)
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+        )
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        timestamp = int(generate_epoch())
+
+        response = self.queue.metrics(
+            queue_type=self._test_queue_type, queue_id=self._test_queue_id)
+        global_response = self.queue.metrics()
+        for counts in [response['enqueue_counts'],
+                       response['dequeue_counts'],
+                       global_response['enqueue_counts'],
+                       global_response['dequeue_counts']]:
+            self.assertEqual(len(counts), 30)
+            self.assertEqual(sum(counts.values()), 1)
+            self.assertTrue(all(
+                int(bucket) % 1000 == 0 for bucket in counts))
+
+        timestamp_second = int(math.floor(timestamp / 1000.0) * 1000)
+        counter_key = '%s:enqueue_counter:%s' % (
+            self.queue._key_prefix, timestamp_second)
+        self.assertEqual(int(self.queue._r.get(counter_key)), 1)
+        self.assertTrue(0 < self.queue._r.ttl(counter_key) <= 30)
+
+    def _count_counter_commands(self, queue_metrics, queue_type_metrics):
+        """Enqueues and dequeues 10 jobs of different queues, with the
+        given metrics modes. Returns the number of counter commands
+        (INCR, INCRBY and EXPIREAT) run by the enqueues and dequeues.
+        """
+        self.queue._r.flushdb()
+        self.queue._config.set('sharq', 'queue_metrics', queue_metrics)
+        self.queue._config.set(
+            'sharq', 'queue_type_metrics', queue_type_metrics)
+
+        def count_commands():
+            command_stats = self.queue._r.info('commandstats')
+            return sum(
+                command_stats.get('cmdstat_%s' % command, {}).get('calls', 0)
+                for command in ('incr', 'incrby', 'expireat'))
+
+        self.queue._r.config_resetstat()
+        for i in range(10):
+            self.queue.enqueue(
+                payload=self._test_payload_1,
+                interval=10000,  # 10s (10000ms)
+                job_id=self._get_job_id(),
+                queue_id='queue-%d' % i,
+                queue_type=self._test_queue_type,
+            )
+        enqueue_command_count = count_commands()
+
+        self.queue._r.config_resetstat()
+        for i in range(10):
+            self.queue.dequeue(queue_type=self._test_queue_type)
+        return enqueue_command_count, count_commands()
+
+    def test_metrics_queue_metrics_modes(self):
+        # the global counter takes 2 commands per call, and the
+        # counter of every queue another 2.
+        self.assertEqual(self._count_counter_commands('on', 'false'), (40, 40))
+        queue_counters = self.queue._r.keys('%s:%s:*_counter:*' % (
+            self.queue._key_prefix, self._test_queue_type))
+        self.assertEqual(len(queue_counters), 20)
+
+        # without the counters of the queues, the 2 commands
+        # per enqueue and dequeue are saved.
+        self.assertEqual(self._count_counter_commands('off', 'false'), (20, 20))
+        self.assertEqual(self.queue._r.keys('%s:%s:*_counter:*' % (
+            self.queue._key_prefix, self._test_queue_type)), [])
+        response = self.queue.metrics(
+            queue_type=self._test_queue_type, queue_id='queue-0')
+        self.assertEqual(sum(response['enqueue_counts'].values()), 0)
+        self.assertNotIn(
+            'enqueue_counts', self.queue.metrics(self._test_queue_type))
+
+        # the counter of the queue_type takes 2 commands per call too,
+        # but a single key.
+        self.assertEqual(self._count_counter_commands('off', 'true'), (40, 40))
+        queue_counters = self.queue._r.keys('%s:%s:*_counter:*' % (
+            self.queue._key_prefix, self._test_queue_type))
+        self.assertEqual(len(queue_counters), 2)
+        response = self.queue.metrics(self._test_queue_type)
+        self.assertEqual(sum(response['enqueue_counts'].values()), 10)
+        self.assertEqual(sum(response['dequeue_counts'].values()), 10)
+
+    def test_metrics_queue_metrics_sampled(self):
+        self.queue._config.set('sharq', 'queue_metrics_sample_rate', '0.5')
+        enqueue_command_count, dequeue_command_count = \
+            self._count_counter_commands('sampled', 'false')
+        # about half of the queues are counted.
+        self.assertTrue(20 <= enqueue_command_count <= 40)
+        self.assertTrue(20 <= dequeue_command_count <= 40)
+        # the sampled counts are scaled up by the inverse of the rate.
+        for i in range(10):
+            response = self.queue.metrics(
+                queue_type=self._test_queue_type, queue_id='queue-%d' % i)
+            self.assertIn(sum(response['enqueue_counts'].values()), (0, 2))
+
+    def test_metrics_queue_metrics_sample_rate(self):
+        self.queue._config.set('sharq', 'queue_metrics', 'sampled')
+        self.queue._config.set('sharq', 'queue_metrics_sample_rate', '0.5')
+        self.queue._dequeue_sample_size = 2
+        for strategy in ('earliest', 'random', 'backlog'):
+            self.queue._r.flushdb()
+            jobs = [{
+                'payload': self._test_payload_1,
+                'interval': 0,
+                'job_id': self._get_job_id(),
+                'queue_id': 'queue-%d' % (i % 2),
+                'queue_type': self._test_queue_type
+            } for i in range(400)]
+            self.queue.enqueue_many(jobs)
+            dequeue_counts = {'queue-0': 0, 'queue-1': 0}
+            for _ in range(200):
+                response = self.queue.dequeue(
+                    queue_type=self._test_queue_type, strategy=strategy)
+                dequeue_counts[response['queue_id']] += 1
+
+            # the sampled count of every queue stays close to its
+            # dequeues, whichever queue the strategy picked.
+            for queue_id, dequeue_count in dequeue_counts.items():
+                response = self.queue.metrics(
+                    queue_type=self._test_queue_type, queue_id=queue_id)
+                sampled_count = sum(response['dequeue_counts'].values())
+                self.assertTrue(
+                    dequeue_count * 0.5 <= sampled_count <=
+                    dequeue_count * 1.5 + 10,
+                    (strategy, queue_id, dequeue_count, sampled_count))
+
+    def test_queue_type_stats(self):
+        def get_stats():
+            stats = self.queue.get_queue_type_stats(self._test_queue_type)
+            # the queued jobs always match the job queues.
+            self.assertEqual(stats['queued'], sum(self.queue.get_queue_lengths(
+                self._test_queue_type, ['queue-0', 'queue-1', 'queue-2'])))
+            return stats
+
+        self.assertEqual(get_stats(), {
+            'queued': 0, 'in_flight': 0, 'requeued': 0, 'discarded': 0})
+
+        jobs = [{
+            'payload': self._test_payload_1,
+            'interval': 0,
+            'job_id': 'job-%d' % i,
+            'queue_id': 'queue-%d' % (i % 3),
+            'queue_type': self._test_queue_type,
+            'requeue_limit': 0 if i == 0 else 1
+        } for i in range(7)]
+        self.queue.enqueue_many(jobs)
+        self.queue.dequeue_many(queue_type=self._test_queue_type, count=3)
+        self.assertEqual(get_stats(), {
+            'queued': 4, 'in_flight': 3, 'requeued': 0, 'discarded': 0})
+
+        self.queue.finish(
+            job_id='job-1', queue_id='queue-1',
+            queue_type=self._test_queue_type)
+        # a job which is not in flight anymore is not counted again.
+        self.queue.finish(
+            job_id='job-1', queue_id='queue-1',
+            queue_type=self._test_queue_type)
+        self.assertEqual(get_stats()['in_flight'], 2)
+
+        # job-0 has no requeues left, and is discarded.
+        active_key = '%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type)
+        for member in self.queue._r.zrange(active_key, 0, -1):
+            self.queue._r.zadd(active_key, {member: 1})
+        self.queue.requeue()
+        self.assertEqual(get_stats(), {
+            'queued': 5, 'in_flight': 0, 'requeued': 1, 'discarded': 1})
+
+        response = self.queue.finish_and_dequeue(
+            job_id='job-1', queue_id='queue-1',
+            queue_type=self._test_queue_type)
+        job = response['next_job']
+        self.queue.release(
+            job_id=job['job_id'], queue_id=job['queue_id'],
+            queue_type=self._test_queue_type)
+        self.assertEqual(get_stats(), {
+            'queued': 5, 'in_flight': 0, 'requeued': 2, 'discarded': 1})
+
+        self.queue.clear_queue(
+            queue_type=self._test_queue_type, queue_id='queue-1')
+        self.queue.clear_queue(
+            queue_type=self._test_queue_type, queue_id='queue-2',
+            purge_all=True)
+        response = self.queue.metrics(queue_type=self._test_queue_type)
+        self.assertEqual(response['queued'], get_stats()['queued'])
+        self.assertEqual(response['in_flight'], 0)
+        self.assertEqual(response['requeued'], 2)
+        self.assertEqual(response['discarded'], 1)
+
+        # a single command reads all the counters.
+        self.queue._r.config_resetstat()
+        self.queue.get_queue_type_stats(self._test_queue_type)
+        command_stats = self.queue._r.info('commandstats')
+        self.assertEqual(
+            sum(stats['calls'] for command, stats in command_stats.items()
+                if command != 'cmdstat_config'), 1)
+
+    def test_clear_queue_queued_stats(self):
+        stats_key = '%s:%s:stats' % (
+            self.queue._key_prefix, self._test_queue_type)
+        for purge_all in (False, True):
+            for i in range(3):
+                self.queue.enqueue(
+                    payload=self._test_payload_1,
+                    interval=0,
+                    job_id=self._get_job_id(),
+                    queue_id=self._test_queue_id,
+                    queue_type=self._test_queue_type)
+            self.assertEqual(self.queue._r.hget(stats_key, 'queued'), b'3')
+
+            # the jobs are deleted and taken off the queued jobs in a
+            # single script call.
+            self.queue._r.config_resetstat()
+            self.queue.clear_queue(
+                queue_type=self._test_queue_type,
+                queue_id=self._test_queue_id, purge_all=purge_all)
+            command_stats = self.queue._r.info('commandstats')
+            self.assertEqual(command_stats['cmdstat_evalsha']['calls'], 1)
+            self.assertNotIn('cmdstat_exec', command_stats)
+            self.assertEqual(self.queue._r.hget(stats_key, 'queued'), b'0')
+            self.assertFalse(self.queue._r.exists('%s:%s:%s' % (
+                self.queue._key_prefix, self._test_queue_type,
+                self._test_queue_id)))
+
+        # a queue which is not ready only loses its job queue.
+        self.queue.clear_queue(
+            queue_type=self._test_queue_type, queue_id=self._test_queue_id,
+            purge_all=True)
+        self.assertEqual(self.queue._r.hget(stats_key, 'queued'), b'0')
+
+    def test_metrics_latency_histograms(self):
+        self.queue._config.set('sharq', 'latency_metrics', 'queue')
+        jobs = [{
+            'payload': self._test_payload_1,
+            'interval': 0,
+            'job_id': self._get_job_id(),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(3)]
+        self.queue.enqueue_many(jobs)
+        time.sleep(0.1)
+        dequeued_jobs = self.queue.dequeue_many(
+            queue_type=self._test_queue_type, count=3)
+        time.sleep(0.3)
+        self.queue.finish_many([
+            (self._test_queue_type, job['queue_id'], job['job_id'])
+            for job in dequeued_jobs])
+
+        response = self.queue.metrics(queue_type=self._test_queue_type)
+        wait_time = response['wait_time']
+        self.assertEqual(wait_time['count'], 3)
+        self.assertTrue(300 <= wait_time['sum'] < 600)
+        self.assertEqual(sum(wait_time['buckets'].values()), 3)
+        self.assertTrue(50 <= wait_time['p50'] <= wait_time['p99'] <= 250)
+        service_time = response['service_time']
+        self.assertEqual(service_time['count'], 3)
+        self.assertTrue(250 <= service_time['p50'] <= 500)
+
+        response = self.queue.metrics(
+            queue_type=self._test_queue_type, queue_id='queue-0')
+        self.assertEqual(response['wait_time']['count'], 1)
+        self.assertEqual(response['service_time']['count'], 1)
+
+        # the job times are cleaned up on finish.
+        self.assertEqual(self.queue._r.keys('*:requeues_remaining'), [])
+
+        # the histograms of the queues are optional.
+        self.queue._config.set('sharq', 'latency_metrics', 'queue_type')
+        response = self.queue.metrics(
+            queue_type=self._test_queue_type, queue_id='queue-0')
+        self.assertNotIn('wait_time', response)
+
+    def test_metrics_latency_requeue(self):
+        self.queue._config.set('sharq', 'latency_metrics', 'queue_type')
+        job_id = self._get_job_id()
+        self.queue.enqueue(
+            payload=self._test_payload_1,
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type,
+            requeue_limit=self._test_requeue_limit_0
+        )
+        time.sleep(0.3)
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        # a job which is not finished has no service time.
+        self.queue.release(
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type
+        )
+        response = self.queue.metrics(queue_type=self._test_queue_type)
+        self.assertEqual(response['wait_time']['count'], 1)
+        self.assertTrue(response['wait_time']['p50'] >= 250)
+        self.assertEqual(response['service_time']['count'], 0)
+        self.assertEqual(response['service_time']['p99'], None)
+        # the job times are cleaned up on discard.
+        self.assertEqual(self.queue._r.keys('*:requeues_remaining'), [])
+
+    def test_metrics_latency_percentiles(self):
+        summary = self.queue._summarize_latencies([
+            {b'10': b'50', b'100': b'40', b'sum': b'3000'},
+            {b'100': b'5', b'1000': b'4', b'+Inf': b'1', b'sum': b'9000'}
+        ])
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['sum'], 12000)
+        self.assertEqual(
+            summary['buckets'], {'10': 50, '100': 45, '1000': 4, '+Inf': 1})
+        # the percentiles are interpolated within their buckets.
+        self.assertEqual(summary['p50'], 10)
+        self.assertEqual(summary['p95'], 100)
+        self.assertEqual(summary['p99'], 1000)
+
     def test_metrics_enqueue_sliding_window(self):
         response = self.queue.metrics(
             queue_type=self._test_queue_type, queue_id=self._test_queue_id)
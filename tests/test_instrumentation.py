@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+import os
+import uuid
+import inspect
+import unittest
+from sharq import SharQ
+from sharq.instrumentation import (Recorder, HistogramRecorder, OPERATIONS,
+                                   UNTIMED_FUNCTIONS)
+from sharq.exceptions import BadArgumentException
+
+
+class ListRecorder(Recorder):
+    """Keeps every (operation, phase) recorded, in order."""
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, operation, phase, duration):
+        self.records.append((operation, phase))
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    """
+    `InstrumentationTestCase` contains the functional test cases
+    that validate the timing of the SharQ calls.
+    """
+
+    def setUp(self):
+        cwd = os.path.dirname(os.path.realpath(__file__))
+        config_path = os.path.join(cwd, 'sharq.test.conf')  # test config
+        self.queue = SharQ(config_path)
+        # flush all the keys in the test db before starting test
+        self.queue._r.flushdb()
+        self._test_queue_id = 'johndoe'
+        self._test_queue_type = 'sms'
+
+    def tearDown(self):
+        self.queue._r.flushdb()
+
+    def _enqueue(self, job_id, queue_type='sms'):
+        self.queue.enqueue(
+            payload={'message': 'Hello, world'},
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=queue_type)
+
+    def test_histogram_recorder_times_phases(self):
+        recorder = HistogramRecorder()
+        self.queue.set_recorder(recorder)
+        job_id = str(uuid.uuid4())
+        self._enqueue(job_id)
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        self.queue.finish(
+            job_id=job_id, queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type)
+
+        snapshot = recorder.snapshot()
+        self.assertEqual(
+            sorted(snapshot['enqueue']),
+            ['lua_enqueue', 'serialize', 'total', 'validate'])
+        self.assertEqual(
+            sorted(snapshot['dequeue']),
+            ['deserialize', 'lua_dequeue', 'total', 'validate'])
+        self.assertEqual(
+            sorted(snapshot['finish']), ['lua_finish', 'total', 'validate'])
+        # the operations called by other operations are parts of them.
+        self.assertNotIn('dequeue_many', snapshot)
+        self.assertNotIn('finish_many', snapshot)
+
+        summary = snapshot['enqueue']['total']
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(sum(summary['buckets'].values()), 1)
+        self.assertTrue(
+            summary['sum'] >= snapshot['enqueue']['lua_enqueue']['sum'])
+        self.assertTrue(summary['p50'] <= summary['p99'])
+
+        recorder.reset()
+        self.assertEqual(recorder.snapshot(), {})
+
+    def test_recorder_nested_phases(self):
+        recorder = ListRecorder()
+        self.queue.set_recorder(recorder)
+        self.queue.enqueue_many([{
+            'payload': {'message': 'Hello, world'},
+            'interval': 0,
+            'job_id': str(uuid.uuid4()),
+            'queue_id': 'queue-%d' % i,
+            'queue_type': self._test_queue_type
+        } for i in range(3)])
+
+        # the enqueue args built within the batch are one validation,
+        # which covers the serialization of every payload.
+        self.assertEqual(recorder.records, [
+            ('enqueue_many', 'serialize'),
+            ('enqueue_many', 'serialize'),
+            ('enqueue_many', 'serialize'),
+            ('enqueue_many', 'validate'),
+            ('enqueue_many', 'lua_enqueue'),
+            ('enqueue_many', 'total')
+        ])
+
+        # the failed calls are timed too.
+        recorder.records = []
+        self.assertRaises(
+            BadArgumentException, self.queue.dequeue_many, count=0)
+        self.assertEqual(recorder.records, [
+            ('dequeue_many', 'validate'), ('dequeue_many', 'total')])
+
+        # the calls outside of any operation.
+        recorder.records = []
+        self.queue._lua_lease(
+            keys=['%s:lease' % self.queue._key_prefix], args=['owner', 1000])
+        self.assertEqual(recorder.records, [('other', 'lua_lease')])
+
+    def test_recorder_requeue_lanes(self):
+        recorder = HistogramRecorder()
+        for queue_type in ('sms', 'call'):
+            self._enqueue(str(uuid.uuid4()), queue_type=queue_type)
+            self.queue.dequeue(queue_type=queue_type)
+
+        self.queue.set_recorder(recorder)
+        self.queue.requeue(concurrency=2)
+        # the lanes run in threads of their own.
+        snapshot = recorder.snapshot()
+        self.assertEqual(snapshot['requeue']['lua_requeue']['count'], 2)
+        # the requeue args of every lane are built in the lanes too.
+        self.assertEqual(snapshot['requeue']['validate']['count'], 3)
+        self.assertNotIn('other', snapshot)
+
+    def test_set_recorder_none(self):
+        lua_enqueue = self.queue._lua_enqueue
+        recorder = ListRecorder()
+        self.queue.set_recorder(recorder)
+        self.assertIsNot(self.queue._lua_enqueue, lua_enqueue)
+
+        # the scripts loaded again are timed as well.
+        self.queue.reload_lua_scripts()
+        self._enqueue(str(uuid.uuid4()))
+        self.assertIn(('enqueue', 'lua_enqueue'), recorder.records)
+
+        self.queue.set_recorder(None)
+        self.assertEqual(self.queue._instrumented, {})
+        self.assertEqual(
+            type(self.queue._lua_enqueue).__name__, 'Script')
+        self.assertNotIn('enqueue', vars(self.queue))
+        self.assertNotIn('_build_enqueue_args', vars(self.queue))
+
+        recorder.records = []
+        self._enqueue(str(uuid.uuid4()))
+        self.assertEqual(recorder.records, [])
+
+    def test_operations_cover_public_functions(self):
+        # every public function of SharQ is either timed, or known
+        # not to talk to redis.
+        public_functions = set(
+            name for name, _ in inspect.getmembers(SharQ, inspect.isfunction)
+            if not name.startswith('_'))
+        self.assertEqual(
+            public_functions, set(OPERATIONS) | set(UNTIMED_FUNCTIONS))
+        self.assertFalse(set(OPERATIONS) & set(UNTIMED_FUNCTIONS))
+
+    def test_recorder_generator_operations(self):
+        recorder = ListRecorder()
+        self._enqueue(str(uuid.uuid4()))
+        self.queue.set_recorder(recorder)
+
+        # the operation is recorded once its generator is exhausted.
+        pages = self.queue.iter_queue_ids(self._test_queue_type)
+        self.assertEqual(recorder.records, [])
+        self.assertEqual(list(pages), [[self._test_queue_id]])
+        self.assertEqual(recorder.records, [('iter_queue_ids', 'total')])
+
+        recorder.records = []
+        self.assertEqual(list(self.queue.replay_dead_letters(
+            queue_type=self._test_queue_type)), [])
+        self.assertEqual(recorder.records[-1], ('replay_dead_letters', 'total'))
+        self.assertTrue(all(
+            operation == 'replay_dead_letters'
+            for operation, _ in recorder.records))
+
+        # the generator of an operation called by another one is a part
+        # of that operation.
+        recorder.records = []
+        self.queue.metrics(queue_type=self._test_queue_type)
+        self.assertEqual(recorder.records, [('metrics', 'total')])
+
+    def test_histogram_recorder_percentiles(self):
+        recorder = HistogramRecorder()
+        for duration in [0.3] * 50 + [0.7] * 45 + [3] * 4 + [20000]:
+            recorder.record('enqueue', 'total', duration)
+
+        summary = recorder.snapshot()['enqueue']['total']
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(
+            summary['buckets'], {'0.5': 50, '1': 45, '5': 4, '+Inf': 1})
+        self.assertEqual(summary['sum'], 20058.5)
+        self.assertEqual(summary['p50'], 0.5)
+        self.assertEqual(summary['p95'], 1)
+        self.assertEqual(summary['p99'], 5)
+
+        recorder.record('enqueue', 'total', 20000)
+        recorder.record('enqueue', 'total', 20000)
+        self.assertEqual(
+            recorder.snapshot()['enqueue']['total']['p99'], 10000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,8 @@ import os
 import unittest
 from datetime import date
 from sharq import SharQ
-from sharq.exceptions import BadArgumentException
+from sharq.queue import MAX_BULK_QUEUE_COUNT
+from sharq.exceptions import BadArgumentException, SharqException
 
 
 class SharQTest(unittest.TestCase):
@@ -406,6 +407,59 @@ class SharQTest(unittest.TestCase):
         self.assertEqual(response, {})
 
 
+    def test_enqueue_many_job_invalid(self):
+        jobs = [
+            {
+                'payload': self.valid_payload,
+                'interval': self.valid_interval,
+                'job_id': self.valid_job_id,
+                'queue_id': self.valid_queue_id,
+                'queue_type': self.valid_queue_type
+            },
+            {
+                'payload': self.valid_payload,
+                'interval': self.valid_interval,
+                'job_id': self.valid_job_id,
+                'queue_id': self.invalid_queue_id_1,
+                'queue_type': self.valid_queue_type
+            }
+        ]
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`queue_id` has an invalid value.',
+            self.queue.enqueue_many,
+            jobs
+        )
+        # nothing should be enqueued when any job is invalid.
+        self.assertEqual(
+            self.queue.get_queue_length(
+                self.valid_queue_type, self.valid_queue_id), 0)
+
+    def test_enqueue_many_job_argument_missing(self):
+        jobs = [
+            {
+                'payload': self.valid_payload,
+                'interval': self.valid_interval,
+                # job_id is missing
+                'queue_id': self.valid_queue_id
+            }
+        ]
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`job_id` is missing in a job.',
+            self.queue.enqueue_many,
+            jobs
+        )
+
+    def test_enqueue_many_batch_size_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`batch_size` has an invalid value.',
+            self.queue.enqueue_many,
+            [],
+            batch_size=0
+        )
+
     def test_dequeue_queue_type_invalid(self):
         # type 1
         self.assertRaisesRegexp(
@@ -501,6 +555,49 @@ class SharQTest(unittest.TestCase):
         # except the above key / value pairs
         self.assertEqual(response, {})
 
+    def test_dequeue_many_count_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`count` has an invalid value.',
+            self.queue.dequeue_many,
+            queue_type=self.valid_queue_type,
+            count=0
+        )
+
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`count` has an invalid value.',
+            self.queue.dequeue_many,
+            queue_type=self.valid_queue_type,
+            count='10'
+        )
+
+    def test_dequeue_timeout_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`timeout` has an invalid value.',
+            self.queue.dequeue,
+            queue_type=self.valid_queue_type,
+            timeout=-1
+        )
+
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`timeout` has an invalid value.',
+            self.queue.dequeue,
+            queue_type=self.valid_queue_type,
+            timeout='1000'
+        )
+
+    def test_dequeue_strategy_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`strategy` has an invalid value.',
+            self.queue.dequeue,
+            queue_type=self.valid_queue_type,
+            strategy='fastest'
+        )
+
     def test_finish_queue_type_invalid(self):
         # type 1
         self.assertRaisesRegexp(
@@ -628,6 +725,255 @@ class SharQTest(unittest.TestCase):
         # except the above key / value pairs
         self.assertEqual(response, {})
 
+    def test_finish_many_job_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`job_id` has an invalid value.',
+            self.queue.finish_many,
+            [(self.valid_queue_type, self.valid_queue_id, self.valid_job_id),
+             (self.valid_queue_type, self.valid_queue_id,
+              self.invalid_job_id_1)]
+        )
+
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`queue_type` has an invalid value.',
+            self.queue.finish_many,
+            [(self.invalid_queue_type_1, self.valid_queue_id,
+              self.valid_job_id)]
+        )
+
+    def test_finish_many_all_ok(self):
+        response = self.queue.finish_many(
+            [(self.valid_queue_type, self.valid_queue_id, self.valid_job_id)])
+        self.assertEqual(response, [{'status': 'failure'}])
+
+        response = self.queue.finish_many([])
+        self.assertEqual(response, [])
+
+    def test_finish_and_dequeue_job_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`job_id` has an invalid value.',
+            self.queue.finish_and_dequeue,
+            job_id=self.invalid_job_id_1,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type
+        )
+
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`queue_id` has an invalid value.',
+            self.queue.finish_and_dequeue,
+            job_id=self.valid_job_id,
+            queue_id=self.invalid_queue_id_1,
+            queue_type=self.valid_queue_type
+        )
+
+    def test_finish_and_dequeue_all_ok(self):
+        response = self.queue.finish_and_dequeue(
+            job_id=self.valid_job_id,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type
+        )
+        self.assertEqual(response, {
+            'status': 'failure',
+            'next_job': {'status': 'failure'}
+        })
+
+    def test_touch_extend_ms_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`extend_ms` has an invalid value.',
+            self.queue.touch,
+            job_id=self.valid_job_id,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type,
+            extend_ms=-1
+        )
+
+    def test_touch_many_job_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`queue_id` has an invalid value.',
+            self.queue.touch_many,
+            [(self.valid_queue_type, self.invalid_queue_id_2,
+              self.valid_job_id)]
+        )
+
+    def test_touch_all_ok(self):
+        response = self.queue.touch(
+            job_id=self.valid_job_id,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type
+        )
+        self.assertEqual(response, {'status': 'failure'})
+
+    def test_release_delay_ms_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`delay_ms` has an invalid value.',
+            self.queue.release,
+            job_id=self.valid_job_id,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type,
+            delay_ms='1000'
+        )
+
+    def test_release_job_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`job_id` has an invalid value.',
+            self.queue.release,
+            job_id=self.invalid_job_id_1,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type
+        )
+
+    def test_release_all_ok(self):
+        response = self.queue.release(
+            job_id=self.valid_job_id,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type
+        )
+        self.assertEqual(response, {'status': 'failure'})
+
+    def test_metrics_config_invalid(self):
+        self.queue._config.set('sharq', 'metrics_bucket_size', '0')
+        self.assertRaisesRegex(
+            SharqException,
+            '`metrics_bucket_size` should be greater than 0.',
+            self.queue._initialize
+        )
+        self.queue._config.set('sharq', 'metrics_bucket_size', '1000')
+        for metrics_retention in ['999', '3601000']:
+            self.queue._config.set(
+                'sharq', 'metrics_retention', metrics_retention)
+            self.assertRaisesRegex(
+                SharqException,
+                '`metrics_retention` should hold between 1 and 3600 buckets.',
+                self.queue._initialize
+            )
+
+    def test_queue_metrics_config_invalid(self):
+        self.queue._config.set('sharq', 'queue_metrics', 'always')
+        self.assertRaisesRegex(
+            SharqException,
+            '`queue_metrics` should be one of on, off, sampled.',
+            self.queue.enqueue,
+            payload=self.valid_payload,
+            interval=self.valid_interval,
+            job_id=self.valid_job_id,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type
+        )
+        self.queue._config.set('sharq', 'queue_metrics', 'sampled')
+        self.queue._config.set('sharq', 'queue_metrics_sample_rate', '0')
+        self.assertRaisesRegex(
+            SharqException,
+            '`queue_metrics_sample_rate` should be between 0 and 1.',
+            self.queue.dequeue,
+            queue_type=self.valid_queue_type
+        )
+        self.queue._config.set('sharq', 'queue_metrics', 'on')
+        self.queue._config.set('sharq', 'queue_type_metrics', 'sometimes')
+        self.assertRaisesRegex(
+            SharqException,
+            '`queue_type_metrics` should be a boolean.',
+            self.queue.dequeue,
+            queue_type=self.valid_queue_type
+        )
+
+    def test_latency_metrics_config_invalid(self):
+        self.queue._config.set('sharq', 'latency_metrics', 'on')
+        self.assertRaisesRegex(
+            SharqException,
+            '`latency_metrics` should be one of off, queue_type, queue.',
+            self.queue.finish,
+            job_id=self.valid_job_id,
+            queue_id=self.valid_queue_id,
+            queue_type=self.valid_queue_type
+        )
+
+    def test_requeue_batch_size_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`batch_size` has an invalid value.',
+            self.queue.requeue,
+            batch_size=0
+        )
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`concurrency` has an invalid value.',
+            self.queue.requeue,
+            concurrency=0
+        )
+
+    def test_retry_backoff_config_invalid(self):
+        self.queue._config.add_section('sharq:%s' % self.valid_queue_type)
+        for option, value, message in [
+                ('retry_base_delay', 'soon', 'should be numbers'),
+                ('retry_base_delay', '-1', 'should not be negative'),
+                ('retry_multiplier', '0.5', 'should be at least 1'),
+                ('retry_jitter', '2', 'should be between 0 and 1')]:
+            self.queue._config.set(
+                'sharq:%s' % self.valid_queue_type, option, value)
+            self.assertRaisesRegex(
+                SharqException,
+                message,
+                self.queue.release,
+                job_id=self.valid_job_id,
+                queue_id=self.valid_queue_id,
+                queue_type=self.valid_queue_type
+            )
+            self.queue._config.remove_option(
+                'sharq:%s' % self.valid_queue_type, option)
+
+    def test_get_dead_letters_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`queue_type` has an invalid value.',
+            self.queue.get_dead_letters,
+            queue_type=self.invalid_queue_type_1
+        )
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`offset` has an invalid value.',
+            self.queue.get_dead_letters,
+            queue_type=self.valid_queue_type,
+            offset=-1
+        )
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`limit` has an invalid value.',
+            self.queue.get_dead_letters,
+            queue_type=self.valid_queue_type,
+            limit=0
+        )
+
+    def test_replay_dead_letters_invalid(self):
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`limit` has an invalid value.',
+            self.queue.replay_dead_letters,
+            queue_type=self.valid_queue_type,
+            limit=0
+        )
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`batch_size` has an invalid value.',
+            self.queue.replay_dead_letters,
+            queue_type=self.valid_queue_type,
+            batch_size='10'
+        )
+        self.assertRaisesRegex(
+            BadArgumentException,
+            '`requeue_limit` has an invalid value.',
+            self.queue.replay_dead_letters,
+            queue_type=self.valid_queue_type,
+            requeue_limit=-2
+        )
+
     def test_interval_interval_invalid(self):
         self.assertRaisesRegexp(
             BadArgumentException,
@@ -808,6 +1154,9 @@ class SharQTest(unittest.TestCase):
         # check if it has a key called 'queue_ids'
         self.assertIn('queue_ids', response)
         response.pop('queue_ids')
+        # along with the counters of the jobs.
+        for field in ('queued', 'in_flight', 'requeued', 'discarded'):
+            self.assertEqual(response.pop(field), 0)
 
         self.assertEqual(response, {})
 
@@ -885,6 +1234,54 @@ class SharQTest(unittest.TestCase):
             queue_id=self.valid_queue_id
         )
 
+    def test_iter_queue_ids_invalid_arguments(self):
+        self.assertRaisesRegexp(
+            BadArgumentException,
+            '`queue_type` has an invalid value.',
+            self.queue.iter_queue_ids,
+            queue_type=self.invalid_queue_type_1
+        )
+        self.assertRaisesRegexp(
+            BadArgumentException,
+            '`page_size` has an invalid value.',
+            self.queue.iter_queue_ids,
+            queue_type=self.valid_queue_type,
+            page_size=0
+        )
+
+    def test_metrics_many_invalid_arguments(self):
+        for function in (self.queue.metrics_many,
+                         self.queue.get_queue_lengths):
+            self.assertRaisesRegexp(
+                BadArgumentException,
+                '`queue_type` has an invalid value.',
+                function,
+                queue_type=self.invalid_queue_type_1,
+                queue_ids=[self.valid_queue_id]
+            )
+            self.assertRaisesRegexp(
+                BadArgumentException,
+                '`queue_id` has an invalid value.',
+                function,
+                queue_type=self.valid_queue_type,
+                queue_ids=[self.valid_queue_id, self.invalid_queue_id_1]
+            )
+            self.assertRaisesRegexp(
+                BadArgumentException,
+                '`batch_size` has an invalid value.',
+                function,
+                queue_type=self.valid_queue_type,
+                queue_ids=[self.valid_queue_id],
+                batch_size=0
+            )
+            self.assertRaisesRegexp(
+                BadArgumentException,
+                '`queue_ids` has an invalid value.',
+                function,
+                queue_type=self.valid_queue_type,
+                queue_ids=[self.valid_queue_id] * (MAX_BULK_QUEUE_COUNT + 1)
+            )
+
     def test_clear_queue_invalid_queue_type(self):
         # type 1
         self.assertRaisesRegexp(
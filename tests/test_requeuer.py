@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+import os
+import uuid
+import time
+import unittest
+from sharq import SharQ
+from sharq.requeuer import Requeuer
+from sharq.utils import generate_epoch
+from sharq.exceptions import BadArgumentException
+from tests.helpers import wait_until
+
+
+class RequeuerTestCase(unittest.TestCase):
+    """
+    `RequeuerTestCase` contains the functional test cases
+    that validate the requeue daemon of SharQ.
+    """
+
+    def setUp(self):
+        cwd = os.path.dirname(os.path.realpath(__file__))
+        config_path = os.path.join(cwd, 'sharq.test.conf')  # test config
+        self.queue = SharQ(config_path)
+        # flush all the keys in the test db before starting test
+        self.queue._r.flushdb()
+        self._test_queue_id = 'johndoe'
+        self._test_queue_type = 'sms'
+        self._requeuers = []
+
+    def tearDown(self):
+        for requeuer in self._requeuers:
+            requeuer.stop()
+        self.queue._r.flushdb()
+
+    def _start_requeuer(self, **kwargs):
+        requeuer = Requeuer(self.queue, **kwargs)
+        self._requeuers.append(requeuer)
+        requeuer.start()
+        return requeuer
+
+    def test_requeuer_defaults_to_config(self):
+        requeuer = Requeuer(self.queue)
+        self.assertEqual(requeuer._interval, 5000)
+        self.assertEqual(requeuer._lease_interval, 15000)
+
+    def test_requeuer_requeues_expired_jobs(self):
+        job_id = str(uuid.uuid4())
+        self.queue.enqueue(
+            payload={'message': 'Hello, world'},
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type)
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        # expire the job right away.
+        self.queue._r.zadd('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type),
+            {'%s:%s' % (self._test_queue_id, job_id): 1})
+
+        requeuer = self._start_requeuer(interval=100)
+        wait_until(self, lambda: requeuer.stats()['requeued'] == 1)
+
+        stats = requeuer.stats()
+        self.assertTrue(stats['is_leader'])
+        self.assertEqual(stats['discarded'], 0)
+        self.assertEqual(stats['errors'], 0)
+        self.assertTrue(stats['passes'] >= 1)
+        self.assertTrue(
+            stats['max_pass_duration'] >= stats['last_pass_duration'] >= 0)
+        response = self.queue.dequeue(queue_type=self._test_queue_type)
+        self.assertEqual(response['job_id'], job_id)
+
+    def test_requeuer_sleeps_until_next_expiry(self):
+        # a short lease, so that the test does not take long.
+        self.queue._job_expire_interval = 1000
+        requeuer = self._start_requeuer(interval=60000)
+        wait_until(self, lambda: requeuer.stats()['passes'] == 1)
+        # there are no active jobs, so the next pass is an interval away.
+        self.assertTrue(
+            requeuer.stats()['next_pass_at'] > generate_epoch() + 50000)
+
+        job_id = str(uuid.uuid4())
+        self.queue.enqueue(
+            payload={'message': 'Hello, world'},
+            interval=0,
+            job_id=job_id,
+            queue_id=self._test_queue_id,
+            queue_type=self._test_queue_type)
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        job_expiry_time = int(self.queue._r.zscore('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type),
+            '%s:%s' % (self._test_queue_id, job_id)))
+
+        # the dequeue wakes the requeuer up, which reschedules the
+        # next pass to when the job expires.
+        wait_until(self, lambda: requeuer.stats()['wakeups'] == 1)
+        wait_until(
+            self, lambda: requeuer.stats()['next_pass_at'] == job_expiry_time)
+        wait_until(self, lambda: requeuer.stats()['requeued'] == 1)
+        self.assertTrue(
+            requeuer.stats()['last_pass_at'] >= job_expiry_time)
+
+        # the requeued job expires before the next pass again.
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        wait_until(self, lambda: requeuer.stats()['wakeups'] == 2)
+
+        # a dequeue which expires after the next pass does not wake it up.
+        self.queue._job_expire_interval = 120000
+        self.queue.enqueue(
+            payload={'message': 'Hello, world'},
+            interval=0,
+            job_id=str(uuid.uuid4()),
+            queue_id='thetourist',
+            queue_type=self._test_queue_type)
+        self.queue.dequeue(queue_type=self._test_queue_type)
+        time.sleep(0.2)
+        self.assertEqual(requeuer.stats()['wakeups'], 2)
+
+    def test_requeuer_dequeue_during_pass(self):
+        self.queue._job_expire_interval = 30000
+        for i in range(2):
+            self.queue.enqueue(
+                payload={'message': 'Hello, world'},
+                interval=0,
+                job_id=str(uuid.uuid4()),
+                queue_id='queue-%d' % i,
+                queue_type=self._test_queue_type)
+        requeue = self.queue.requeue
+        dequeued_jobs = []
+
+        def requeue_and_dequeue(*args, **kwargs):
+            # a job, which expires before the next pass, is dequeued
+            # while the first pass runs.
+            if not dequeued_jobs:
+                dequeued_jobs.append(self.queue.dequeue(
+                    queue_type=self._test_queue_type))
+            return requeue(*args, **kwargs)
+        self.queue.requeue = requeue_and_dequeue
+
+        requeuer = self._start_requeuer(interval=60000)
+        wait_until(self, lambda: requeuer.stats()['passes'] == 1)
+        job = dequeued_jobs[0]
+        job_expiry_time = int(self.queue._r.zscore('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type),
+            '%s:%s' % (job['queue_id'], job['job_id'])))
+        wait_until(
+            self, lambda: requeuer.stats()['next_pass_at'] == job_expiry_time)
+        time.sleep(0.5)
+        # the dequeue neither wakes the requeuer up, nor makes it scan
+        # again before the job expires.
+        stats = requeuer.stats()
+        self.assertEqual(stats['passes'], 1)
+        self.assertEqual(stats['wakeups'], 0)
+        self.assertEqual(stats['next_pass_at'], job_expiry_time)
+
+        # a dequeue while it sleeps reschedules, without a pass.
+        self.queue._job_expire_interval = 20000
+        job = self.queue.dequeue(queue_type=self._test_queue_type)
+        job_expiry_time = int(self.queue._r.zscore('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type),
+            '%s:%s' % (job['queue_id'], job['job_id'])))
+        wait_until(self, lambda: requeuer.stats()['wakeups'] == 1)
+        wait_until(
+            self, lambda: requeuer.stats()['next_pass_at'] == job_expiry_time)
+        self.assertEqual(requeuer.stats()['passes'], 1)
+
+    def test_requeuer_backs_off_after_failed_pass(self):
+        # an expired job, which the failing passes never requeue.
+        self.queue._r.zadd('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type),
+            {'%s:%s' % (self._test_queue_id, uuid.uuid4()): 1})
+        self.queue._r.sadd(
+            '%s:active:queue_type' % self.queue._key_prefix,
+            self._test_queue_type)
+
+        def fail(*args, **kwargs):
+            raise ConnectionError('redis is down')
+        self.queue.requeue = fail
+
+        requeuer = self._start_requeuer(interval=100)
+        with self.assertLogs('sharq.requeuer', level='ERROR'):
+            wait_until(self, lambda: requeuer.stats()['errors'] == 1)
+            time.sleep(1.5)
+        # the passes are retried after the backoff, instead of at the
+        # expired lease.
+        stats = requeuer.stats()
+        self.assertTrue(2 <= stats['errors'] <= 3)
+        self.assertTrue(stats['next_pass_at'] > generate_epoch())
+
+    def test_requeuer_single_leader(self):
+        requeuer_1 = self._start_requeuer(interval=100)
+        wait_until(self, lambda: requeuer_1.stats()['is_leader'])
+        requeuer_2 = self._start_requeuer(interval=100)
+        time.sleep(0.5)
+
+        # only the leader requeues.
+        self.assertTrue(requeuer_1.stats()['is_leader'])
+        self.assertFalse(requeuer_2.stats()['is_leader'])
+        self.assertEqual(requeuer_2.stats()['passes'], 0)
+
+        # the lease is released on stop, and the other requeuer
+        # takes over without waiting for the lease to expire.
+        requeuer_1.stop()
+        self.assertFalse(requeuer_1.stats()['is_leader'])
+        wait_until(self, lambda: requeuer_2.stats()['is_leader'], timeout=1)
+        wait_until(self, lambda: requeuer_2.stats()['passes'] > 0, timeout=1)
+
+    def test_requeuer_invalid_arguments(self):
+        self.assertRaisesRegex(
+            BadArgumentException, '`interval` has an invalid value.',
+            Requeuer, self.queue, interval=0)
+        self.assertRaisesRegex(
+            BadArgumentException, '`lease_interval` has an invalid value.',
+            Requeuer, self.queue, interval=1000, lease_interval=1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Plivo Team. See LICENSE.txt for details.
+import os
+import time
+import unittest
+import threading
+from sharq import SharQ
+from sharq.worker import Worker
+from sharq.exceptions import BadArgumentException
+from tests.helpers import enqueue_jobs, wait_until
+
+
+def square(job):
+    """A picklable handler for the process pool."""
+    return job['payload']['number'] ** 2
+
+
+class WorkerTestCase(unittest.TestCase):
+    """
+    `WorkerTestCase` contains the functional test cases
+    that validate the worker runtime of SharQ.
+    """
+
+    def setUp(self):
+        cwd = os.path.dirname(os.path.realpath(__file__))
+        config_path = os.path.join(cwd, 'sharq.test.conf')  # test config
+        self.queue = SharQ(config_path)
+        # flush all the keys in the test db before starting test
+        self.queue._r.flushdb()
+        self._test_queue_type = 'sms'
+
+    def tearDown(self):
+        self.queue._r.flushdb()
+
+    def _start(self, worker):
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        return thread
+
+    def _active_job_count(self):
+        return self.queue._r.zcard('%s:%s:active' % (
+            self.queue._key_prefix, self._test_queue_type))
+
+    def test_worker_finishes_jobs(self):
+        processed = []
+        enqueue_jobs(self.queue, self._test_queue_type, 10)
+        worker = Worker(
+            self.queue, processed.append, queue_type=self._test_queue_type,
+            concurrency=3)
+        thread = self._start(worker)
+
+        wait_until(self, lambda: len(processed) == 10)
+        worker.stop()
+        thread.join()
+
+        self.assertEqual(
+            sorted(job['payload']['number'] for job in processed),
+            list(range(10)))
+        self.assertEqual(self._active_job_count(), 0)
+        self.assertFalse(self.queue._r.exists(
+            '%s:payload' % self.queue._key_prefix))
+
+    def test_worker_process_pool(self):
+        enqueue_jobs(self.queue, self._test_queue_type, 4)
+        worker = Worker(
+            self.queue, square, queue_type=self._test_queue_type,
+            concurrency=2, executor='process')
+        thread = self._start(worker)
+
+        wait_until(self, lambda: not self.queue._r.exists(
+            '%s:payload' % self.queue._key_prefix))
+        worker.stop()
+        thread.join()
+        self.assertEqual(self._active_job_count(), 0)
+
+    def test_worker_releases_failed_jobs(self):
+        attempts = []
+
+        def fail(job):
+            attempts.append(job['requeues_remaining'])
+            raise ValueError('failed')
+
+        enqueue_jobs(self.queue, self._test_queue_type, 1, requeue_limit=2)
+        worker = Worker(
+            self.queue, fail, queue_type=self._test_queue_type)
+        thread = self._start(worker)
+
+        # the job is released twice, and discarded on the third failure.
+        wait_until(self, lambda: len(attempts) == 3)
+        worker.stop()
+        thread.join()
+
+        self.assertEqual(attempts, [2, 1, 0])
+        self.assertEqual(self._active_job_count(), 0)
+        self.assertFalse(self.queue._r.exists(
+            '%s:payload' % self.queue._key_prefix))
+
+    def test_worker_survives_dequeue_failure(self):
+        processed = []
+        dequeue_many = self.queue.dequeue_many
+        calls = []
+
+        def fail_once(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise ConnectionError('redis is down')
+            return dequeue_many(*args, **kwargs)
+
+        self.queue.dequeue_many = fail_once
+        enqueue_jobs(self.queue, self._test_queue_type, 5)
+        worker = Worker(
+            self.queue, processed.append, queue_type=self._test_queue_type)
+
+        # the worker backs off after the failure and dequeues again.
+        with self.assertLogs('sharq.worker', level='ERROR'):
+            thread = self._start(worker)
+            try:
+                wait_until(self, lambda: len(processed) == 5)
+            finally:
+                worker.stop()
+                thread.join()
+
+        self.assertTrue(len(calls) > 1)
+        self.assertEqual(self._active_job_count(), 0)
+
+    def test_worker_heartbeat_and_graceful_stop(self):
+        started = threading.Event()
+        completed = []
+
+        def slow(job):
+            started.set()
+            # longer than the job_expire_interval of 5s.
+            time.sleep(6)
+            completed.append(job['job_id'])
+
+        jobs = enqueue_jobs(self.queue, self._test_queue_type, 1)
+        worker = Worker(
+            self.queue, slow, queue_type=self._test_queue_type,
+            heartbeat_interval=1000)
+        thread = self._start(worker)
+        self.assertTrue(started.wait(5))
+
+        # the running job is completed before the worker stops.
+        worker.stop()
+        thread.join()
+
+        self.assertEqual(completed, [jobs[0]['job_id']])
+        # the lease was extended, so the job was never requeued.
+        self.queue.requeue()
+        self.assertEqual(self.queue.get_queue_length(
+            self._test_queue_type, jobs[0]['queue_id']), 0)
+        self.assertFalse(self.queue._r.exists(
+            '%s:payload' % self.queue._key_prefix))
+
+    def test_worker_invalid_arguments(self):
+        self.assertRaisesRegex(
+            BadArgumentException, '`concurrency` has an invalid value.',
+            Worker, self.queue, square, concurrency=0)
+        self.assertRaisesRegex(
+            BadArgumentException, '`executor` has an invalid value.',
+            Worker, self.queue, square, executor='fiber')
+        self.assertRaisesRegex(
+            BadArgumentException, '`queue_type` has an invalid value.',
+            Worker, self.queue, square, queue_type='$#')
+
+
+if __name__ == '__main__':
+    unittest.main()